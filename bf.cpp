@@ -1,83 +1,2106 @@
+#include <stdint.h>
+#include <stddef.h>
 #include <string.h>
-#include <math.h>
+#include <time.h>
 #include <unistd.h>
+#include <errno.h>
+#include <setjmp.h>
+#include <signal.h>
+#include <sys/mman.h>
 
+#include <algorithm>
+#include <condition_variable>
 #include <map>
+#include <mutex>
 #include <stack>
+#include <string>
+#include <thread>
+#include <type_traits>
+#include <vector>
 
 #define PY_SSIZE_T_CLEAN
 #include <Python.h>
 
-static PyObject* execute(PyObject *self, PyObject *args)
+// The program is lowered into a small bytecode before it is run. Runs of
+// +/- and </> are folded into a single op, and the loops the DSL emits all the
+// time ([-] for ZERO, [->+<] for MOV/COPY) become straight-line ops.
+enum Op {
+  OP_ADD,  // tape[dp] += arg
+  OP_MOVE, // dp += arg
+  OP_ZERO, // tape[dp] = 0, arg is the step of the loop it replaced
+  OP_MUL,  // tape[dp + off] += tape[dp] * arg
+  OP_OUT,
+  OP_IN,
+  OP_JZ,   // if (!tape[dp]) ip = arg
+  OP_JNZ,  // if (tape[dp]) ip = arg
+  OP_END,
+  // the rest only come from DSL programs (see assemble), which are run as
+  // they are instead of being expanded into brainfuck first
+  OP_MOV,     // tape[dp + off] += tape[dp + arg], tape[dp + arg] = 0
+  OP_MOV_SUB, // tape[dp + off] -= tape[dp + arg], tape[dp + arg] = 0
+  OP_COPY,    // tape[dp + off] = tape[dp + arg]
+  OP_WRITE,   // writes data[arg:arg + off]
+  OP_REPEAT,  // writes data[arg] tape[dp + off] times
+};
+
+// For JZ, JNZ and END, off holds how many ops run between the previous jump
+// and this one (including it), so steps can be counted a block at a time.
+// The op came from source[pos:end], which may include comments.
+struct Inst {
+  Op op;
+  int arg;
+  int off;
+  int pos;
+  int end;
+};
+
+static bool is_bf(char c)
 {
-    const char *instr;
-    int tape_size;
-    int cell_width;
+  return c != '\0' && strchr("+-<>.,[]", c) != NULL;
+}
 
-  if (!PyArg_ParseTuple(args, "iis", &tape_size, &cell_width, &instr))
-      return NULL;
+// Tries to lower the loop starting at src[i] ('[') as a clear or multiply
+// loop: a body made only of +-<> that ends where it started and changes the
+// loop cell by exactly one per iteration. Returns the index of the matching
+// ']' on success, or -1 if the loop has to be run as a loop.
+static int lower_simple_loop(const std::string &src, const std::vector<int> &src_pos, int i,
+                             std::vector<Inst> &code)
+{
+  std::map<int, int> deltas;
+  int pos = 0;
+  int j = i + 1;
+  for (; j < (int) src.size() && src[j] != ']'; j++) {
+    switch (src[j]) {
+      case '+': deltas[pos]++; break;
+      case '-': deltas[pos]--; break;
+      case '>': pos++; break;
+      case '<': pos--; break;
+      default: return -1; // nested loop or I/O
+    }
+  }
+  if (j == (int) src.size() || pos != 0)
+    return -1;
+
+  int step = deltas[0];
+  if (step != 1 && step != -1)
+    return -1;
 
-  int ip = 0;
-  int dp = 0;
-  int tape[tape_size];
-  memset(tape, 0, tape_size * sizeof(int));
-  int cell_max = pow(2, cell_width * 8);
+  // the loop runs tape[dp] times when it counts down and -tape[dp] times when
+  // it counts up, so fold the direction into the factor
+  // the whole loop is attributed to the ZERO, which comes last
+  int pos_i = src_pos[i];
+  for (auto &[off, delta] : deltas) {
+    if (off != 0 && delta != 0)
+      code.push_back({OP_MUL, -step * delta, off, pos_i, pos_i});
+  }
+  code.push_back({OP_ZERO, step, 0, pos_i, src_pos[j] + 1});
+  return j;
+}
+
+// Sets the off of each JZ, JNZ and END to the number of ops since the
+// previous jump. Every jump lands right after another jump (or at the start),
+// so the ops since the last jump always run together.
+static void count_blocks(std::vector<Inst> &code)
+{
+  int last = -1;
+  for (int ip = 0; ip < (int) code.size(); ip++) {
+    if (code[ip].op == OP_JZ || code[ip].op == OP_JNZ) {
+      code[ip].off = ip - last;
+      last = ip;
+    }
+  }
+  code.back().off = code.size() - 1 - last - 1;
+}
+
+// Lowers brainfuck source into bytecode, ignoring comment characters. Jump
+// targets are resolved to bytecode indices so nothing has to be looked up at
+// run time. Returns false (with a Python exception set) on unbalanced
+// brackets.
+static bool lower(const char *instr, std::vector<Inst> &code)
+{
+  std::string src;
+  std::vector<int> src_pos;
+  for (int i = 0; instr[i] != '\0'; i++) {
+    if (is_bf(instr[i])) {
+      src.push_back(instr[i]);
+      src_pos.push_back(i);
+    }
+  }
 
-  std::map<int, int> jump_table;
   std::stack<int> paren_stack;
 
-  for (int i=0; instr[i] != '\0'; i++) {
-    switch (instr[i]) {
-      case '[':
-        paren_stack.push(i);
+  for (int i = 0; i < (int) src.size(); i++) {
+    int pos = src_pos[i];
+    switch (src[i]) {
+      case '+':
+      case '-': {
+        int n = 0;
+        for (; i < (int) src.size() && (src[i] == '+' || src[i] == '-'); i++)
+          n += src[i] == '+' ? 1 : -1;
+        i--;
+        if (n)
+          code.push_back({OP_ADD, n, 0, pos, src_pos[i] + 1});
+        break;
+      }
+      case '>':
+      case '<': {
+        int n = 0;
+        for (; i < (int) src.size() && (src[i] == '>' || src[i] == '<'); i++)
+          n += src[i] == '>' ? 1 : -1;
+        i--;
+        if (n)
+          code.push_back({OP_MOVE, n, 0, pos, src_pos[i] + 1});
+        break;
+      }
+      case '.':
+        code.push_back({OP_OUT, 0, 0, pos, pos + 1});
+        break;
+      case ',':
+        code.push_back({OP_IN, 0, 0, pos, pos + 1});
+        break;
+      case '[': {
+        int end = lower_simple_loop(src, src_pos, i, code);
+        if (end != -1) {
+          i = end;
+          break;
+        }
+        paren_stack.push(code.size());
+        code.push_back({OP_JZ, 0, 0, pos, pos + 1});
         break;
-      case ']':
+      }
+      case ']': {
+        if (paren_stack.empty()) {
+          PyErr_SetString(PyExc_ValueError, "unmatched ']' in brainfuck program");
+          return false;
+        }
         int j = paren_stack.top();
         paren_stack.pop();
-        jump_table[j] = i;
-        jump_table[i] = j;
+        code[j].arg = code.size();
+        code.push_back({OP_JNZ, j, 0, pos, pos + 1});
         break;
+      }
     }
   }
-  
-  while (instr[ip] != '\0') {
-    switch (instr[ip]) {
-      case '>':
-        dp++;
+
+  if (!paren_stack.empty()) {
+    PyErr_SetString(PyExc_ValueError, "unmatched '[' in brainfuck program");
+    return false;
+  }
+
+  int len = strlen(instr);
+  code.push_back({OP_END, 0, 0, len, len});
+  count_blocks(code);
+  return true;
+}
+
+// Pipe connects a run on a worker thread to a Stream that hands its output
+// out a chunk at a time and fetches its input from Python a chunk at a time.
+// At most one chunk is waiting in each direction, so neither side can get
+// more than a chunk ahead of the other.
+struct Pipe {
+  std::mutex lock;
+  std::condition_variable cond;
+  bool has_source;      // otherwise ',' reads the real stdin
+
+  std::string out;      // a chunk of output waiting to be taken
+  bool out_ready = false;
+  std::string in;       // a chunk of input waiting to be read
+  bool in_ready = false;
+  bool want_input = false;
+  std::string reading;  // the chunk of input the run is reading from
+  bool eof = false;
+
+  bool closed = false;  // the Stream went away, stop as soon as possible
+  char cancel = 0;      // Run.cancel, set along with closed
+  bool done = false;    // the run has finished
+};
+
+// Io is where a run reads ',' from and writes '.' to. Input is either a caller
+// supplied buffer, which reads as EOF once it is used up, a Pipe, or the real
+// stdin. Output is collected in a buffer that is flushed when it fills up,
+// before blocking on input and when the run finishes, either to the real
+// stdout, a Pipe or into a string that is handed back to the caller.
+struct Io {
+  const char *in;
+  Py_ssize_t in_len;
+  Py_ssize_t in_pos;
+  Py_ssize_t in_base;   // bytes read from earlier Pipe chunks
+
+  std::string *capture;
+  Pipe *pipe;
+  size_t out_cap;
+  size_t out_len;
+  char out[1 << 16];
+};
+
+static void init_io(Io &io, const char *in, Py_ssize_t in_len, std::string *capture)
+{
+  io.in = in;
+  io.in_len = in_len;
+  io.in_pos = 0;
+  io.in_base = 0;
+  io.capture = capture;
+  io.pipe = NULL;
+  io.out_cap = sizeof(io.out);
+  io.out_len = 0;
+}
+
+static void pipe_write(Pipe &p, const char *buf, size_t len)
+{
+  std::unique_lock<std::mutex> lock(p.lock);
+  p.cond.wait(lock, [&] { return !p.out_ready || p.closed; });
+  if (p.closed)
+    return;
+  p.out.assign(buf, len);
+  p.out_ready = true;
+  p.cond.notify_all();
+}
+
+// Swaps the next chunk of input into io, returning false at EOF.
+static bool pipe_read(Io &io)
+{
+  Pipe &p = *io.pipe;
+  if (p.eof)
+    return false;
+
+  std::unique_lock<std::mutex> lock(p.lock);
+  p.want_input = true;
+  p.cond.notify_all();
+  p.cond.wait(lock, [&] { return p.in_ready || p.closed; });
+  p.want_input = false;
+  p.in_ready = false;
+  if (p.closed || p.in.empty()) {
+    p.eof = true;
+    return false;
+  }
+
+  io.in_base += io.in_len;
+  p.reading.swap(p.in);
+  io.in = p.reading.data();
+  io.in_len = p.reading.size();
+  io.in_pos = 0;
+  return true;
+}
+
+static void flush_output(Io &io)
+{
+  if (io.pipe) {
+    if (io.out_len)
+      pipe_write(*io.pipe, io.out, io.out_len);
+  } else if (io.capture) {
+    io.capture->append(io.out, io.out_len);
+  } else {
+    for (size_t done = 0; done < io.out_len; ) {
+      ssize_t n = write(1, io.out + done, io.out_len - done);
+      if (n < 0 && errno == EINTR)
+        continue;
+      if (n <= 0)
+        break; // nowhere to write to, drop the output like a closed pipe would
+      done += n;
+    }
+  }
+  io.out_len = 0;
+}
+
+static inline void write_output(Io &io, char c)
+{
+  if (io.out_len == io.out_cap)
+    flush_output(io);
+  io.out[io.out_len++] = c;
+}
+
+static void write_string(Io &io, const char *s, size_t len)
+{
+  while (len) {
+    if (io.out_len == io.out_cap)
+      flush_output(io);
+    size_t n = std::min(len, io.out_cap - io.out_len);
+    memcpy(io.out + io.out_len, s, n);
+    io.out_len += n;
+    s += n;
+    len -= n;
+  }
+}
+
+static void repeat_output(Io &io, char c, uint64_t times)
+{
+  while (times) {
+    if (io.out_len == io.out_cap)
+      flush_output(io);
+    size_t n = std::min<uint64_t>(times, io.out_cap - io.out_len);
+    memset(io.out + io.out_len, c, n);
+    io.out_len += n;
+    times -= n;
+  }
+}
+
+static int read_input(Io &io)
+{
+  if (io.in && io.in_pos < io.in_len)
+    return (unsigned char) io.in[io.in_pos++];
+  if (io.pipe && io.pipe->has_source) {
+    // the consumer has to take what we printed before it can feed us more
+    flush_output(io);
+    return pipe_read(io) ? (unsigned char) io.in[io.in_pos++] : 0;
+  }
+  if (io.in)
+    return 0;
+
+  // whatever we printed so far is probably a prompt for this input
+  flush_output(io);
+  unsigned char c;
+  if (read(0, &c, 1) <= 0) return 0;
+  return c;
+}
+
+// Run holds the limits a run is checked against. They are only looked at when
+// a loop jumps back, and even then only once steps reaches next_check, which
+// is at most CHECK_INTERVAL steps away so the clock isn't read all the time.
+// The first two fields are read directly by the JIT.
+struct Run {
+  uint64_t steps;       // bytecode ops executed so far
+  uint64_t next_check;
+  uint64_t max_steps;
+  double deadline;      // CLOCK_MONOTONIC seconds, or 0 for none
+  const volatile char *cancel; // stop as soon as this is nonzero
+  int stop;             // why the run stopped early, or STOP_NONE
+  int ip;               // the op it stopped at
+  Io *io;
+  const char *data;     // what OP_WRITE and OP_REPEAT write
+  uint64_t *counts;     // when profiling, how often each op ran
+  uint64_t *iters;      // when profiling, iterations of each ZERO'd loop
+  char *cells;          // the tape a checked run has to stay on
+  uint64_t bytes;       // and its size
+  long fault;           // the cell a checked run tried to touch off the tape
+};
+
+enum Stop { STOP_NONE, STOP_STEPS, STOP_TIMEOUT, STOP_CANCELLED, STOP_OFF_TAPE };
+
+static const uint64_t CHECK_INTERVAL = 1 << 16;
+
+static double monotonic()
+{
+  struct timespec ts;
+  clock_gettime(CLOCK_MONOTONIC, &ts);
+  return ts.tv_sec + ts.tv_nsec * 1e-9;
+}
+
+static void schedule_check(Run &r)
+{
+  uint64_t next = r.steps + CHECK_INTERVAL;
+  r.next_check = r.max_steps < next ? r.max_steps + 1 : next;
+}
+
+static void init_run(Run &r, Io *io, uint64_t max_steps, double timeout, const char *cancel)
+{
+  r.steps = 0;
+  r.max_steps = max_steps;
+  r.deadline = timeout >= 0 ? monotonic() + timeout : 0;
+  r.cancel = cancel;
+  r.stop = STOP_NONE;
+  r.ip = 0;
+  r.io = io;
+  r.data = NULL;
+  r.counts = NULL;
+  r.iters = NULL;
+  r.cells = NULL;
+  r.bytes = 0;
+  r.fault = 0;
+  schedule_check(r);
+}
+
+// Returns true if the run has to stop, recording why in r.stop.
+static bool check_limits(Run &r)
+{
+  if (r.steps > r.max_steps)
+    r.stop = STOP_STEPS;
+  else if (r.deadline && monotonic() >= r.deadline)
+    r.stop = STOP_TIMEOUT;
+  else if (r.cancel && *r.cancel)
+    r.stop = STOP_CANCELLED;
+  else
+    schedule_check(r);
+  return r.stop != STOP_NONE;
+}
+
+// Cells are stored as the unsigned integer type of the cell width, so wrapping
+// comes for free. Arithmetic is done in at least unsigned int so that narrow
+// cells are not promoted to (signed, overflowing) int.
+template <typename Cell>
+using Arith = typename std::conditional<sizeof(Cell) < sizeof(unsigned), unsigned, Cell>::type;
+
+// Stops a checked run that tried to touch cell, which isn't on the tape.
+static long off_tape(Run &r, uint64_t steps, long cell, long dp)
+{
+  r.stop = STOP_OFF_TAPE;
+  r.fault = cell;
+  r.steps = steps;
+  return dp;
+}
+
+// A Checked run is on a tape that isn't guarded (see GuardedTape), so dp is
+// checked against r.bytes every time it moves, and so is every cell an op
+// touches at an offset from it. Since dp starts on the tape, the cells at dp
+// are always on it.
+#define CHECK_CELL(cell) \
+  do { \
+    if (Checked && (unsigned long) (cell) >= size) \
+      return off_tape(r, steps, (cell), dp); \
+  } while (0)
+
+// Runs bytecode on a tape of Cells, starting at dp. Returns the final dp. If
+// a limit is hit, r.stop and r.ip say why and where it stopped. The Profile
+// instantiation also fills in r.counts and r.iters; the normal one doesn't
+// pay anything for it.
+template <typename Cell, bool Profile, bool Checked>
+static long run(const Inst *code, Cell *tape, long dp, Run &r)
+{
+  Io &io = *r.io;
+  uint64_t steps = r.steps;
+  const unsigned long size = r.bytes / sizeof(Cell);
+
+  for (int ip = 0; ; ip++) {
+    const Inst &in = code[ip];
+    if (Profile)
+      r.counts[ip]++;
+    switch (in.op) {
+      case OP_ADD:
+        tape[dp] = (Arith<Cell>) tape[dp] + (Arith<Cell>) in.arg;
         break;
-      case '<':
-        dp--;
+      case OP_MOVE:
+        dp += in.arg;
+        CHECK_CELL(dp);
         break;
-      case '+':
-        tape[dp]++;
-        tape[dp] %= cell_max;
+      case OP_ZERO:
+        // a loop counting down runs tape[dp] times, one counting up -tape[dp]
+        if (Profile)
+          r.iters[ip] += in.arg < 0 ? tape[dp] : (Cell) -(Arith<Cell>) tape[dp];
+        tape[dp] = 0;
         break;
-      case '-':
-        tape[dp]--;
-        tape[dp] %= cell_max;
+      case OP_MUL:
+        CHECK_CELL(dp + in.off);
+        tape[dp + in.off] += (Arith<Cell>) tape[dp] * (Arith<Cell>) in.arg;
         break;
-      case '.':
-        write(1, (char*) &tape[dp], 1);
+      case OP_OUT:
+        write_output(io, tape[dp]);
         break;
-      case ',':
-        if (read(0, &tape[dp], 1) <= 0) tape[dp] = 0;
+      case OP_IN:
+        tape[dp] = read_input(io);
+        break;
+      case OP_JZ:
+        steps += in.off;
+        if (!tape[dp]) ip = in.arg;
         break;
-      case '[':
-        if (!tape[dp]) ip=jump_table[ip];
+      case OP_JNZ:
+        steps += in.off;
+        if (tape[dp]) {
+          if (steps >= r.next_check) {
+            r.steps = steps;
+            if (check_limits(r)) {
+              r.ip = ip;
+              return dp;
+            }
+          }
+          ip = in.arg;
+        }
         break;
-      case ']':
-        if (tape[dp]) ip=jump_table[ip];
+      case OP_END:
+        r.steps = steps + in.off;
+        return dp;
+      case OP_MOV:
+        CHECK_CELL(dp + in.off);
+        CHECK_CELL(dp + in.arg);
+        tape[dp + in.off] += tape[dp + in.arg];
+        tape[dp + in.arg] = 0;
+        break;
+      case OP_MOV_SUB:
+        CHECK_CELL(dp + in.off);
+        CHECK_CELL(dp + in.arg);
+        tape[dp + in.off] -= tape[dp + in.arg];
+        tape[dp + in.arg] = 0;
+        break;
+      case OP_COPY:
+        CHECK_CELL(dp + in.off);
+        CHECK_CELL(dp + in.arg);
+        tape[dp + in.off] = tape[dp + in.arg];
+        break;
+      case OP_WRITE:
+        write_string(io, r.data + in.arg, in.off);
+        break;
+      case OP_REPEAT:
+        CHECK_CELL(dp + in.off);
+        repeat_output(io, r.data[in.arg], tape[dp + in.off]);
         break;
-      default: ; // ignore other characters
     }
-    ip++;
   }
+}
+
+static bool valid_width(int cell_width)
+{
+  if (cell_width == 1 || cell_width == 2 || cell_width == 4 || cell_width == 8)
+    return true;
+  PyErr_Format(PyExc_ValueError, "cell width must be 1, 2, 4 or 8, not %d", cell_width);
+  return false;
+}
+
+// Gets the bytes ',' reads from input. str is encoded as latin-1 (anything
+// it can't hold becoming '?') to read the same as in the python engines.
+static bool get_input(PyObject *input, Py_buffer *view)
+{
+  if (!PyUnicode_Check(input))
+    return PyObject_GetBuffer(input, view, PyBUF_SIMPLE) == 0;
+  PyObject *bytes = PyUnicode_AsEncodedString(input, "latin-1", "replace");
+  if (!bytes)
+    return false;
+  // the view keeps its own reference to bytes
+  bool ok = PyObject_GetBuffer(bytes, view, PyBUF_SIMPLE) == 0;
+  Py_DECREF(bytes);
+  return ok;
+}
 
+// Picks the kernel for the cell width once, rather than on every op.
+template <bool Profile, bool Checked>
+static long run_width(int cell_width, const Inst *code, void *tape, long dp, Run &r)
+{
+  switch (cell_width) {
+    case 1: return run<uint8_t, Profile, Checked>(code, (uint8_t*) tape, dp, r);
+    case 2: return run<uint16_t, Profile, Checked>(code, (uint16_t*) tape, dp, r);
+    case 4: return run<uint32_t, Profile, Checked>(code, (uint32_t*) tape, dp, r);
+    default: return run<uint64_t, Profile, Checked>(code, (uint64_t*) tape, dp, r);
+  }
+}
+
+// Build with -DBF_NO_COMPUTED_GOTO to leave out the threaded kernel, as
+// compilers without the labels-as-values extension have to.
+#if (defined(__GNUC__) || defined(__clang__)) && !defined(BF_NO_COMPUTED_GOTO)
+#define HAVE_THREADED 1
+
+// Same as run, but dispatches with computed gotos: every op ends by jumping
+// straight to the handler of the next one, so each has its own indirect
+// branch for the predictor to learn instead of sharing the switch's one.
+template <typename Cell, bool Checked>
+static long run_threaded(const Inst *code, Cell *tape, long dp, Run &r)
+{
+  // in the same order as Op
+  static void *const labels[] = {
+    &&op_add, &&op_move, &&op_zero, &&op_mul, &&op_out, &&op_in, &&op_jz, &&op_jnz, &&op_end,
+    &&op_mov, &&op_mov_sub, &&op_copy, &&op_write, &&op_repeat,
+  };
+  Io &io = *r.io;
+  uint64_t steps = r.steps;
+  const unsigned long size = r.bytes / sizeof(Cell);
+  const Inst *in = code;
+
+#define DISPATCH() goto *labels[in->op]
+#define NEXT() do { in++; DISPATCH(); } while (0)
+
+  DISPATCH();
+
+op_add:
+  tape[dp] = (Arith<Cell>) tape[dp] + (Arith<Cell>) in->arg;
+  NEXT();
+op_move:
+  dp += in->arg;
+  CHECK_CELL(dp);
+  NEXT();
+op_zero:
+  tape[dp] = 0;
+  NEXT();
+op_mul:
+  CHECK_CELL(dp + in->off);
+  tape[dp + in->off] += (Arith<Cell>) tape[dp] * (Arith<Cell>) in->arg;
+  NEXT();
+op_out:
+  write_output(io, tape[dp]);
+  NEXT();
+op_in:
+  tape[dp] = read_input(io);
+  NEXT();
+op_jz:
+  steps += in->off;
+  if (!tape[dp])
+    in = code + in->arg;
+  NEXT();
+op_jnz:
+  steps += in->off;
+  if (tape[dp]) {
+    if (steps >= r.next_check) {
+      r.steps = steps;
+      if (check_limits(r)) {
+        r.ip = in - code;
+        return dp;
+      }
+    }
+    in = code + in->arg;
+  }
+  NEXT();
+op_end:
+  r.steps = steps + in->off;
+  return dp;
+op_mov:
+  CHECK_CELL(dp + in->off);
+  CHECK_CELL(dp + in->arg);
+  tape[dp + in->off] += tape[dp + in->arg];
+  tape[dp + in->arg] = 0;
+  NEXT();
+op_mov_sub:
+  CHECK_CELL(dp + in->off);
+  CHECK_CELL(dp + in->arg);
+  tape[dp + in->off] -= tape[dp + in->arg];
+  tape[dp + in->arg] = 0;
+  NEXT();
+op_copy:
+  CHECK_CELL(dp + in->off);
+  CHECK_CELL(dp + in->arg);
+  tape[dp + in->off] = tape[dp + in->arg];
+  NEXT();
+op_write:
+  write_string(io, r.data + in->arg, in->off);
+  NEXT();
+op_repeat:
+  CHECK_CELL(dp + in->off);
+  repeat_output(io, r.data[in->arg], tape[dp + in->off]);
+  NEXT();
+
+#undef NEXT
+#undef DISPATCH
+}
+
+template <bool Checked>
+static long run_threaded_width(int cell_width, const Inst *code, void *tape, long dp, Run &r)
+{
+  switch (cell_width) {
+    case 1: return run_threaded<uint8_t, Checked>(code, (uint8_t*) tape, dp, r);
+    case 2: return run_threaded<uint16_t, Checked>(code, (uint16_t*) tape, dp, r);
+    case 4: return run_threaded<uint32_t, Checked>(code, (uint32_t*) tape, dp, r);
+    default: return run_threaded<uint64_t, Checked>(code, (uint64_t*) tape, dp, r);
+  }
+}
+
+#else
+
+// without computed goto, the threaded engine is just the switch one
+template <bool Checked>
+static long run_threaded_width(int cell_width, const Inst *code, void *tape, long dp, Run &r)
+{
+  return run_width<false, Checked>(cell_width, code, tape, dp, r);
+}
+
+#endif
+
+#undef CHECK_CELL
+
+// The JIT translates bytecode into x86-64 machine code in an mmap'd buffer.
+// Like run it is specialized for the cell width, using 8/16/32/64 bit operands
+// so cells wrap on their own.
+#if defined(__x86_64__) && defined(__linux__)
+#define HAVE_JIT 1
+
+// Generated code is called as fn(&tape[dp], run) and returns the final
+// &tape[dp]. It keeps dp in rbx, run in r12 and the step count in r13, all
+// callee saved, so they survive the calls out to the helpers.
+typedef char *(*JitFn)(char *cell, Run *run);
+
+static void jit_out(Run *r, unsigned long c)
+{
+  write_output(*r->io, c);
+}
+
+static unsigned long jit_in(Run *r)
+{
+  return read_input(*r->io);
+}
+
+static int jit_check(Run *r, int ip)
+{
+  if (!check_limits(*r))
+    return 0;
+  r->ip = ip;
+  return 1;
+}
+
+struct Assembler {
+  std::vector<unsigned char> buf;
+  int width;
+
+  void byte(unsigned char b) { buf.push_back(b); }
+
+  void bytes(std::initializer_list<unsigned char> bs) { buf.insert(buf.end(), bs); }
+
+  void imm32(int v)
+  {
+    for (int i = 0; i < 4; i++)
+      byte((unsigned) v >> (8 * i));
+  }
+
+  void imm64(unsigned long v)
+  {
+    for (int i = 0; i < 8; i++)
+      byte(v >> (8 * i));
+  }
+
+  // operand size prefix for a cell sized op; `wide` is the opcode used for
+  // 16/32/64 bit operands, `narrow` the one for 8 bit operands
+  void cell_op(unsigned char narrow, unsigned char wide)
+  {
+    switch (width) {
+      case 1: byte(narrow); break;
+      case 2: bytes({0x66, wide}); break;
+      case 4: byte(wide); break;
+      default: bytes({0x48, wide}); break;
+    }
+  }
+
+  // immediate for a cell sized op
+  void cell_imm(int v)
+  {
+    switch (width) {
+      case 1: byte(v); break;
+      case 2: byte(v); byte(v >> 8); break;
+      default: imm32(v); break;
+    }
+  }
+
+  // [rbx + disp32] with the given ModRM reg field
+  void mem_rbx(int reg, int disp)
+  {
+    byte(0x83 | reg << 3);
+    imm32(disp);
+  }
+
+  // load the current cell zero extended into eax (or rax for 8 byte cells)
+  void load_cell(int reg)
+  {
+    switch (width) {
+      case 1: bytes({0x0f, 0xb6}); break;
+      case 2: bytes({0x0f, 0xb7}); break;
+      case 4: byte(0x8b); break;
+      default: bytes({0x48, 0x8b}); break;
+    }
+    byte(reg << 3 | 0x03); // [rbx]
+  }
+
+  void call(void *fn)
+  {
+    bytes({0x4c, 0x89, 0xe7});    // mov rdi, r12
+    bytes({0x48, 0xb8});          // mov rax, imm64
+    imm64((unsigned long) fn);
+    bytes({0xff, 0xd0});          // call rax
+  }
+
+  void cmp_zero()
+  {
+    cell_op(0x80, 0x83);          // cmp [rbx], 0
+    bytes({0x3b, 0x00});
+  }
+
+  // jcc rel32 to a target that is filled in by patch()
+  size_t jump(unsigned char cc)
+  {
+    bytes({0x0f, cc});
+    imm32(0);
+    return buf.size();
+  }
+
+  void patch(size_t from, size_t to)
+  {
+    int rel = (int) (to - from);
+    memcpy(&buf[from - 4], &rel, 4);
+  }
+
+  void add_steps(int n)
+  {
+    bytes({0x49, 0x81, 0xc5});    // add r13, imm32
+    imm32(n);
+  }
+
+  // jumps to a fault exit filled in by patch() unless the cell rax points at
+  // is on the tape of a checked run, leaving its offset in bytes in rax
+  size_t check_cell()
+  {
+    bytes({0x49, 0x2b, 0x84, 0x24}); // sub rax, [r12 + cells]
+    imm32(offsetof(Run, cells));
+    bytes({0x49, 0x3b, 0x84, 0x24}); // cmp rax, [r12 + bytes]
+    imm32(offsetof(Run, bytes));
+    return jump(0x83);            // jae
+  }
+};
+
+// A checked program does what the Checked kernels do (see CHECK_CELL), the
+// cells of a MUL being the only ones it touches at an offset.
+static void jit_assemble(const Inst *code, int width, bool checked,
+                         std::vector<unsigned char> &out)
+{
+  Assembler a = {{}, width};
+  int len = 0;
+  while (code[len].op != OP_END)
+    len++;
+  std::vector<size_t> ends(len); // end of the jump emitted for each JZ, by ip
+  std::vector<size_t> exits;     // jumps to the epilogue when a limit is hit
+  std::vector<size_t> faults;    // jumps to the exit for touching a cell off the tape
+
+  // three pushes also leave the stack 16 byte aligned for calls
+  a.bytes({0x53, 0x41, 0x54, 0x41, 0x55}); // push rbx; push r12; push r13
+  a.bytes({0x48, 0x89, 0xfb});    // mov rbx, rdi
+  a.bytes({0x49, 0x89, 0xf4});    // mov r12, rsi
+  a.bytes({0x4d, 0x8b, 0x2c, 0x24}); // mov r13, [r12] (steps)
+
+  for (int ip = 0; ip < len; ip++) {
+    const Inst &in = code[ip];
+    switch (in.op) {
+      case OP_ADD:
+        a.cell_op(0x80, 0x81);    // add [rbx], imm
+        a.mem_rbx(0, 0);
+        a.cell_imm(in.arg);
+        break;
+      case OP_MOVE:
+        a.bytes({0x48, 0x81, 0xc3}); // add rbx, imm32
+        a.imm32(in.arg * width);
+        if (checked) {
+          a.bytes({0x48, 0x89, 0xd8}); // mov rax, rbx
+          faults.push_back(a.check_cell());
+        }
+        break;
+      case OP_ZERO:
+        a.cell_op(0xc6, 0xc7);    // mov [rbx], imm
+        a.mem_rbx(0, 0);
+        a.cell_imm(0);
+        break;
+      case OP_MUL:
+        if (checked) {
+          a.bytes({0x48, 0x8d, 0x83}); // lea rax, [rbx + off]
+          a.imm32(in.off * width);
+          faults.push_back(a.check_cell());
+        }
+        a.load_cell(0);           // eax = [rbx]
+        if (width == 8)
+          a.byte(0x48);
+        a.bytes({0x69, 0xc0});    // imul eax, eax, imm32
+        a.imm32(in.arg);
+        a.cell_op(0x00, 0x01);    // add [rbx + off], eax
+        a.mem_rbx(0, in.off * width);
+        break;
+      case OP_OUT:
+        a.load_cell(6);           // esi = [rbx]
+        a.call((void*) jit_out);
+        break;
+      case OP_IN:
+        a.call((void*) jit_in);
+        a.cell_op(0x88, 0x89);    // mov [rbx], eax
+        a.byte(0x03);
+        break;
+      case OP_JZ:
+        a.add_steps(in.off);
+        a.cmp_zero();
+        ends[ip] = a.jump(0x84);  // je past the matching JNZ
+        break;
+      case OP_JNZ: {
+        size_t start = ends[in.arg];
+        a.add_steps(in.off);
+        a.cmp_zero();
+        size_t done = a.jump(0x84); // je out of the loop
+        a.bytes({0x4d, 0x3b, 0x6c, 0x24, 0x08}); // cmp r13, [r12 + 8] (next_check)
+        a.patch(a.jump(0x82), start); // jb to the start of the body
+        a.bytes({0x4d, 0x89, 0x2c, 0x24}); // mov [r12], r13
+        a.byte(0xbe);             // mov esi, ip
+        a.imm32(ip);
+        a.call((void*) jit_check);
+        a.bytes({0x85, 0xc0});    // test eax, eax
+        a.patch(a.jump(0x84), start); // jz to the start of the body
+        a.byte(0xe9);             // jmp to the epilogue
+        a.imm32(0);
+        exits.push_back(a.buf.size());
+        a.patch(done, a.buf.size());
+        a.patch(start, a.buf.size());
+        break;
+      }
+      default:
+        break;
+    }
+  }
+
+  a.add_steps(code[len].off);
+  for (size_t exit : exits)
+    a.patch(exit, a.buf.size());
+  size_t epilogue = a.buf.size();
+  a.bytes({0x4d, 0x89, 0x2c, 0x24}); // mov [r12], r13
+  a.bytes({0x48, 0x89, 0xd8});    // mov rax, rbx
+  a.bytes({0x41, 0x5d, 0x41, 0x5c, 0x5b}); // pop r13; pop r12; pop rbx
+  a.byte(0xc3);                   // ret
+
+  if (!faults.empty()) {
+    for (size_t fault : faults)
+      a.patch(fault, a.buf.size());
+    a.bytes({0x48, 0xc1, 0xf8});  // sar rax, log2(width)
+    a.byte(__builtin_ctz(width));
+    a.bytes({0x49, 0x89, 0x84, 0x24}); // mov [r12 + fault], rax
+    a.imm32(offsetof(Run, fault));
+    a.bytes({0x41, 0xc7, 0x84, 0x24}); // mov dword [r12 + stop], STOP_OFF_TAPE
+    a.imm32(offsetof(Run, stop));
+    a.imm32(STOP_OFF_TAPE);
+    a.byte(0xe9);                 // jmp to the epilogue
+    a.imm32(0);
+    a.patch(a.buf.size(), epilogue);
+  }
+  out.swap(a.buf);
+}
+
+// JitCode is a block of executable memory holding one compiled program.
+struct JitCode {
+  void *mem;
+  size_t size;
+};
+
+static bool jit_compile(const Inst *code, int width, bool checked, JitCode &jit)
+{
+  std::vector<unsigned char> buf;
+  jit_assemble(code, width, checked, buf);
+
+  void *mem = mmap(NULL, buf.size(), PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+  if (mem == MAP_FAILED) {
+    PyErr_SetFromErrno(PyExc_OSError);
+    return false;
+  }
+  memcpy(mem, buf.data(), buf.size());
+  if (mprotect(mem, buf.size(), PROT_READ | PROT_EXEC)) {
+    PyErr_SetFromErrno(PyExc_OSError);
+    munmap(mem, buf.size());
+    return false;
+  }
+
+  jit.mem = mem;
+  jit.size = buf.size();
+  return true;
+}
+
+static void jit_free(JitCode &jit)
+{
+  if (jit.mem)
+    munmap(jit.mem, jit.size);
+  jit.mem = NULL;
+}
+
+#endif
+
+
+// reach is how far past the end of the tape a program can get before it has to
+// touch a cell. dp is only known to be on the tape right after a cell at dp
+// has been touched (every jump does), and from there the moves that follow
+// can take it away until the next such op. Any cell touched at an offset in
+// between is at most that far away plus the offset.
+static long program_reach(const std::vector<Inst> &code)
+{
+  long reach = 0, moved = 0;
+  for (const Inst &in : code) {
+    switch (in.op) {
+      case OP_MOVE:
+        moved += labs(in.arg);
+        break;
+      case OP_MOV:
+      case OP_MOV_SUB:
+      case OP_COPY:
+        reach = std::max(reach, moved + std::max(labs(in.arg), labs(in.off)));
+        break;
+      case OP_REPEAT:
+        reach = std::max(reach, moved + labs(in.off));
+        break;
+      case OP_WRITE:
+        break;
+      case OP_END:
+        // dp itself is checked once the run is over
+        break;
+      case OP_MUL:
+        // and then reads tape[dp] too
+        reach = std::max(reach, moved + labs(in.off));
+        moved = 0;
+        break;
+      default:
+        reach = std::max(reach, moved);
+        moved = 0;
+        break;
+    }
+  }
+  return reach;
+}
+
+// GuardedTape is tape memory mapped between two guard regions that can't be
+// touched, at least reach cells wide, so running off either end faults
+// instead of scribbling over the heap. The mapping is lazy, so pages the
+// program never touches are never materialized. cells doesn't start on a
+// page boundary unless the tape is a whole number of pages, and the slack
+// bytes in front of it aren't guarded, so such tapes are run with the Checked
+// kernels too (see run_checked), as are tapes the caller owns, which can't be
+// guarded at all.
+struct GuardedTape {
+  char *map;
+  size_t map_size;
+  char *cells;
+  size_t bytes;
+  size_t slack;
+};
+
+static bool alloc_tape(GuardedTape &t, size_t bytes, int cell_width, long reach)
+{
+  size_t page = sysconf(_SC_PAGESIZE);
+  size_t guard = ((reach + 1) * cell_width + page - 1) / page * page;
+  size_t body = (bytes + page - 1) / page * page;
+
+  t.map_size = guard + body + guard;
+  t.map = (char*) mmap(NULL, t.map_size, PROT_NONE,
+                       MAP_PRIVATE | MAP_ANONYMOUS | MAP_NORESERVE, -1, 0);
+  if (t.map == MAP_FAILED) {
+    t.map = NULL;
+    PyErr_SetFromErrno(PyExc_MemoryError);
+    return false;
+  }
+  if (body && mprotect(t.map + guard, body, PROT_READ | PROT_WRITE)) {
+    PyErr_SetFromErrno(PyExc_OSError);
+    munmap(t.map, t.map_size);
+    t.map = NULL;
+    return false;
+  }
+  t.slack = body - bytes;
+  t.cells = t.map + guard + t.slack;
+  t.bytes = bytes;
+  return true;
+}
+
+static void free_tape(GuardedTape &t)
+{
+  if (t.map)
+    munmap(t.map, t.map_size);
+  t.map = NULL;
+}
+
+// The fault handler only catches faults in the guarded tape of a run on its
+// own thread, everything else goes to whoever handled the signal before.
+struct Guard {
+  const GuardedTape *tape;
+  char *addr;
+  sigjmp_buf env;
+};
+
+static thread_local Guard *current_guard;
+static struct sigaction old_segv, old_bus;
+
+static void guard_handler(int sig, siginfo_t *info, void *ucontext)
+{
+  Guard *g = current_guard;
+  char *addr = (char*) info->si_addr;
+  if (g && addr >= g->tape->map && addr < g->tape->map + g->tape->map_size) {
+    g->addr = addr;
+    siglongjmp(g->env, 1);
+  }
+
+  // put the old handler back and let the faulting instruction run again
+  struct sigaction old = sig == SIGSEGV ? old_segv : old_bus;
+  if (!(old.sa_flags & SA_SIGINFO) && old.sa_handler == SIG_IGN)
+    old.sa_handler = SIG_DFL;
+  sigaction(sig, &old, NULL);
+}
+
+// Installs guard_handler if it isn't already. Called with the GIL held, so
+// two threads can't both save the other's handler as the old one.
+static bool install_guard_handler()
+{
+  struct sigaction sa, cur;
+  memset(&sa, 0, sizeof(sa));
+  sa.sa_sigaction = guard_handler;
+  sa.sa_flags = SA_SIGINFO | SA_NODEFER | SA_ONSTACK;
+  sigemptyset(&sa.sa_mask);
+
+  int sigs[] = {SIGSEGV, SIGBUS};
+  struct sigaction *olds[] = {&old_segv, &old_bus};
+  for (int i = 0; i < 2; i++) {
+    if (sigaction(sigs[i], NULL, &cur) < 0)
+      goto fail;
+    if ((cur.sa_flags & SA_SIGINFO) && cur.sa_sigaction == guard_handler)
+      continue;
+    if (sigaction(sigs[i], &sa, olds[i]) < 0)
+      goto fail;
+  }
+  return true;
+
+fail:
+  PyErr_SetFromErrno(PyExc_OSError);
+  return false;
+}
+
+// Engine is which kernel a run goes through.
+struct Engine {
+  const Inst *code;
+  const char *data; // see Run.data
+  void *jit;        // compiled checked if checked is set
+  bool threaded;
+  bool profile;
+  bool checked;     // whether the tape is the caller's, see run_checked
+};
+
+template <bool Checked>
+static long run_engine(const Engine &e, int cell_width, char *tape, long dp, Run &r)
+{
+  r.data = e.data;
+  if (e.profile)
+    return run_width<true, Checked>(cell_width, e.code, tape, dp, r);
+#ifdef HAVE_JIT
+  if (e.jit)
+    return (((JitFn) e.jit)(tape + dp * cell_width, &r) - tape) / cell_width;
+#endif
+  if (e.threaded)
+    return run_threaded_width<Checked>(cell_width, e.code, tape, dp, r);
+  return run_width<false, Checked>(cell_width, e.code, tape, dp, r);
+}
+
+// Runs in place on a tape the caller owns, which can't be guarded, with the
+// Checked kernels instead. Returns false if the program tried to touch a cell
+// off it, with *fault set to that cell. Doesn't need the GIL.
+static bool run_checked(const Engine &e, int cell_width, char *cells, size_t bytes, long *dp,
+                        Run &r, long *fault)
+{
+  r.cells = cells;
+  r.bytes = bytes;
+  *dp = run_engine<true>(e, cell_width, cells, *dp, r);
+  if (r.stop == STOP_OFF_TAPE) {
+    r.stop = STOP_NONE;
+    *fault = r.fault;
+    return false;
+  }
+  return true;
+}
+
+
+// Runs on a guarded tape, checked if e.checked says so, which it has to when
+// the tape has slack. Returns false if the program ran off it, with
+// *fault set to the cell it tried to touch. Doesn't need the GIL.
+static bool run_guarded(const Engine &e, int cell_width, GuardedTape &t, long *dp, Run &r,
+                        long *fault)
+{
+  Guard g;
+  g.tape = &t;
+  current_guard = &g;
+  if (sigsetjmp(g.env, 1)) {
+    current_guard = NULL;
+    long off = g.addr - t.cells;
+    *fault = off >= 0 ? off / cell_width : -((-off + cell_width - 1) / cell_width);
+    return false;
+  }
+  if (e.checked) {
+    bool ok = run_checked(e, cell_width, t.cells, t.bytes, dp, r, fault);
+    current_guard = NULL;
+    return ok;
+  }
+  *dp = run_engine<false>(e, cell_width, t.cells, *dp, r);
+  current_guard = NULL;
+
+  long size = t.bytes / cell_width;
+  if (*dp < 0 || *dp >= size) {
+    *fault = *dp;
+    return false;
+  }
+  return true;
+}
+
+
+// Program is a brainfuck program that has already been lowered to bytecode,
+// so it can be run any number of times without being parsed again.
+typedef struct {
+  PyObject_HEAD
+  std::vector<Inst> *code;
+  std::string *source; // kept to map profiles back onto
+  std::string *data;   // see Run.data
+  bool dsl;            // made by assemble rather than compile
+  long reach;          // see program_reach
+#ifdef HAVE_JIT
+  JitCode jit[8]; // machine code for each cell width, unchecked then checked,
+                  // compiled on first use
+#endif
+} ProgramObject;
+
+static PyObject *ProgramType;
+
+static void Program_dealloc(ProgramObject *self)
+{
+  PyTypeObject *tp = Py_TYPE(self);
+  delete self->code;
+  delete self->source;
+  delete self->data;
+#ifdef HAVE_JIT
+  for (JitCode &jit : self->jit)
+    jit_free(jit);
+#endif
+  tp->tp_free(self);
+  Py_DECREF(tp);
+}
+
+// RunResult is what Program.run hands back: the captured output (if any),
+// where the data pointer ended up and how much of the input was consumed.
+static PyStructSequence_Field RunResult_fields[] = {
+  {"output", "captured output as bytes, or None if it went to stdout"},
+  {"dp", "the data pointer when the program finished"},
+  {"input_pos", "how many bytes of input were read"},
+  {"steps", "how many bytecode ops were executed"},
+  {"counts", "if profiling, how many times each source character ran"},
+  {"loops", "if profiling, total iterations of the loop opened at each '['"},
+  {NULL, NULL},
+};
+
+static PyStructSequence_Desc RunResult_desc = {
+  "bfbbfb.bf_cpp.RunResult",
+  "result of Program.run",
+  RunResult_fields,
+  4,
+};
+
+static PyTypeObject *RunResultType;
+
+static PyObject *LimitExceeded;
+
+// Raises LimitExceeded for a run that was stopped early, recording where it
+// stopped so the caller can look at (or resume from) the tape.
+static void raise_limit(const Run &r, const Inst *code, long dp, PyObject *output)
+{
+  PyObject *exc;
+  const char *reason;
+
+  switch (r.stop) {
+    case STOP_STEPS:
+      reason = "steps";
+      exc = PyObject_CallFunction(LimitExceeded, "N",
+                                  PyUnicode_FromFormat("exceeded maximum steps, died %llu > %llu",
+                                                       (unsigned long long) r.steps,
+                                                       (unsigned long long) r.max_steps));
+      break;
+    case STOP_TIMEOUT:
+      reason = "timeout";
+      exc = PyObject_CallFunction(LimitExceeded, "s", "timed out");
+      break;
+    default:
+      reason = "cancelled";
+      exc = PyObject_CallFunction(LimitExceeded, "s", "cancelled");
+      break;
+  }
+  if (!exc)
+    return;
+
+  PyObject *attrs[][2] = {
+    {PyUnicode_FromString("reason"), PyUnicode_FromString(reason)},
+    {PyUnicode_FromString("ip"), PyLong_FromLong(code[r.ip].pos)},
+    {PyUnicode_FromString("dp"), PyLong_FromLong(dp)},
+    {PyUnicode_FromString("steps"), PyLong_FromUnsignedLongLong(r.steps)},
+    {PyUnicode_FromString("output"), Py_NewRef(output)},
+  };
+  bool ok = true;
+  for (auto &attr : attrs) {
+    ok = ok && attr[0] && attr[1] && PyObject_SetAttr(exc, attr[0], attr[1]) == 0;
+    Py_XDECREF(attr[0]);
+    Py_XDECREF(attr[1]);
+  }
+  if (ok)
+    PyErr_SetObject(LimitExceeded, exc);
+  Py_DECREF(exc);
+}
+
+// Makes an array('Q') holding values.
+static PyObject *u64_array(const std::vector<uint64_t> &values)
+{
+  PyObject *array_mod = PyImport_ImportModule("array");
+  if (!array_mod)
+    return NULL;
+  PyObject *array = PyObject_CallMethod(array_mod, "array", "sy#", "Q",
+                                        (const char*) values.data(),
+                                        (Py_ssize_t) (values.size() * sizeof(uint64_t)));
+  Py_DECREF(array_mod);
+  return array;
+}
+
+// Maps a profile of the bytecode back onto the source it was lowered from.
+// Each character gets the number of times it would have run in a plain
+// brainfuck interpreter, except that ones folded away entirely (like "+-")
+// never run. Each '[' also gets the total iterations of its loop.
+static bool map_profile(const ProgramObject *self, const Run &r, PyObject **counts, PyObject **loops)
+{
+  const std::string &src = *self->source;
+  const std::vector<Inst> &code = *self->code;
+  std::vector<uint64_t> char_counts(src.size());
+  std::vector<uint64_t> loop_iters(src.size());
+
+  for (size_t ip = 0; ip < code.size(); ip++) {
+    const Inst &in = code[ip];
+    uint64_t n = r.counts[ip];
+    switch (in.op) {
+      case OP_ZERO:
+        // the '[' ran once per entry, the rest once per iteration
+        char_counts[in.pos] += n;
+        loop_iters[in.pos] += r.iters[ip];
+        for (int pos = in.pos + 1; pos < in.end; pos++) {
+          if (is_bf(src[pos]))
+            char_counts[pos] += r.iters[ip];
+        }
+        break;
+      case OP_JNZ:
+        char_counts[in.pos] += n;
+        loop_iters[code[in.arg].pos] += n;
+        break;
+      default:
+        for (int pos = in.pos; pos < in.end; pos++) {
+          if (is_bf(src[pos]))
+            char_counts[pos] += n;
+        }
+        break;
+    }
+  }
+
+  *counts = u64_array(char_counts);
+  if (!*counts)
+    return false;
+  *loops = u64_array(loop_iters);
+  if (!*loops) {
+    Py_CLEAR(*counts);
+    return false;
+  }
+  return true;
+}
+
+// Sets e up to run self with the named engine, compiling it if need be. checked
+// is for runs on the caller's tape, see run_checked.
+static bool select_engine(ProgramObject *self, const char *engine, int cell_width, bool profile,
+                          bool checked, Engine &e)
+{
+  e = {self->code->data(), self->data->data(), NULL, false, profile, checked};
+  if (self->dsl && (profile || !strcmp(engine, "jit"))) {
+    PyErr_SetString(PyExc_ValueError,
+                    "DSL programs only run on the switch and threaded engines, without profile");
+    return false;
+  }
+  if (!strcmp(engine, "switch")) {
+  }
+  else if (!strcmp(engine, "threaded")) {
+    e.threaded = true;
+  }
+#ifdef HAVE_JIT
+  else if (!strcmp(engine, "jit")) {
+    JitCode &jit = self->jit[__builtin_ctz(cell_width) + 4 * checked];
+    if (!jit.mem && !jit_compile(self->code->data(), cell_width, checked, jit))
+      return false;
+    e.jit = jit.mem;
+  }
+#endif
+  else {
+    PyErr_Format(PyExc_ValueError, "unknown engine '%s'", engine);
+    return false;
+  }
+  if (profile && (e.jit || e.threaded)) {
+    PyErr_SetString(PyExc_ValueError, "only the switch engine can profile");
+    return false;
+  }
+  return true;
+}
+
+static PyObject* Program_run(ProgramObject *self, PyObject *args, PyObject *kwargs)
+{
+  static const char *kwlist[] = {
+    "input", "tape_size", "cell_width", "engine", "capture", "tape", "dp",
+    "max_steps", "timeout", "cancel", "profile", NULL
+  };
+  PyObject *input_obj = Py_None;
+  Py_buffer input_buf = {NULL, NULL};
+  Py_buffer tape_buf = {NULL, NULL};
+  Py_buffer cancel_buf = {NULL, NULL};
+  int tape_size = -1;
+  int cell_width = 1;
+  const char *engine = "switch";
+  int capture = 0;
+  PyObject *tape_obj = Py_None;
+  long dp = 0;
+  long long max_steps = -1;
+  double timeout = -1;
+  PyObject *cancel_obj = Py_None;
+  int profile = 0;
+  std::vector<uint64_t> counts, iters;
+  PyObject *char_counts = NULL, *loop_iters = NULL;
+  PyObject *result = NULL;
+  std::string output;
+  Io *io = NULL;
+  Run r;
+  GuardedTape tape = {NULL};
+  Engine e;
+  bool ok;
+  long fault;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|OiispOlLdOp", (char**) kwlist,
+                                   &input_obj, &tape_size, &cell_width, &engine,
+                                   &capture, &tape_obj, &dp, &max_steps, &timeout,
+                                   &cancel_obj, &profile))
+    return NULL;
+  if (!valid_width(cell_width))
+    goto done;
+  if (input_obj != Py_None && !get_input(input_obj, &input_buf))
+    goto done;
+
+  if (cancel_obj != Py_None) {
+    if (PyObject_GetBuffer(cancel_obj, &cancel_buf, PyBUF_SIMPLE) < 0)
+      goto done;
+    if (cancel_buf.len < 1) {
+      PyErr_SetString(PyExc_ValueError, "cancel must be at least one byte long");
+      goto done;
+    }
+  }
+
+  if (tape_obj != Py_None) {
+    // run directly on the caller's memory, so they see the final state even
+    // if the run fails, checking that it stays on it (see run_checked)
+    if (PyObject_GetBuffer(tape_obj, &tape_buf, PyBUF_WRITABLE | PyBUF_C_CONTIGUOUS) < 0)
+      goto done;
+    if (tape_buf.itemsize != cell_width) {
+      PyErr_Format(PyExc_ValueError, "tape items are %zd bytes but cells are %d bytes",
+                   tape_buf.itemsize, cell_width);
+      goto done;
+    }
+    if (tape_size != -1 && tape_size != tape_buf.len / tape_buf.itemsize) {
+      PyErr_SetString(PyExc_ValueError, "tape_size does not match the size of tape");
+      goto done;
+    }
+    tape_size = tape_buf.len / tape_buf.itemsize;
+  } else {
+    if (tape_size == -1)
+      tape_size = 30000;
+    if (tape_size < 0) {
+      PyErr_SetString(PyExc_ValueError, "tape_size must not be negative");
+      goto done;
+    }
+  }
+  if (dp < 0 || dp >= tape_size) {
+    PyErr_Format(PyExc_IndexError, "dp %ld is not on a tape of %d cells", dp, tape_size);
+    goto done;
+  }
+  if (!tape_buf.obj
+      && (!alloc_tape(tape, (size_t) tape_size * cell_width, cell_width, self->reach)
+          || !install_guard_handler()))
+    goto done;
+
+  io = new Io;
+  init_io(*io, (const char*) input_buf.buf, input_buf.len, capture ? &output : NULL);
+  init_run(r, io, max_steps < 0 ? UINT64_MAX : max_steps, timeout, (const char*) cancel_buf.buf);
+
+  if (!select_engine(self, engine, cell_width, profile, tape_buf.obj || tape.slack, e))
+    goto done;
+  if (profile) {
+    counts.resize(self->code->size());
+    iters.resize(self->code->size());
+    r.counts = counts.data();
+    r.iters = iters.data();
+  }
+
+  // Nothing in here touches Python objects. The tape and input stay exported
+  // until the buffers are released, so they can't be resized underneath us
+  // while other threads run.
+  Py_BEGIN_ALLOW_THREADS
+  if (tape_buf.obj)
+    ok = run_checked(e, cell_width, (char*) tape_buf.buf, tape_buf.len, &dp, r, &fault);
+  else
+    ok = run_guarded(e, cell_width, tape, &dp, r, &fault);
+  flush_output(*io);
+  Py_END_ALLOW_THREADS
+
+  if (!ok) {
+    PyErr_Format(PyExc_IndexError, "dp ran off the tape at cell %ld (the tape has %d cells)",
+                 fault, tape_size);
+    goto done;
+  }
+
+  {
+    PyObject *out = Py_None;
+    if (capture && !(out = PyBytes_FromStringAndSize(output.data(), output.size())))
+      goto done;
+    if (r.stop != STOP_NONE) {
+      raise_limit(r, self->code->data(), dp, out);
+      if (capture)
+        Py_DECREF(out);
+      goto done;
+    }
+
+    result = PyStructSequence_New(RunResultType);
+    if (!result) {
+      if (capture)
+        Py_DECREF(out);
+      goto done;
+    }
+    PyStructSequence_SetItem(result, 0, Py_NewRef(out));
+    if (capture)
+      Py_DECREF(out);
+  }
+  PyStructSequence_SetItem(result, 1, PyLong_FromLong(dp));
+  PyStructSequence_SetItem(result, 2, PyLong_FromSsize_t(io->in_base + io->in_pos));
+  PyStructSequence_SetItem(result, 3, PyLong_FromUnsignedLongLong(r.steps));
+  if (profile && !map_profile(self, r, &char_counts, &loop_iters)) {
+    Py_CLEAR(result);
+    goto done;
+  }
+  PyStructSequence_SetItem(result, 4, profile ? char_counts : Py_NewRef(Py_None));
+  PyStructSequence_SetItem(result, 5, profile ? loop_iters : Py_NewRef(Py_None));
+  if (PyErr_Occurred())
+    Py_CLEAR(result);
+
+done:
+  delete io;
+  free_tape(tape);
+  if (cancel_buf.obj)
+    PyBuffer_Release(&cancel_buf);
+  if (tape_buf.obj)
+    PyBuffer_Release(&tape_buf);
+  if (input_buf.obj)
+    PyBuffer_Release(&input_buf);
+  return result;
+}
+
+// StreamState is everything a streamed run needs that Python doesn't see.
+struct StreamState {
+  Pipe pipe;
+  Io io;
+  Run run;
+  Engine engine;
+  GuardedTape tape = {NULL};
+  int cell_width;
+  long dp = 0;
+  long fault;
+  bool ok;
+  std::thread worker;
+};
+
+// Stream is an iterator over the output of a program running on another
+// thread, see Program.stream.
+typedef struct {
+  PyObject_HEAD
+  PyObject *program;  // keeps the bytecode alive while the worker runs it
+  PyObject *source;   // an iterator, or the object read is bound to
+  PyObject *read;     // source.read, if it has one
+  PyObject *result;   // the RunResult once the run is over
+  Py_ssize_t chunk_size;
+  bool started;
+  StreamState *state;
+} StreamObject;
+
+static PyObject *StreamType;
+
+static void stream_work(StreamState *st)
+{
+  st->ok = run_guarded(st->engine, st->cell_width, st->tape, &st->dp, st->run, &st->fault);
+  flush_output(st->io);
+
+  std::lock_guard<std::mutex> lock(st->pipe.lock);
+  st->pipe.done = true;
+  st->pipe.cond.notify_all();
+}
+
+// Stops the worker, if there is one, and waits for it. Needs the GIL.
+static void stream_stop(StreamObject *self)
+{
+  StreamState *st = self->state;
+  self->started = true;
+  if (!st->worker.joinable())
+    return;
+  {
+    std::lock_guard<std::mutex> lock(st->pipe.lock);
+    st->pipe.closed = true;
+    st->pipe.cancel = 1;
+    st->pipe.cond.notify_all();
+  }
+  Py_BEGIN_ALLOW_THREADS
+  st->worker.join();
+  Py_END_ALLOW_THREADS
+}
+
+static void Stream_dealloc(StreamObject *self)
+{
+  PyTypeObject *tp = Py_TYPE(self);
+  stream_stop(self);
+  free_tape(self->state->tape);
+  delete self->state;
+  Py_XDECREF(self->program);
+  Py_XDECREF(self->source);
+  Py_XDECREF(self->read);
+  Py_XDECREF(self->result);
+  tp->tp_free(self);
+  Py_DECREF(tp);
+}
+
+// Gets the next chunk of input from the source: bytes, or str which is
+// encoded as latin-1 (see get_input). An empty chunk is EOF.
+static bool stream_fetch(StreamObject *self, std::string &chunk)
+{
+  PyObject *data;
+  if (self->read) {
+    data = PyObject_CallFunction(self->read, "n", self->chunk_size);
+  } else {
+    data = PyIter_Next(self->source);
+    if (!data) {
+      chunk.clear();
+      return !PyErr_Occurred();
+    }
+  }
+  if (!data)
+    return false;
+
+  Py_buffer view;
+  bool ok = get_input(data, &view);
+  if (ok) {
+    chunk.assign((const char*) view.buf, view.len);
+    PyBuffer_Release(&view);
+  }
+  Py_DECREF(data);
+  return ok;
+}
+
+// Wraps up a finished run: either raises whatever stopped it or leaves its
+// RunResult in self->result.
+static PyObject *stream_finish(StreamObject *self)
+{
+  StreamState *st = self->state;
+  ProgramObject *program = (ProgramObject*) self->program;
+
+  Py_BEGIN_ALLOW_THREADS
+  st->worker.join();
+  Py_END_ALLOW_THREADS
+  free_tape(st->tape);
+
+  if (!st->ok) {
+    PyErr_Format(PyExc_IndexError, "dp ran off the tape at cell %ld (the tape has %zu cells)",
+                 st->fault, st->tape.bytes / st->cell_width);
+    return NULL;
+  }
+  if (st->run.stop != STOP_NONE) {
+    raise_limit(st->run, program->code->data(), st->dp, Py_None);
+    return NULL;
+  }
+
+  PyObject *result = PyStructSequence_New(RunResultType);
+  if (!result)
+    return NULL;
+  PyStructSequence_SetItem(result, 0, Py_NewRef(Py_None));
+  PyStructSequence_SetItem(result, 1, PyLong_FromLong(st->dp));
+  PyStructSequence_SetItem(result, 2, PyLong_FromSsize_t(st->io.in_base + st->io.in_pos));
+  PyStructSequence_SetItem(result, 3, PyLong_FromUnsignedLongLong(st->run.steps));
+  PyStructSequence_SetItem(result, 4, Py_NewRef(Py_None));
+  PyStructSequence_SetItem(result, 5, Py_NewRef(Py_None));
+  if (PyErr_Occurred()) {
+    Py_DECREF(result);
+    return NULL;
+  }
+  self->result = result;
+  return NULL; // StopIteration
+}
+
+static PyObject *Stream_next(StreamObject *self)
+{
+  StreamState *st = self->state;
+  Pipe &p = st->pipe;
+
+  if (!self->started) {
+    self->started = true;
+    st->worker = std::thread(stream_work, st);
+  }
+  if (!st->worker.joinable())
+    return NULL;
+
+  for (;;) {
+    bool out_ready, want_input, done;
+    Py_BEGIN_ALLOW_THREADS
+    {
+      std::unique_lock<std::mutex> lock(p.lock);
+      p.cond.wait(lock, [&] { return p.out_ready || (p.want_input && !p.in_ready) || p.done; });
+      out_ready = p.out_ready;
+      want_input = p.want_input && !p.in_ready;
+      done = p.done;
+    }
+    Py_END_ALLOW_THREADS
+
+    if (out_ready) {
+      std::string chunk;
+      {
+        std::lock_guard<std::mutex> lock(p.lock);
+        chunk.swap(p.out);
+        p.out_ready = false;
+        p.cond.notify_all();
+      }
+      return PyBytes_FromStringAndSize(chunk.data(), chunk.size());
+    }
+    if (want_input) {
+      std::string chunk;
+      if (!stream_fetch(self, chunk)) {
+        stream_stop(self);
+        return NULL;
+      }
+      std::lock_guard<std::mutex> lock(p.lock);
+      p.in.swap(chunk);
+      p.in_ready = true;
+      p.cond.notify_all();
+      continue;
+    }
+    if (done)
+      return stream_finish(self);
+  }
+}
+
+static PyObject *Stream_close(StreamObject *self, PyObject *Py_UNUSED(args))
+{
+  stream_stop(self);
+  Py_RETURN_NONE;
+}
+
+static PyObject *Stream_get_result(StreamObject *self, void *Py_UNUSED(closure))
+{
+  return Py_NewRef(self->result ? self->result : Py_None);
+}
+
+static PyMethodDef Stream_methods[] = {
+  {"close", (PyCFunction) Stream_close, METH_NOARGS,
+   "stops the run, if it is still going, and waits for it to finish"},
+  {NULL, NULL, 0, NULL} // Sentinel
+};
+
+static PyGetSetDef Stream_getset[] = {
+  {"result", (getter) Stream_get_result, NULL,
+   "the RunResult once the stream is exhausted, otherwise None", NULL},
+  {NULL, NULL, NULL, NULL, NULL} // Sentinel
+};
+
+static PyType_Slot Stream_slots[] = {
+  {Py_tp_dealloc, (void*) Stream_dealloc},
+  {Py_tp_iter, (void*) PyObject_SelfIter},
+  {Py_tp_iternext, (void*) Stream_next},
+  {Py_tp_methods, Stream_methods},
+  {Py_tp_getset, Stream_getset},
+  {Py_tp_doc, (void*) "output of a running program, see Program.stream"},
+  {0, NULL},
+};
+
+static PyType_Spec Stream_spec = {
+  "bfbbfb.bf_cpp.Stream",
+  sizeof(StreamObject),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+  Stream_slots,
+};
+
+static PyObject* Program_stream(ProgramObject *self, PyObject *args, PyObject *kwargs)
+{
+  static const char *kwlist[] = {
+    "source", "chunk_size", "tape_size", "cell_width", "engine", "max_steps", "timeout", NULL
+  };
+  PyObject *source = Py_None;
+  Py_ssize_t chunk_size = 1 << 16;
+  int tape_size = 30000;
+  int cell_width = 1;
+  const char *engine = "switch";
+  long long max_steps = -1;
+  double timeout = -1;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "|OniisLd", (char**) kwlist,
+                                   &source, &chunk_size, &tape_size, &cell_width, &engine,
+                                   &max_steps, &timeout))
+    return NULL;
+  if (!valid_width(cell_width))
+    return NULL;
+  if (chunk_size <= 0 || chunk_size > (Py_ssize_t) sizeof(Io::out)) {
+    PyErr_Format(PyExc_ValueError, "chunk_size must be between 1 and %zu", sizeof(Io::out));
+    return NULL;
+  }
+  if (tape_size <= 0) {
+    PyErr_SetString(PyExc_ValueError, "tape_size must be positive");
+    return NULL;
+  }
+
+  StreamObject *stream = PyObject_New(StreamObject, (PyTypeObject*) StreamType);
+  if (!stream)
+    return NULL;
+  stream->program = Py_NewRef(self);
+  stream->source = NULL;
+  stream->read = NULL;
+  stream->result = NULL;
+  stream->chunk_size = chunk_size;
+  stream->started = false;
+  stream->state = new StreamState;
+
+  StreamState *st = stream->state;
+  if (source != Py_None) {
+    if (PyObject_HasAttrString(source, "read")
+        && !(stream->read = PyObject_GetAttrString(source, "read")))
+      goto fail;
+    stream->source = stream->read ? Py_NewRef(source) : PyObject_GetIter(source);
+    if (!stream->source)
+      goto fail;
+  }
+  if (!alloc_tape(st->tape, (size_t) tape_size * cell_width, cell_width, self->reach)
+      || !select_engine(self, engine, cell_width, false, st->tape.slack, st->engine)
+      || !install_guard_handler())
+    goto fail;
+
+  st->cell_width = cell_width;
+  st->pipe.has_source = source != Py_None;
+  init_io(st->io, NULL, 0, NULL);
+  st->io.pipe = &st->pipe;
+  st->io.out_cap = chunk_size;
+  init_run(st->run, &st->io, max_steps < 0 ? UINT64_MAX : max_steps, timeout, &st->pipe.cancel);
+  return (PyObject*) stream;
+
+fail:
+  Py_DECREF(stream);
+  return NULL;
+}
+
+static PyMethodDef Program_methods[] = {
+  {"run", (PyCFunction) Program_run, METH_VARARGS | METH_KEYWORDS,
+   "run(input=None, tape_size=30000, cell_width=1, engine='switch', capture=False,\n"
+   "    tape=None, dp=0, max_steps=-1, timeout=-1, cancel=None, profile=False)\n"
+   "    -> RunResult\n"
+   "runs the program. input (str|bytes|None) is read by ',' and reads as 0\n"
+   "once it runs out; str is encoded as latin-1 with unencodable characters\n"
+   "read as '?', and if it is None the real stdin is used instead. engine\n"
+   "is 'switch' for the bytecode interpreter, 'threaded' for the same with\n"
+   "computed goto dispatch (see bf_cpp.has_threaded) or 'jit' to compile it\n"
+   "to machine code first (see bf_cpp.has_jit). Output goes to the real\n"
+   "stdout, or if capture is set it is returned as bytes instead. tape may be\n"
+   "a writable buffer with cell_width sized items (bytearray, array('H'),\n"
+   "...) that is run on in place starting at dp, so it holds the final\n"
+   "state afterwards. Moving off either end of the tape raises IndexError.\n"
+   "The run stops with LimitExceeded once it has executed more\n"
+   "than max_steps bytecode ops, after timeout seconds, or once the first\n"
+   "byte of the cancel buffer (e.g. a bytearray(1) set by another thread)\n"
+   "is nonzero. These are only checked as loops jump back, every so often.\n"
+   "With profile set (switch engine only) the result also has counts and\n"
+   "loops, arrays indexed by source offset of how often each character ran\n"
+   "and how many iterations the loop opened at each '[' ran in total"},
+  {"stream", (PyCFunction) Program_stream, METH_VARARGS | METH_KEYWORDS,
+   "stream(source=None, chunk_size=65536, tape_size=30000, cell_width=1,\n"
+   "       engine='switch', max_steps=-1, timeout=-1) -> Stream\n"
+   "runs the program on another thread, iterating over its output in bytes\n"
+   "chunks of at most chunk_size as it is produced. ',' reads from source,\n"
+   "which is either something with a read(n) method (a file, io.BytesIO,\n"
+   "...) or an iterable of bytes or str chunks, where an empty chunk or the\n"
+   "end of it is EOF. If source is None the real stdin is used instead. The\n"
+   "run only gets a chunk ahead of the consumer in each direction. Whatever\n"
+   "stops a run early is raised from the iterator once the output before it\n"
+   "has been yielded, and the Stream's result is set once it is exhausted.\n"
+   "Closing the Stream or dropping it stops the run"},
+  {NULL, NULL, 0, NULL} // Sentinel
+};
+
+static PyType_Slot Program_slots[] = {
+  {Py_tp_dealloc, (void*) Program_dealloc},
+  {Py_tp_methods, Program_methods},
+  {Py_tp_doc, (void*) "a brainfuck program lowered to bytecode, see bf_cpp.compile"},
+  {0, NULL},
+};
+
+static PyType_Spec Program_spec = {
+  "bfbbfb.bf_cpp.Program",
+  sizeof(ProgramObject),
+  0,
+  Py_TPFLAGS_DEFAULT | Py_TPFLAGS_DISALLOW_INSTANTIATION,
+  Program_slots,
+};
+
+static PyObject* compile(PyObject *self, PyObject *args)
+{
+  const char *instr;
+
+  if (!PyArg_ParseTuple(args, "s", &instr))
+    return NULL;
+
+  std::vector<Inst> *code = new std::vector<Inst>();
+  if (!lower(instr, *code)) {
+    delete code;
+    return NULL;
+  }
+
+  ProgramObject *program = PyObject_New(ProgramObject, (PyTypeObject*) ProgramType);
+  if (!program) {
+    delete code;
+    return NULL;
+  }
+  program->code = code;
+  program->source = new std::string(instr);
+  program->data = new std::string();
+  program->dsl = false;
+  program->reach = program_reach(*code);
+#ifdef HAVE_JIT
+  for (JitCode &jit : program->jit)
+    jit.mem = NULL;
+#endif
+  return (PyObject*) program;
+}
+
+// The ops a DSL program can be made of, see assemble.
+static const Op dsl_ops[] = {
+  OP_ADD, OP_MOVE, OP_ZERO, OP_OUT, OP_IN, OP_JZ, OP_JNZ,
+  OP_MOV, OP_MOV_SUB, OP_COPY, OP_WRITE, OP_REPEAT,
+};
+
+static bool is_dsl_op(int op)
+{
+  return std::find(std::begin(dsl_ops), std::end(dsl_ops), op) != std::end(dsl_ops);
+}
+
+// Reads a program from (op, arg, off) triples of ints, checking that every op
+// can be run safely. Brackets are matched here, so the args of JZ and JNZ
+// are ignored. Each op's pos is its index in the stream.
+static bool assemble_ops(const int *ops, int n, Py_ssize_t data_len, std::vector<Inst> &code)
+{
+  std::stack<int> paren_stack;
+
+  for (int i = 0; i < n; i++) {
+    int op = ops[3 * i], arg = ops[3 * i + 1], off = ops[3 * i + 2];
+    if (!is_dsl_op(op)) {
+      PyErr_Format(PyExc_ValueError, "op %d: unknown op %d", i, op);
+      return false;
+    }
+    if ((op == OP_WRITE && (arg < 0 || off < 0 || arg + (Py_ssize_t) off > data_len))
+        || (op == OP_REPEAT && (arg < 0 || arg >= data_len))) {
+      PyErr_Format(PyExc_ValueError, "op %d: writes past the end of data", i);
+      return false;
+    }
+    if (op == OP_ZERO)
+      arg = 1;
+    if (op == OP_JZ) {
+      paren_stack.push(code.size());
+    } else if (op == OP_JNZ) {
+      if (paren_stack.empty()) {
+        PyErr_Format(PyExc_ValueError, "op %d: JNZ without a JZ", i);
+        return false;
+      }
+      arg = paren_stack.top();
+      paren_stack.pop();
+      code[arg].arg = code.size();
+    }
+    code.push_back({(Op) op, arg, off, i, i + 1});
+  }
+
+  if (!paren_stack.empty()) {
+    PyErr_Format(PyExc_ValueError, "op %d: JZ without a JNZ", paren_stack.top());
+    return false;
+  }
+  code.push_back({OP_END, 0, 0, n, n});
+  count_blocks(code);
+  return true;
+}
+
+static PyObject* assemble(PyObject *self, PyObject *args)
+{
+  Py_buffer ops_buf, data_buf = {NULL, NULL};
+
+  if (!PyArg_ParseTuple(args, "y*|y*", &ops_buf, &data_buf))
+    return NULL;
+
+  PyObject *result = NULL;
+  std::vector<Inst> *code = new std::vector<Inst>();
+  ProgramObject *program;
+  if (ops_buf.len % (3 * sizeof(int))) {
+    PyErr_SetString(PyExc_ValueError, "ops must be made of (op, arg, off) int triples");
+    goto done;
+  }
+  if (!assemble_ops((const int*) ops_buf.buf, ops_buf.len / (3 * sizeof(int)), data_buf.len,
+                    *code))
+    goto done;
+
+  program = PyObject_New(ProgramObject, (PyTypeObject*) ProgramType);
+  if (!program)
+    goto done;
+  program->code = code;
+  code = NULL;
+  program->source = new std::string();
+  program->data = new std::string((const char*) data_buf.buf, data_buf.len);
+  program->dsl = true;
+  program->reach = program_reach(*program->code);
+#ifdef HAVE_JIT
+  for (JitCode &jit : program->jit)
+    jit.mem = NULL;
+#endif
+  result = (PyObject*) program;
+
+done:
+  delete code;
+  PyBuffer_Release(&ops_buf);
+  if (data_buf.obj)
+    PyBuffer_Release(&data_buf);
+  return result;
+}
+
+static PyObject* execute(PyObject *self, PyObject *args, PyObject *kwargs)
+{
+  static const char *kwlist[] = {"tape_size", "cell_width", "instr", "max_steps", "timeout", NULL};
+  const char *instr;
+  int tape_size;
+  int cell_width;
+  long long max_steps = -1;
+  double timeout = -1;
+
+  if (!PyArg_ParseTupleAndKeywords(args, kwargs, "iis|Ld", (char**) kwlist,
+                                   &tape_size, &cell_width, &instr, &max_steps, &timeout))
+      return NULL;
+
+  std::vector<Inst> code;
+  if (!lower(instr, code))
+    return NULL;
+
+  if (!valid_width(cell_width))
+    return NULL;
+
+  if (tape_size <= 0) {
+    PyErr_SetString(PyExc_ValueError, "tape_size must be positive");
+    return NULL;
+  }
+  GuardedTape tape;
+  if (!alloc_tape(tape, (size_t) tape_size * cell_width, cell_width, program_reach(code)))
+    return NULL;
+  if (!install_guard_handler()) {
+    free_tape(tape);
+    return NULL;
+  }
+
+  Engine e = {code.data(), NULL, NULL, false, false, tape.slack != 0};
+  Io *io = new Io;
+  Run r;
+  long dp = 0, fault;
+  bool ok;
+  init_io(*io, NULL, 0, NULL);
+  init_run(r, io, max_steps < 0 ? UINT64_MAX : max_steps, timeout, NULL);
+  Py_BEGIN_ALLOW_THREADS
+  ok = run_guarded(e, cell_width, tape, &dp, r, &fault);
+  flush_output(*io);
+  Py_END_ALLOW_THREADS
+  delete io;
+  free_tape(tape);
+
+  if (!ok) {
+    PyErr_Format(PyExc_IndexError, "dp ran off the tape at cell %ld (the tape has %d cells)",
+                 fault, tape_size);
+    return NULL;
+  }
+  if (r.stop != STOP_NONE) {
+    raise_limit(r, code.data(), dp, Py_None);
+    return NULL;
+  }
   Py_RETURN_NONE;
 }
 
 static PyMethodDef methods[] = {
-    {"execute", execute, METH_VARARGS, "executes a brainfuck program"},
+    {"execute", (PyCFunction) execute, METH_VARARGS | METH_KEYWORDS,
+     "execute(tape_size, cell_width, instr, max_steps=-1, timeout=-1)\n"
+     "executes a brainfuck program, raising LimitExceeded if it runs for more\n"
+     "than max_steps bytecode ops or timeout seconds"},
+    {"compile", compile, METH_VARARGS, "compiles a brainfuck program into a reusable Program"},
+    {"assemble", assemble, METH_VARARGS,
+     "assemble(ops, data=b'') -> Program\n"
+     "makes a Program out of DSL instructions serialized as (op, arg, off)\n"
+     "triples of native ints (e.g. array('i').tobytes()), using the OP_*\n"
+     "constants. ADD adds arg to the current cell and MOVE moves dp by arg,\n"
+     "ZERO, IN and OUT work on the current cell, and JZ and JNZ bracket a\n"
+     "loop like [ and ] (their args are ignored). MOV, MOV_SUB and COPY work\n"
+     "on the cells at offsets arg (the source) and off (the destination),\n"
+     "WRITE writes data[arg:arg + off] and REPEAT writes data[arg] as many\n"
+     "times as the cell at offset off says. The program runs on the switch\n"
+     "and threaded engines, and the ip of a LimitExceeded it raises is the\n"
+     "index of an op"},
     {NULL, NULL, 0, NULL} // Sentinel
 };
 
@@ -92,7 +2115,61 @@ static struct PyModuleDef module = {
 PyMODINIT_FUNC
 PyInit_bf_cpp(void)
 {
-    return PyModule_Create(&module);
-}
-
+    PyObject *m = PyModule_Create(&module);
+    if (!m)
+        return NULL;
 
+    ProgramType = PyType_FromSpec(&Program_spec);
+    if (!ProgramType || PyModule_AddObjectRef(m, "Program", ProgramType) < 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
+    StreamType = PyType_FromSpec(&Stream_spec);
+    if (!StreamType || PyModule_AddObjectRef(m, "Stream", StreamType) < 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
+#ifdef HAVE_JIT
+    PyObject *has_jit = Py_True;
+#else
+    PyObject *has_jit = Py_False;
+#endif
+#ifdef HAVE_THREADED
+    PyObject *has_threaded = Py_True;
+#else
+    PyObject *has_threaded = Py_False;
+#endif
+    RunResultType = PyStructSequence_NewType(&RunResult_desc);
+    if (!RunResultType || PyModule_AddObjectRef(m, "RunResult", (PyObject*) RunResultType) < 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
+    LimitExceeded = PyErr_NewExceptionWithDoc(
+        "bfbbfb.bf_cpp.LimitExceeded",
+        "raised when a run is stopped by max_steps, timeout or cancel. reason is\n"
+        "'steps', 'timeout' or 'cancelled', ip is the source offset it stopped\n"
+        "at, dp and steps are the data pointer and step count at that point, and\n"
+        "output is whatever was captured so far",
+        NULL, NULL);
+    if (!LimitExceeded || PyModule_AddObjectRef(m, "LimitExceeded", LimitExceeded) < 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
+    if (PyModule_AddObjectRef(m, "has_jit", has_jit) < 0
+        || PyModule_AddObjectRef(m, "has_threaded", has_threaded) < 0) {
+        Py_DECREF(m);
+        return NULL;
+    }
+    // in the same order as dsl_ops
+    static const char *const dsl_op_names[] = {
+      "OP_ADD", "OP_MOVE", "OP_ZERO", "OP_OUT", "OP_IN", "OP_JZ", "OP_JNZ",
+      "OP_MOV", "OP_MOV_SUB", "OP_COPY", "OP_WRITE", "OP_REPEAT",
+    };
+    for (size_t i = 0; i < std::size(dsl_ops); i++) {
+        if (PyModule_AddIntConstant(m, dsl_op_names[i], dsl_ops[i]) < 0) {
+            Py_DECREF(m);
+            return NULL;
+        }
+    }
+    return m;
+}
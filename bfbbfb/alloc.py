@@ -0,0 +1,355 @@
+from dataclasses import dataclass, replace
+from bfbbfb.dsl import Instruction, LOOP, SHF, ADD, MOV, COPY, OUT_N, OUT_S
+from bfbbfb.interpreter import Interpreter, DSLCode, NativeCode, flatten
+
+# how many times more often the inside of a loop is guessed to run than the
+# code around it, to weigh pointer movement by
+LOOP_WEIGHT = 10
+
+# the fields of each instruction that are cell offsets, and so can be names
+CELL_FIELDS = {
+    ADD: ("tmp",),
+    MOV: ("src", "dest"),
+    COPY: ("src", "tmp", "dest"),
+    OUT_N: ("n", "tmp1", "tmp2"),
+}
+
+# where the pointer is after a loop that moves it by some unknown amount
+LOST = object()
+
+
+@dataclass(frozen=True)
+class AT(Instruction):
+    """
+    AT moves to a named cell. Named cells have no place on the tape until
+    allocate gives them one, so a program with ATs (or with names in place of
+    the offsets of a MOV, COPY or OUT_N) has to go through allocate before it
+    can be compiled or run.
+
+    name (Hashable): the name of the cell, anything but an int
+    """
+    name: object
+
+    def __str__(self):
+        raise TypeError(f"{self!r} needs allocate")
+
+    def exec(self, interp: Interpreter):
+        raise TypeError(f"{self!r} needs allocate")
+
+    def lower(self, code: DSLCode):
+        raise TypeError(f"{self!r} needs allocate")
+
+    def assemble(self, code: NativeCode):
+        raise TypeError(f"{self!r} needs allocate")
+
+    def __repr__(self):
+        return f"AT({self.name!r})"
+
+
+def cell_names(inst):
+    """cell_names gives the names an instruction uses in place of offsets"""
+    return [
+        getattr(inst, f)
+        for f in CELL_FIELDS.get(type(inst), ())
+        if not isinstance(getattr(inst, f), (int, type(None)))
+    ]
+
+
+def cell_offsets(inst):
+    """
+    cell_offsets gives the offsets (not names) from the current cell that an
+    instruction might touch, the current cell always among them
+    """
+    offs = {0}
+    for f in CELL_FIELDS.get(type(inst), ()):
+        if isinstance(getattr(inst, f), int):
+            offs.add(getattr(inst, f))
+    if isinstance(inst, OUT_S):
+        offs.update(off for off in (inst.tmp, *inst.cells) if off is not None)
+    return offs
+
+
+class Usage:
+    """
+    Usage goes through a program once to find out when each named cell is
+    used and which cells the pointer goes between, and how often.
+
+    Properties:
+    uses (dict[Hashable, list[int]]): the steps each name is used at
+    loops (list[tuple[int, int]]): the first and last step of each loop
+    moves (dict[Hashable, dict[Hashable, int]]): how much the pointer is
+    expected to move between two cells per cell between them. None is the
+    cell the program starts on.
+    cur (Hashable): the cell the pointer last went to with an AT, None for
+    the one it started on and LOST if it isn't known
+    delta (int): how far the pointer has moved from cur since
+    raw (set[int]): the cells the program touches by offset from where it
+    starts, before it goes to any named cell, which named cells can't use
+    """
+
+    def __init__(self, program):
+        self.uses = {}
+        self.raw = set()
+        self.loops = []
+        self.moves = {None: {}}
+        self.step = 0
+        self.cur, self.delta = None, 0
+        self.named = False
+        self.go(program, 1)
+
+    def use(self, name):
+        self.uses.setdefault(name, []).append(self.step)
+        self.moves.setdefault(name, {})
+
+    def move(self, a, b, weight):
+        if a != b:
+            self.moves[a][b] = self.moves[a].get(b, 0) + weight
+            self.moves[b][a] = self.moves[b].get(a, 0) + weight
+
+    def here(self, inst):
+        if self.cur is LOST:
+            raise ValueError(f"{inst!r} uses a named cell but where the pointer is isn't known")
+        return self.cur
+
+    def go(self, program, weight):
+        for inst in flatten(program):
+            self.step += 1
+            if isinstance(inst, AT):
+                self.named = True
+                self.use(inst.name)
+                self.move(self.here(inst), inst.name, weight)
+                self.cur, self.delta = inst.name, 0
+            elif isinstance(inst, SHF):
+                self.delta += inst.off
+            elif isinstance(inst, LOOP):
+                self.loop(inst, weight)
+            elif cell_names(inst):
+                self.named = True
+                self.cell_op(inst, weight)
+            elif self.cur is None:
+                self.raw.update(self.delta + off for off in cell_offsets(inst))
+            elif self.cur is not LOST and not self.delta:
+                self.use(self.cur)
+
+    def loop(self, inst, weight):
+        if self.cur is None:
+            self.raw.add(self.delta)
+        elif self.cur is not LOST and not self.delta:
+            self.use(self.cur)
+        start, named = self.step, self.named
+        entry = self.cur, self.delta
+        self.named = False
+        self.go(inst.insts, weight * LOOP_WEIGHT)
+        if (self.cur, self.delta) != entry:
+            if self.named:
+                raise ValueError(f"LOOP starting at {entry[0]!r} ends at {self.cur!r}")
+            # a loop of plain moves like a scan, it could stop anywhere
+            self.cur = LOST
+        self.named = self.named or named
+        self.loops.append((start, self.step))
+
+    def cell_op(self, inst, weight):
+        here = self.here(inst)
+        cells = {f: getattr(inst, f) for f in CELL_FIELDS[type(inst)]}
+        if here is None:
+            self.raw.update(self.delta + off for off in cells.values() if isinstance(off, int))
+        elif not self.delta:
+            self.use(here)
+        for name in cell_names(inst):
+            self.use(name)
+        # an offset that isn't a name is counted as the current cell
+        at = {f: here if isinstance(v, int) else v for f, v in cells.items()}
+        inner = weight * LOOP_WEIGHT
+        if isinstance(inst, ADD):
+            path = [(here, at["tmp"], weight), (at["tmp"], here, 2 * inner)]
+            back = at["tmp"]
+        elif isinstance(inst, MOV):
+            path = [(here, at["src"], weight), (at["src"], at["dest"], 2 * inner)]
+            back = at["src"]
+        else:
+            src, tmp, dest = (
+                (at["src"], at["tmp"], at["dest"])
+                if isinstance(inst, COPY)
+                else (at["n"], at["tmp1"], at["tmp2"])
+            )
+            path = [
+                (here, src, weight),
+                (src, tmp, inner),
+                (tmp, dest, inner),
+                (dest, src, inner),
+                (src, tmp, weight),
+                (tmp, src, 2 * inner),
+            ]
+            back = tmp
+            if isinstance(inst, OUT_N):
+                path += [(tmp, dest, weight), (dest, tmp, 2 * inner)]
+        for a, b, w in path + [(back, here, weight)]:
+            self.move(a, b, w)
+
+    def live(self):
+        """
+        live gives the first and last step each name is used at. A name used
+        both inside and outside a loop is live for the whole loop, since the
+        loop can come back around to it.
+        """
+        live = {name: [min(steps), max(steps)] for name, steps in self.uses.items()}
+        for start, end in sorted(self.loops, key=lambda l: l[1] - l[0]):
+            for span in live.values():
+                inside = span[0] <= end and span[1] >= start
+                if inside and (span[0] < start or span[1] > end):
+                    span[0], span[1] = min(span[0], start), max(span[1], end)
+        return live
+
+
+def layout(usage, fixed=None):
+    """
+    layout places named cells, trying to keep the pointer movement weighed by
+    Usage.moves as low as it can. It places the cells one by one, the busiest
+    first, where they cost the least, then keeps moving and swapping them as
+    long as that makes it cheaper. Cells that are never live at the same time
+    can share a place, and none go where Usage.raw says the program uses the
+    tape directly.
+
+    usage (Usage): how the cells are used
+    fixed (dict[Hashable, int]|None): cells that have to go at a given offset
+    """
+    fixed = fixed or {}
+    moves = usage.moves
+    live = usage.live()
+    names = [name for name in moves if name is not None]
+    clashes = {
+        a: {b for b in names if b != a and live[a][0] <= live[b][1] and live[b][0] <= live[a][1]}
+        for a in names
+    }
+    # fixed cells are there from before the program starts to after it ends
+    for name in fixed:
+        if name in clashes:
+            clashes[name] = set(names) - {name}
+            for other in names:
+                if other != name:
+                    clashes[other].add(name)
+
+    pos = {None: 0, **{name: off for name, off in fixed.items() if name in moves}}
+    at = {}
+    for name, off in pos.items():
+        if name is not None:
+            at.setdefault(off, set()).add(name)
+    places = range(len(names) + len(usage.raw) + max(pos.values()) + 1)
+
+    def cost(name, p):
+        return sum(w * abs(p - pos[other]) for other, w in moves[name].items() if other in pos)
+
+    def free(name, p, ignore=None):
+        if p in usage.raw:
+            return False
+        return not any(other in clashes[name] for other in at.get(p, ()) if other != ignore)
+
+    def put(name, p):
+        if name in pos:
+            at[pos[name]].discard(name)
+        pos[name] = p
+        at.setdefault(p, set()).add(name)
+
+    movable = sorted(
+        (name for name in names if name not in fixed),
+        key=lambda name: -sum(moves[name].values()),
+    )
+    for name in movable:
+        put(name, min((p for p in places if free(name, p)), key=lambda p: (cost(name, p), p)))
+
+    better = True
+    while better:
+        better = False
+        for name in movable:
+            best = min((p for p in places if free(name, p)), key=lambda p: (cost(name, p), p))
+            if cost(name, best) < cost(name, pos[name]):
+                put(name, best)
+                better = True
+        for i, a in enumerate(movable):
+            for b in movable[i + 1 :]:
+                pa, pb = pos[a], pos[b]
+                if pa == pb or not free(a, pb, b) or not free(b, pa, a):
+                    continue
+                before = cost(a, pa) + cost(b, pb)
+                put(a, pb)
+                put(b, pa)
+                if cost(a, pb) + cost(b, pa) < before:
+                    better = True
+                else:
+                    put(a, pa)
+                    put(b, pb)
+
+    del pos[None]
+    return pos
+
+
+def place(program, cells, pos):
+    """
+    place swaps the names in a program for offsets, given where each named
+    cell is and that the pointer starts at pos. It returns the instructions
+    and where the pointer ends up (None if that isn't known).
+    """
+    out = []
+    shift = 0
+
+    def flush():
+        nonlocal shift
+        if shift:
+            out.append(SHF(shift))
+        shift = 0
+
+    for inst in flatten(program):
+        if isinstance(inst, AT):
+            shift += cells[inst.name] - pos
+            pos = cells[inst.name]
+        elif isinstance(inst, SHF):
+            shift += inst.off
+            pos = None if pos is None else pos + inst.off
+        elif isinstance(inst, LOOP):
+            flush()
+            body, end = place(inst.insts, cells, pos)
+            out.append(LOOP(body))
+            if end != pos:
+                pos = None
+        else:
+            names = cell_names(inst)
+            if names:
+                inst = replace(inst, **{
+                    f: cells[getattr(inst, f)] - pos
+                    for f in CELL_FIELDS[type(inst)]
+                    if getattr(inst, f) in names
+                })
+            flush()
+            out.append(inst)
+    flush()
+    return out, pos
+
+
+def allocate(program, fixed=None):
+    """
+    allocate gives each named cell in a program (see AT, and CELL_FIELDS for
+    the instructions that take names) a place on the tape, and turns the
+    program into one that only uses offsets. Cells are placed
+    at or to the right of where the program starts, unless fixed says
+    otherwise, so that the pointer moves as little as it can, with moves
+    inside loops weighed by LOOP_WEIGHT per level. Cells that are never live
+    at the same time share a place, from the first time a name is used to
+    the last. So a named cell must be zero when it is first used and must be
+    left at zero after it is last used, like any temporary. Returns the
+    program and where each name went.
+
+    Inside named code a LOOP has to end on the cell it started on.
+
+    Cells the program uses by offset before its first AT are kept clear of
+    named cells (see Usage.raw). Once the pointer is on a named cell, where
+    the cells around it are isn't known until they are placed, so offsets
+    from there (SHF, or ints in place of names) must only reach cells that
+    no name uses, like ones given in fixed.
+
+    program (Iterable[Instruction]): the program to allocate, see flatten
+    fixed (dict[Hashable, int]|None): names that have to go at a given offset
+    from where the program starts, like cells that hold input or results
+    """
+    program = list(flatten(program))
+    cells = layout(Usage(program), fixed)
+    return place(program, cells, 0)[0], cells
@@ -1,6 +1,11 @@
-from dataclasses import dataclass, field
+import io
+import weakref
+from dataclasses import dataclass, field, FrozenInstanceError
 from abc import ABC, abstractmethod
-from bfbbfb.interpreter import Interpreter
+from functools import lru_cache
+from math import isqrt
+from bfbbfb.interpreter import Interpreter, DSLCode, NativeCode, bf_cpp, flatten
+from bfbbfb.interpreter import OP_MUL, OP_COPY, OP_IN, OP_OUT, OP_REPEAT, OP_WRITE
 
 class Instruction(ABC):
     """
@@ -8,6 +13,9 @@ class Instruction(ABC):
     multiple operations in Brainfuck. They must both be able to compile to
     brainfuck (with __str__) and must be able to execute themselves when given
     an interpreter (see: interpreter.py)
+
+    Instructions are immutable and hashable, equal when they have the same
+    structure, so their Brainfuck can be cached (see render).
     """
     
     @abstractmethod
@@ -15,6 +23,15 @@ class Instruction(ABC):
         """Converts this instruction into it's Brainfuck representation"""
         pass
 
+    def pieces(self):
+        """
+        The Brainfuck of this instruction as strings and the instructions
+        nested in it, in order, for emit to walk without building the string
+        of every nested instruction first. By default it's just __str__,
+        cached.
+        """
+        return (render(self),)
+
     @abstractmethod
     def exec(self, interp: Interpreter):
         """
@@ -24,26 +41,87 @@ class Instruction(ABC):
         """
         pass
 
+    def lower(self, code: DSLCode):
+        """
+        Adds this instruction to code, the ops DSLInterpreter runs. By
+        default it's run with exec.
+        """
+        code.exec(self)
+
+    def assemble(self, code: NativeCode):
+        """
+        Serializes this instruction onto code, to be run natively. Only the
+        instructions in this module can be.
+        """
+        raise TypeError(f"{type(self).__name__} can't be run natively")
+
+
+def factor(n):
+    """
+    factor finds the shortest way to add n (n >= 0) with a multiply loop, as
+    the a, b and c for which a * b + c == n with a + |b| + |c| as small as
+    it can be: a is counted down in a scratch cell, b is added every time
+    around and c is added after. Fewer times around wins a tie. Returns None
+    if there is no such loop.
 
-@dataclass
+    n (int): the value to add
+    """
+    best = None
+    for a in range(2, 2 * isqrt(n) + 2):
+        for b in (n // a, n // a + 1):
+            c = n - a * b
+            key = (a + b + abs(c), a)
+            if best is None or key < best[0]:
+                best = key, (a, b, c)
+    return best and best[1]
+
+
+# the shortest multiply loop for every byte
+FACTORS = [factor(n) for n in range(256)]
+
+
+@dataclass(frozen=True)
 class ADD(Instruction):
     """
-    ADD adds some positive or negative value to the currently selected cell
+    ADD adds some positive or negative value to the currently selected cell.
+    Given a scratch cell it uses a multiply loop (see factor) instead if that
+    is shorter, which it is for anything much over 20. The scratch cell has
+    to be zero and is left at zero. It never relies on cells wrapping around,
+    so it works for any cell size.
 
     val (int): value to add by
+    tmp (int|None): offset for a scratch cell, must be zero (default: None)
     """
     
     val: int
+    tmp: int = field(default=None)
 
     def __str__(self):
-        return "+" * self.val if self.val > 0 else "-" * -self.val
+        plain = "+" * self.val if self.val > 0 else "-" * -self.val
+        if self.tmp is None:
+            return plain
+        n = abs(self.val)
+        abc = FACTORS[n] if n < len(FACTORS) else factor(n)
+        if abc is None:
+            return plain
+        sign = 1 if self.val > 0 else -1
+        a, b, c = abc
+        there, back = SHF(self.tmp), SHF(-self.tmp)
+        loop = f"{there}{ADD(a)}[-{back}{ADD(sign * b)}{there}]{back}{ADD(sign * c)}"
+        return min(plain, loop, key=len)
 
     def exec(self, interp: Interpreter):
-        interp.tape[interp.dp] += self.val
-        interp.tape[interp.dp] %= 2 ** (interp.cell_size * 8)
+        tape = interp.tape.cells
+        tape[interp.dp] = (tape[interp.dp] + self.val) & interp.mask
+
+    def lower(self, code: DSLCode):
+        code.add(self.val)
 
+    def assemble(self, code: NativeCode):
+        code.emit(bf_cpp.OP_ADD, self.val)
 
-@dataclass
+
+@dataclass(frozen=True)
 class SHF(Instruction):
     """
     SHF shifts the cursor by some positive or negative value
@@ -61,8 +139,14 @@ class SHF(Instruction):
         if interp.dp > len(interp.tape) or interp.dp < 0:
             raise IndexError(f"{interp.dp} is not in (0, {len(interp.tape)})")
 
+    def lower(self, code: DSLCode):
+        code.shf(self.off)
+
+    def assemble(self, code: NativeCode):
+        code.emit(bf_cpp.OP_MOVE, self.off)
+
 
-@dataclass
+@dataclass(frozen=True)
 class MOV(Instruction):
     """
     MOV moves the contents of the source cell into the destination cell. It
@@ -85,14 +169,22 @@ class MOV(Instruction):
         return f"{to_src}[-{to_dest}{'-' if self.sub else '+'}{from_dest}]{from_src}"
 
     def exec(self, interp: Interpreter):
+        tape = interp.tape.cells
+        src, dest = interp.dp + self.src, interp.dp + self.dest
         if self.sub:
-            interp.tape[interp.dp + self.dest] -= interp.tape[interp.dp + self.src]
+            tape[dest] = (tape[dest] - tape[src]) & interp.mask
         else:
-            interp.tape[interp.dp + self.dest] += interp.tape[interp.dp + self.src]
-        interp.tape[interp.dp + self.src] = 0
+            tape[dest] = (tape[dest] + tape[src]) & interp.mask
+        tape[src] = 0
+
+    def lower(self, code: DSLCode):
+        code.emit(OP_MUL, ((self.dest - self.src, -1 if self.sub else 1),), self.src)
+
+    def assemble(self, code: NativeCode):
+        code.emit(bf_cpp.OP_MOV_SUB if self.sub else bf_cpp.OP_MOV, self.src, self.dest)
 
 
-@dataclass
+@dataclass(frozen=True)
 class ZERO(Instruction):
     """
     ZERO wipes the contents of the currently selected cell. It does so by
@@ -103,10 +195,16 @@ class ZERO(Instruction):
         return "[-]"
 
     def exec(self, interp: Interpreter):
-        interp.tape[interp.dp] = 0
+        interp.tape.cells[interp.dp] = 0
 
+    def lower(self, code: DSLCode):
+        code.emit(OP_MUL, ())
 
-@dataclass
+    def assemble(self, code: NativeCode):
+        code.emit(bf_cpp.OP_ZERO)
+
+
+@dataclass(frozen=True)
 class COPY(Instruction):
     """
     COPY copies a value from a source cell to a destination cell, preserving the
@@ -133,7 +231,14 @@ class COPY(Instruction):
         return f"{to_src}[-{to_tmp}+{to_dest}+{go_back}]{to_tmp}{writeback}{from_tmp}"
 
     def exec(self, interp: Interpreter):
-        interp.tape[interp.dp + self.dest] = interp.tape[interp.dp + self.src]
+        tape = interp.tape.cells
+        tape[interp.dp + self.dest] = tape[interp.dp + self.src]
+
+    def lower(self, code: DSLCode):
+        code.emit(OP_COPY, self.src - self.dest, self.dest)
+
+    def assemble(self, code: NativeCode):
+        code.emit(bf_cpp.OP_COPY, self.src, self.dest)
 
 
 class LOOP(Instruction):
@@ -141,22 +246,63 @@ class LOOP(Instruction):
     LOOP simply executes a set of instructions until it ends the loop with the
     value at the current pointer being equal to zero.
 
-    *insts ([Instruction]): list of instructions to execute in the loop body
+    LOOPs are interned: making a LOOP with the same body as one that is still
+    around gives back that one, so repeated subtrees are shared objects. Each
+    keeps its Brainfuck once it has been asked for it.
+
+    *insts (*Instruction|Iterable[Instruction]): instructions to execute in
+    the loop body, lists and generators of them are flattened (see flatten)
     """
-    
-    def __init__(self, *insts):
-        self.insts = insts
+
+    _interned = weakref.WeakValueDictionary()
+
+    def __new__(cls, *insts):
+        insts = tuple(flatten(insts))
+        loop = cls._interned.get(insts)
+        if loop is None:
+            loop = super().__new__(cls)
+            object.__setattr__(loop, "insts", insts)
+            object.__setattr__(loop, "_hash", hash(insts))
+            object.__setattr__(loop, "_bf", None)
+            cls._interned[insts] = loop
+        return loop
+
+    def __setattr__(self, name, value):
+        raise FrozenInstanceError(f"cannot assign to field {name!r}")
+
+    def __eq__(self, other):
+        return self is other or (type(other) is LOOP and self.insts == other.insts)
+
+    def __hash__(self):
+        return self._hash
+
+    def __repr__(self):
+        return f"LOOP({', '.join(map(repr, self.insts))})"
 
     def __str__(self):
-        return "[" + "".join(map(str, self.insts)) + "]"
+        if self._bf is None:
+            object.__setattr__(self, "_bf", emit([self]))
+        return self._bf
+
+    def pieces(self):
+        if self._bf is not None:
+            return (self._bf,)
+        return ("[", *self.insts, "]")
 
     def exec(self, interp: Interpreter):
-        while interp.tape[interp.dp]:
+        tape = interp.tape.cells
+        while tape[interp.dp]:
             for i in self.insts:
                 interp.exec(i)
 
+    def lower(self, code: DSLCode):
+        code.loop(self.insts)
+
+    def assemble(self, code: NativeCode):
+        code.loop(self.insts)
 
-@dataclass
+
+@dataclass(frozen=True)
 class IN(Instruction):
     """
     IN reads in a single character as it's ascii code. When emulating the DSL,
@@ -169,12 +315,18 @@ class IN(Instruction):
 
     def exec(self, interp: Interpreter):
         if interp.itp < len(interp.input):
-            interp.tape[interp.dp] = ord(interp.input[interp.itp])
+            interp.tape.cells[interp.dp] = interp.input[interp.itp]
             interp.itp += 1
         else:
-            interp.tape[interp.dp] = 0
+            interp.tape.cells[interp.dp] = 0
+
+    def lower(self, code: DSLCode):
+        code.emit(OP_IN, 0)
+
+    def assemble(self, code: NativeCode):
+        code.emit(bf_cpp.OP_IN)
 
-@dataclass
+@dataclass(frozen=True)
 class OUT(Instruction):
     """
     OUT prints out the value of the cell at the current position by converting
@@ -186,9 +338,15 @@ class OUT(Instruction):
         return "."
 
     def exec(self, interp: Interpreter):
-        print(chr(interp.tape[interp.dp]), end="")
+        interp.write(bytes((interp.tape.cells[interp.dp] & 255,)))
 
-@dataclass
+    def lower(self, code: DSLCode):
+        code.emit(OP_OUT, 0)
+
+    def assemble(self, code: NativeCode):
+        code.emit(bf_cpp.OP_OUT)
+
+@dataclass(frozen=True)
 class OUT_N(Instruction):
     """
     OUT_N outputs a character a given number of times. It does so by first
@@ -226,35 +384,116 @@ class OUT_N(Instruction):
         )))
 
     def exec(self, interp: Interpreter):
-        print(self.src*interp.tape[interp.dp+self.n], end="")
+        interp.write(bytes((ord(self.src) & 255,)) * interp.tape.cells[interp.dp + self.n])
+
+    def lower(self, code: DSLCode):
+        code.emit(OP_REPEAT, bytes((ord(self.src) & 255,)), self.n)
 
+    def assemble(self, code: NativeCode):
+        code.repeat(ord(self.src) & 255, self.n)
 
-@dataclass
+
+@dataclass(frozen=True)
 class OUT_S(Instruction):
     """
     OUT_S will output an entire string. It does so by offsetting the current
     value of the cell by the difference between the last character's ascii code
     and the next character's.
+
+    Given more cells to work with it tries a few ways of spreading the string
+    over them and keeps the shortest (see spread): a scratch cell lets it
+    fill them all at once with a multiply loop, and each character comes out
+    of whichever cell is closest to it. They all have to be zero and are left
+    at zero.
+
+    s (str): the string to output
+    tmp (int|None): offset for a scratch cell, must be zero (default: None)
+    cells (tuple[int]): offsets for more cells to output from, must be zero
     """
     
     s: str
+    tmp: int = field(default=None)
+    cells: tuple = field(default=())
 
     def __str__(self):
-        res = ""
+        if self.tmp is not None or self.cells:
+            return min(
+                (spread(self.s, self.tmp, (0, *self.cells[:k])) for k in range(len(self.cells) + 1)),
+                key=len,
+            )
+        res = []
         cur = 0
         for chr in self.s:
             diff = ord(chr) - cur
-            res += str(ADD(diff)) + "."
+            res.append(str(ADD(diff)) + ".")
             cur = ord(chr)
 
-        res += str(ADD(-cur))
-        return res
+        res.append(str(ADD(-cur)))
+        return "".join(res)
 
     def exec(self, interp: Interpreter):
-        print(self.s, end="")
+        interp.write(bytes(ord(c) & 255 for c in self.s))
+
+    def lower(self, code: DSLCode):
+        code.emit(OP_WRITE, bytes(ord(c) & 255 for c in self.s))
+
+    def assemble(self, code: NativeCode):
+        code.write(bytes(ord(c) & 255 for c in self.s))
 
 
-@dataclass
+def spread(s, tmp, cells):
+    """
+    spread gives the Brainfuck for outputting s from a few cells, starting
+    and ending on the first and leaving them all at zero. The characters are
+    split into as many groups as there are cells, and if there's a scratch
+    cell, each cell is filled close to the middle of its group with a single
+    multiply loop, trying every count up to 16 for it. Every character is
+    then made in whichever cell costs the least moves and adds to get to.
+
+    s (str): the string to output
+    tmp (int|None): offset for a scratch cell, must be zero
+    cells (tuple[int]): offsets for the cells, the first is the current one
+    """
+    codes = sorted(map(ord, s))
+    k = len(cells)
+    # the middle character of each group, so the cells line up with them
+    mids = [codes[(2 * i + 1) * len(codes) // (2 * k)] for i in range(k)] if codes else []
+    order = sorted(cells)
+    starts = [None] if tmp is None else [None, *range(2, 17)]
+    best = None
+    for a in starts:
+        res = []
+        vals = dict.fromkeys(cells, 0)
+        pos = 0
+        if a is not None:
+            res += [SHF(tmp), ADD(a), "[-"]
+            pos = tmp
+            for cell, mid in zip(order, mids):
+                vals[cell] = a * round(mid / a)
+                if vals[cell]:
+                    res += [SHF(cell - pos), ADD(vals[cell] // a)]
+                    pos = cell
+            res += [SHF(tmp - pos), "]"]
+            pos = tmp
+        for c in map(ord, s):
+            cell = min(cells, key=lambda x: abs(x - pos) + abs(c - vals[x]))
+            step = ADD(c - vals[cell], None if tmp is None else tmp - cell)
+            res += [SHF(cell - pos), step, "."]
+            vals[cell], pos = c, cell
+        left = [cell for cell in order if vals[cell]]
+        if left and abs(left[-1] - pos) < abs(left[0] - pos):
+            left.reverse()
+        for cell in left:
+            res += [SHF(cell - pos), min(str(ADD(-vals[cell])), str(ZERO()), key=len)]
+            pos = cell
+        res.append(SHF(-pos))
+        out = "".join(map(str, res))
+        if best is None or len(out) < len(best):
+            best = out
+    return best
+
+
+@dataclass(frozen=True)
 class DEBUG(Instruction):
     """
     DEBUG just prints out a little string in the debug statements. NOOP with a name.
@@ -265,3 +504,329 @@ class DEBUG(Instruction):
         return ""
     def exec(self, interp: Interpreter):
         return
+    def lower(self, code: DSLCode):
+        return
+    def assemble(self, code: NativeCode):
+        return
+
+
+def optimize(program):
+    """
+    optimize is a peephole pass over a program, yielding instructions that
+    do the same thing with less Brainfuck. SHFs are held back for as long
+    as possible so that runs of them merge or cancel out. MOVs,
+    COPYs and OUT_Ns are rebased onto the first cell they work on, since
+    that is where they move to first and where they come back from, so the
+    moves on either side of them merge with the ones they make. Adjacent
+    ADDs merge the same way, DEBUGs are dropped and LOOP bodies are
+    optimized on their own. Anything it doesn't know about is left where it
+    is. Only the ADDs and SHFs since the last other instruction are held
+    back, so it streams.
+
+    program (Iterable[Instruction]): the instructions to optimize, see flatten
+    """
+    out = []
+    shift = 0
+
+    def flush():
+        nonlocal shift
+        if shift:
+            out.append(SHF(shift))
+        shift = 0
+
+    for inst in flatten(program):
+        if isinstance(inst, DEBUG):
+            continue
+        if isinstance(inst, SHF):
+            shift += inst.off
+        elif isinstance(inst, ADD):
+            flush()
+            val, tmp = inst.val, inst.tmp
+            if out and isinstance(out[-1], ADD):
+                prev = out.pop()
+                val += prev.val
+                tmp = prev.tmp if tmp is None else tmp
+            if val:
+                out.append(ADD(val, tmp))
+            elif out and isinstance(out[-1], SHF):
+                # the ADDs cancelled out, so the moves around them can too
+                shift = out.pop().off
+        else:
+            if isinstance(inst, MOV):
+                # these all go to their first cell and back, so go there
+                # directly and only come back when something else needs to
+                shift, back = shift + inst.src, -inst.src
+                inst = MOV(0, inst.dest - inst.src, inst.sub)
+            elif isinstance(inst, COPY):
+                shift, back = shift + inst.src, -inst.src
+                inst = COPY(0, inst.tmp - inst.src, inst.dest - inst.src)
+            elif isinstance(inst, OUT_N):
+                shift, back = shift + inst.n, -inst.n
+                inst = OUT_N(inst.src, 0, inst.tmp1 - inst.n, inst.tmp2 - inst.n)
+            else:
+                back = 0
+                if isinstance(inst, LOOP):
+                    inst = LOOP(optimize(inst.insts))
+            flush()
+            # nothing merges past this instruction, so everything up to it
+            # can go
+            yield from out
+            yield inst
+            out.clear()
+            shift = back
+    flush()
+    yield from out
+
+
+class Known:
+    """
+    Known is what fold knows about the cells around the pointer: the value of
+    some of them, and whether all the others are zero. Cells are kept by
+    their offset from where the pointer was when this started, which is why
+    pos is kept.
+
+    Values are kept as plain ints, not wrapped, so that they mean the same
+    whatever the cell size. One that gets as far from zero as a byte cell
+    wraps could be zero or not depending on it, so it is forgotten.
+
+    Properties:
+    pos (int): where the pointer is
+    vals (dict[int, int|None]): cells with a known value, or None for unknown
+    rest (int|None): the value of every other cell, 0 or None for unknown
+    """
+
+    def __init__(self, rest=None):
+        self.pos = 0
+        self.vals = {}
+        self.rest = rest
+
+    def forget(self):
+        """forget forgets everything, cells are counted from here again"""
+        self.pos, self.vals, self.rest = 0, {}, None
+
+    def copy(self):
+        known = Known(self.rest)
+        known.pos, known.vals = self.pos, dict(self.vals)
+        return known
+
+    def get(self, off):
+        """get gives the value of the cell off away from the pointer, if known"""
+        return self.vals.get(self.pos + off, self.rest)
+
+    def set(self, off, val):
+        """set sets the value of the cell off away from the pointer, None to forget it"""
+        if val is not None and not -256 < val < 256:
+            val = None
+        self.vals[self.pos + off] = val
+
+
+def writes(insts):
+    """
+    writes gives the offsets that insts may change, from where they start,
+    and where they end. It gives None if that can't be told, because of a
+    loop that moves the pointer by some unknown amount or an instruction it
+    doesn't know about. Temporaries are left at zero, so they aren't counted.
+    """
+    pos, out = 0, set()
+    for inst in flatten(insts):
+        if isinstance(inst, SHF):
+            pos += inst.off
+        elif isinstance(inst, (ADD, ZERO, IN)):
+            out.add(pos)
+        elif isinstance(inst, MOV):
+            out |= {pos + inst.src, pos + inst.dest}
+        elif isinstance(inst, COPY):
+            out.add(pos + inst.dest)
+        elif isinstance(inst, LOOP):
+            inner = writes(inst.insts)
+            if inner is None or inner[1]:
+                return None
+            out |= {pos + off for off in inner[0]}
+        elif not isinstance(inst, (OUT, OUT_N, OUT_S, DEBUG)):
+            return None
+    return out, pos
+
+
+def fold(program, zeroed=False):
+    """
+    fold goes through a program keeping track of the cells whose values it
+    knows (see Known), and uses them to drop what doesn't do anything: LOOPs
+    on a cell that is zero, ZEROs of a cell that is zero and MOVs, COPYs and
+    OUT_Ns of zero. A ZERO of a cell holding a known value becomes the ADD
+    that gets it where it's going instead, when that is shorter. Inside a
+    LOOP only the cells it never changes stay known.
+
+    It also checks the cells that have to be zero: the destinations of MOV
+    and COPY, the temporaries of COPY, OUT_N and ADD and the cells OUT_S
+    works in. Those are known to be zero after, too. Returns the new program
+    and the problems it found, as messages.
+
+    program (Iterable[Instruction]): the program to fold, see flatten
+    zeroed (bool): whether the tape is all zeros when the program starts
+    """
+    problems = []
+
+    def must_be_zero(known, inst, *offs):
+        for off in offs:
+            val = known.get(off)
+            if val is not None and val != 0:
+                problems.append(f"{inst!r}: cell {off:+} has to be zero but is {val}")
+
+    def go(insts, known):
+        out = []
+        insts = list(flatten(insts))
+        i = 0
+        while i < len(insts):
+            inst = insts[i]
+            i += 1
+            if isinstance(inst, SHF):
+                known.pos += inst.off
+            elif isinstance(inst, ADD):
+                if inst.tmp is not None:
+                    must_be_zero(known, inst, inst.tmp)
+                    known.set(inst.tmp, 0)
+                val = known.get(0)
+                known.set(0, None if val is None else val + inst.val)
+            elif isinstance(inst, ZERO):
+                val = known.get(0)
+                if val == 0:
+                    continue
+                known.set(0, 0)
+                if val is not None:
+                    # setting a cell to something when we know what's in it
+                    # is just adding the difference
+                    then = insts[i] if i < len(insts) and isinstance(insts[i], ADD) else None
+                    to = then.val if then else 0
+                    direct = ADD(to - val, then and then.tmp)
+                    if len(str(direct)) < len(str(inst)) + len(str(then or "")):
+                        if then:
+                            i += 1
+                            if then.tmp is not None:
+                                must_be_zero(known, then, then.tmp)
+                                known.set(then.tmp, 0)
+                            known.set(0, to)
+                        if not direct.val:
+                            continue
+                        inst = direct
+            elif isinstance(inst, IN):
+                known.set(0, None)
+            elif isinstance(inst, MOV):
+                must_be_zero(known, inst, inst.dest)
+                src, dest = known.get(inst.src), known.get(inst.dest)
+                if src == 0:
+                    continue
+                if src is not None and dest is not None:
+                    dest = dest - src if inst.sub else dest + src
+                else:
+                    dest = None
+                known.set(inst.dest, dest)
+                known.set(inst.src, 0)
+            elif isinstance(inst, COPY):
+                must_be_zero(known, inst, inst.tmp, inst.dest)
+                src, dest = known.get(inst.src), known.get(inst.dest)
+                known.set(inst.tmp, 0)
+                if src == 0 and dest == 0:
+                    continue
+                known.set(inst.dest, src if dest == 0 else None)
+            elif isinstance(inst, OUT_N):
+                must_be_zero(known, inst, inst.tmp1, inst.tmp2)
+                known.set(inst.tmp1, 0)
+                known.set(inst.tmp2, 0)
+                if known.get(inst.n) == 0:
+                    continue
+            elif isinstance(inst, OUT_S):
+                temps = [0, *([] if inst.tmp is None else [inst.tmp]), *inst.cells]
+                must_be_zero(known, inst, *temps)
+                for off in temps:
+                    known.set(off, 0)
+            elif isinstance(inst, LOOP):
+                if known.get(0) == 0:
+                    continue
+                changed = writes(inst.insts)
+                if changed is None or changed[1]:
+                    # it could stop anywhere, so nothing is known after it
+                    # but that it stopped on a zero
+                    inst = LOOP(go(inst.insts, Known()))
+                    known.forget()
+                    known.set(0, 0)
+                else:
+                    for off in changed[0]:
+                        known.set(off, None)
+                    inst = LOOP(go(inst.insts, known.copy()))
+                    known.set(0, 0)
+            elif not isinstance(inst, (OUT, DEBUG)):
+                known.forget()
+            out.append(inst)
+        return out
+
+    return go(program, Known(0 if zeroed else None)), problems
+
+
+@lru_cache(maxsize=1 << 12)
+def render(inst):
+    """
+    render is str(inst), cached by the instruction's structure so that equal
+    instructions are only rendered once.
+
+    inst (Instruction): the instruction to render
+    """
+    return str(inst)
+
+
+def walk(program):
+    """
+    walk yields the Brainfuck of a program piece by piece, going through the
+    instruction tree once (see Instruction.pieces). Strings in the program
+    are taken to be Brainfuck already, and lists and generators nested in it
+    are gone into like in flatten.
+
+    program (Iterable[Instruction|str|Iterable]): the program to walk
+    """
+    stack = [iter(program)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, str):
+                yield item
+            else:
+                stack.append(iter(item.pieces() if isinstance(item, Instruction) else item))
+                break
+        else:
+            stack.pop()
+
+
+def emit(program, out=None):
+    """
+    emit writes the Brainfuck of a program to out, which can be a file, an
+    io.StringIO or anything else with a write method. If out is None it's
+    returned as a string instead.
+
+    program (Iterable[Instruction|str|Iterable]): the program to emit
+    out (TextIO|None): where to write it
+    """
+    if out is None:
+        out = io.StringIO()
+        emit(program, out)
+        return out.getvalue()
+    for piece in walk(program):
+        out.write(piece)
+
+
+def emit_chunks(program, size=1 << 16):
+    """
+    emit_chunks yields the Brainfuck of a program in strings of about size
+    characters, as it walks it.
+
+    program (Iterable[Instruction|str|Iterable]): the program to emit
+    size (int): how much to yield at once
+    """
+    chunk = []
+    n = 0
+    for piece in walk(program):
+        chunk.append(piece)
+        n += len(piece)
+        if n >= size:
+            yield "".join(chunk)
+            chunk = []
+            n = 0
+    if chunk:
+        yield "".join(chunk)
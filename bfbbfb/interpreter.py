@@ -1,5 +1,552 @@
 import sys
-from bfbbfb import bf_cpp
+import time
+from array import array
+from collections.abc import Iterable
+from functools import lru_cache
+
+try:
+    from bfbbfb import bf_cpp
+except ImportError:  # the extension wasn't built, only the python engine works
+    bf_cpp = None
+
+
+def cell_typecode(cell_size):
+    """
+    cell_typecode gives the array typecode of the unsigned integer type that is
+    cell_size bytes wide, which is what the c++ engines expect a tape to be.
+
+    cell_size (int): number of bytes per cell
+    """
+    for typecode in "BHILQ":
+        if array(typecode).itemsize == cell_size:
+            return typecode
+    raise ValueError(f"no {cell_size} byte cell type")
+
+
+@lru_cache(maxsize=64)
+def compile_c(program):
+    """
+    compile_c lowers a Brainfuck string into a bf_cpp.Program, caching the
+    result so running the same program again skips parsing entirely.
+
+    program (str): Brainfuck source to compile
+    """
+    return bf_cpp.compile(program)
+
+
+# BFInterpreter engine names for each bf_cpp engine
+C_ENGINES = {"c": "switch", "threaded": "threaded", "jit": "jit"}
+
+# LimitExceeded is raised by every engine when a run is stopped by killtime,
+# timeout or cancellation. It carries reason, ip, dp and steps attributes.
+if bf_cpp:
+    LimitExceeded = bf_cpp.LimitExceeded
+else:
+
+    class LimitExceeded(Exception):
+        pass
+
+
+# how many bytes of output are buffered before they're written out, and how
+# much of real stdin is read at once
+BUFFER_SIZE = 1 << 16
+
+
+# ops of the lowered form the python engine runs, named like bf_cpp's OP_*
+# so they don't clash with the DSL instructions
+OP_ADD, OP_MOVE, OP_ZERO, OP_MUL, OP_SCAN, OP_OUT, OP_IN, OP_JZ, OP_JNZ = range(9)
+# ops only DSL programs lower to, see DSLCode
+OP_COPY, OP_WRITE, OP_REPEAT, OP_EXEC = range(9, 13)
+
+
+def lower_simple_loop(src, i):
+    """
+    lower_simple_loop tries to lower the loop starting at src[i] into a single
+    op. Clear and transfer loops (a body made only of +-<> that ends where it
+    started and changes the loop cell by exactly one per iteration) become an
+    OP_MUL, and scan loops (only < or >) become an OP_SCAN. Returns the index
+    of the matching ] and the op, or None if it has to be run as a loop.
+
+    src (str): Brainfuck with the comments taken out
+    i (int): index of the [
+    """
+    deltas = {}
+    pos = 0
+    for j in range(i + 1, len(src)):
+        c = src[j]
+        if c == "]":
+            break
+        if c == "+":
+            deltas[pos] = deltas.get(pos, 0) + 1
+        elif c == "-":
+            deltas[pos] = deltas.get(pos, 0) - 1
+        elif c == ">":
+            pos += 1
+        elif c == "<":
+            pos -= 1
+        else:
+            return None
+    else:
+        return None
+
+    if not deltas and pos:
+        return j, (OP_SCAN, pos, 0)
+
+    step = deltas.pop(0, 0)
+    if pos != 0 or step not in (1, -1):
+        return None
+
+    # the loop runs tape[dp] times when it counts down and -tape[dp] times
+    # when it counts up, so fold the direction into the factors
+    factors = tuple((off, -step * delta) for off, delta in deltas.items() if delta)
+    return j, (OP_MUL, factors, 0)
+
+
+@lru_cache(maxsize=64)
+def lower_py(code):
+    """
+    lower_py lowers Brainfuck into the list of (op, arg, off) tuples the
+    python engine runs, caching the result. Within a stretch of code without
+    loops, < and > only change the offset the following ops work at, and dp
+    is moved once at the end of it. Runs of + and - become a single OP_ADD,
+    clear and transfer loops a single OP_MUL (whose arg is the (offset,
+    factor) of each cell it adds to), scan loops an OP_SCAN, and brackets
+    OP_JZ/OP_JNZ with the index of the matching one as arg. For OP_JZ and
+    OP_JNZ, off is how many ops ran since the previous jump (including the
+    jump), so steps can be counted a block at a time.
+
+    Returns the ops, the source offset of each op and the number of ops after
+    the last jump.
+
+    code (str): Brainfuck source to lower
+    """
+    src_pos = [i for i, c in enumerate(code) if c in "+-<>.,[]"]
+    src = "".join(code[i] for i in src_pos)
+
+    ops = []
+    pos = []
+    stack = []
+    shift = 0
+
+    def emit(op, arg, off, i):
+        ops.append((op, arg, off))
+        pos.append(src_pos[i])
+
+    def move(i):
+        nonlocal shift
+        if shift:
+            emit(OP_MOVE, shift, 0, i)
+        shift = 0
+
+    i = 0
+    while i < len(src):
+        c = src[i]
+        if c in "+-":
+            n = 0
+            start = i
+            while i + 1 < len(src) and src[i + 1] in "+-":
+                n += 1 if src[i] == "+" else -1
+                i += 1
+            n += 1 if src[i] == "+" else -1
+            if n:
+                emit(OP_ADD, n, shift, start)
+        elif c == ">":
+            shift += 1
+        elif c == "<":
+            shift -= 1
+        elif c == ".":
+            emit(OP_OUT, 0, shift, i)
+        elif c == ",":
+            emit(OP_IN, 0, shift, i)
+        elif c == "[":
+            simple = lower_simple_loop(src, i)
+            if simple and simple[1][0] == OP_MUL:
+                end, (op, arg, _) = simple
+                emit(op, arg, shift, i)
+                i = end
+            elif simple:
+                move(i)
+                end, (op, arg, _) = simple
+                emit(op, arg, 0, i)
+                i = end
+            else:
+                move(i)
+                stack.append(len(ops))
+                emit(OP_JZ, 0, 0, i)
+        else:
+            if not stack:
+                raise ValueError("unmatched ']' in brainfuck program")
+            move(i)
+            j = stack.pop()
+            ops[j] = (OP_JZ, len(ops), 0)
+            emit(OP_JNZ, j, 0, i)
+        i += 1
+    move(len(src) - 1)
+
+    if stack:
+        raise ValueError("unmatched '[' in brainfuck program")
+
+    last = -1
+    for ip, (op, arg, _) in enumerate(ops):
+        if op in (OP_JZ, OP_JNZ):
+            ops[ip] = (op, arg, ip - last)
+            last = ip
+    return ops, pos, len(ops) - 1 - last
+
+
+# how deeply loops nest inside one transpiled function, python refuses to
+# compile more than 20 nested blocks
+MAX_LOOP_DEPTH = 15
+
+TRANSPILED_ARGS = "tape, dp, steps, mask, out, flush, read, check, limited"
+
+
+@lru_cache(maxsize=64)
+def transpile(code):
+    """
+    transpile translates Brainfuck into python source and compiles it,
+    caching the result by program. Each loop becomes a while loop, and within
+    the code between loops cells are updated at offsets from dp, which is
+    moved once at the end (see lower_py). Loops nested too deeply for python
+    are split out into functions of their own.
+
+    Returns the compiled function and its source. The function is called as
+    fn(tape, dp, steps, mask, out, flush, read, check, limited) and returns
+    the new dp and steps. Output bytes are appended to the out bytearray and
+    flush() is called once it holds BUFFER_SIZE of them, read() returns the
+    next input cell and check(dp, steps, pos) is called as loops jump back if
+    limited is set.
+
+    code (str): Brainfuck source to transpile
+    """
+    ops, pos, tail = lower_py(code)
+    funcs = []
+
+    def cell(off):
+        if off > 0:
+            return f"tape[dp + {off}]"
+        if off < 0:
+            return f"tape[dp - {-off}]"
+        return "tape[dp]"
+
+    def function(start, end, tail=0):
+        name = f"bf_{len(funcs)}"
+        lines = [f"def {name}({TRANSPILED_ARGS}):"]
+        funcs.append(lines)
+        block(start, end, 1, lines)
+        if tail:
+            lines.append(f"    steps += {tail}")
+        lines.append("    return dp, steps")
+        return name
+
+    def block(start, end, depth, lines):
+        pad = "    " * depth
+        ip = start
+        while ip < end:
+            op, arg, off = ops[ip]
+            if op == OP_ADD:
+                lines.append(f"{pad}{cell(off)} = ({cell(off)} + {arg}) & mask")
+            elif op == OP_MOVE:
+                lines.append(f"{pad}dp += {arg}")
+            elif op == OP_MUL:
+                if arg:
+                    lines.append(f"{pad}v = {cell(off)}")
+                    lines.append(f"{pad}if v:")
+                    for o, factor in arg:
+                        target = cell(off + o)
+                        lines.append(f"{pad}    {target} = ({target} + v * {factor}) & mask")
+                    lines.append(f"{pad}    {cell(off)} = 0")
+                else:
+                    lines.append(f"{pad}{cell(off)} = 0")
+            elif op == OP_SCAN:
+                lines.append(f"{pad}while tape[dp]:")
+                lines.append(f"{pad}    dp += {arg}")
+            elif op == OP_OUT:
+                lines.append(f"{pad}out.append({cell(off)} & 255)")
+                lines.append(f"{pad}if len(out) >= {BUFFER_SIZE}:")
+                lines.append(f"{pad}    flush()")
+            elif op == OP_IN:
+                lines.append(f"{pad}{cell(off)} = read()")
+            elif op == OP_JZ:
+                close = arg
+                lines.append(f"{pad}steps += {off}")
+                lines.append(f"{pad}while tape[dp]:")
+                if depth >= MAX_LOOP_DEPTH:
+                    name = function(ip + 1, close)
+                    lines.append(f"{pad}    dp, steps = {name}({TRANSPILED_ARGS})")
+                else:
+                    block(ip + 1, close, depth + 1, lines)
+                lines.append(f"{pad}    steps += {ops[close][2]}")
+                lines.append(f"{pad}    if limited and tape[dp]:")
+                lines.append(f"{pad}        check(dp, steps, {pos[close]})")
+                ip = close
+            ip += 1
+
+    function(0, len(ops), tail)
+    source = "\n\n".join("\n".join(lines) for lines in funcs) + "\n"
+    namespace = {}
+    exec(compile(source, f"<brainfuck {hash(code):x}>", "exec"), namespace)
+    return namespace["bf_0"], source
+
+
+class DSLCode:
+    """
+    DSLCode lowers DSL programs into the ops the python engine runs (see
+    lower_py), so that DSLInterpreter doesn't have to go through the exec of
+    every instruction. Instructions add themselves to it with their lower
+    method. SHFs only change the offset the following ops work at, ADDs to
+    the same cell merge, MOV and ZERO become OP_MULs, and LOOPs become jumps.
+    Instructions that can't be lowered are run with their exec. For OP_JZ and
+    OP_JNZ, off is how many instructions ran since the previous jump, so steps
+    still count DSL instructions.
+
+    Properties:
+    ops (list[tuple]): the (op, arg, off) ops lowered so far
+    pos (list[int]): the index of the top level instruction each op came from
+    index (int): the index of the top level instruction being lowered
+    """
+
+    def __init__(self):
+        self.ops = []
+        self.pos = []
+        self.index = 0
+        self.shift = 0
+        self.count = 0
+
+    def lower(self, inst):
+        """
+        lower adds an instruction to the code.
+
+        inst (Instruction): the instruction to lower
+        """
+        self.count += 1
+        inst.lower(self)
+
+    def emit(self, op, arg, off=0):
+        """
+        emit adds an op working at offset off from the current cell.
+
+        op (int): one of the ops above
+        arg (Any): the op's argument
+        off (int): offset from the current cell
+        """
+        self.ops.append((op, arg, self.shift + off))
+        self.pos.append(self.index)
+
+    def move(self):
+        """
+        move moves dp by the shift it has built up, ahead of a jump.
+        """
+        if self.shift:
+            self.ops.append((OP_MOVE, self.shift, 0))
+            self.pos.append(self.index)
+        self.shift = 0
+
+    def shf(self, off):
+        """shf moves the current cell by off"""
+        self.shift += off
+
+    def add(self, val):
+        """add adds val to the current cell, merging with an ADD right before"""
+        if self.ops and self.ops[-1][0] == OP_ADD and self.ops[-1][2] == self.shift:
+            val += self.ops.pop()[1]
+            self.pos.pop()
+        if val:
+            self.emit(OP_ADD, val)
+
+    def exec(self, inst):
+        """exec runs an instruction with its exec method"""
+        self.move()
+        self.emit(OP_EXEC, inst)
+
+    def loop(self, insts):
+        """loop lowers insts into a loop on the current cell"""
+        self.move()
+        start = len(self.ops)
+        self.ops.append((OP_JZ, 0, 0))
+        self.pos.append(self.index)
+        count, self.count = self.count, 0
+        for inst in insts:
+            self.lower(inst)
+        self.move()
+        self.ops[start] = (OP_JZ, len(self.ops), count)
+        self.ops.append((OP_JNZ, start, self.count))
+        self.pos.append(self.index)
+        self.count = 0
+
+    def finish(self):
+        """
+        finish returns the ops, the instruction each op came from and the
+        number of instructions after the last jump, like lower_py.
+        """
+        self.move()
+        return self.ops, self.pos, self.count
+
+
+def flatten(program):
+    """
+    flatten yields the instructions of a program in order, going into any
+    lists, tuples or generators of instructions nested in it as it gets to
+    them. This way helpers can return or yield their instructions and be put
+    into a program as they are, and nothing is built up front. Strings are
+    Brainfuck and are yielded whole.
+
+    program (Iterable[Instruction|str|Iterable]): the program to flatten
+    """
+    stack = [iter(program)]
+    while stack:
+        for item in stack[-1]:
+            if isinstance(item, str) or not isinstance(item, Iterable):
+                yield item
+            else:
+                stack.append(iter(item))
+                break
+        else:
+            stack.pop()
+
+
+def lower_dsl(program):
+    """
+    lower_dsl lowers a DSL program, see DSLCode.
+
+    program (Iterable[Instruction]): the instructions to lower, see flatten
+    """
+    code = DSLCode()
+    for i, inst in enumerate(flatten(program)):
+        code.index = i
+        code.lower(inst)
+    return code.finish()
+
+
+class NativeCode:
+    """
+    NativeCode serializes DSL programs into the ops bf_cpp.assemble runs
+    natively, one op per instruction except that runs of ADD and of SHF
+    merge. Instructions add themselves to it with their assemble method.
+
+    Properties:
+    ops (array[int]): the (op, arg, off) triples so far
+    data (bytearray): the bytes OP_WRITE and OP_REPEAT write
+    """
+
+    def __init__(self):
+        self.ops = array("i")
+        self.data = bytearray()
+
+    def emit(self, op, arg=0, off=0):
+        """
+        emit adds an op, see bf_cpp.assemble.
+
+        op (int): one of the bf_cpp.OP_* constants
+        arg (int): the op's argument
+        off (int): the op's offset
+        """
+        if op in (bf_cpp.OP_ADD, bf_cpp.OP_MOVE) and self.ops and self.ops[-3] == op:
+            self.ops[-2] += arg
+            if not self.ops[-2]:
+                del self.ops[-3:]
+        elif op not in (bf_cpp.OP_ADD, bf_cpp.OP_MOVE) or arg:
+            self.ops.extend((op, arg, off))
+
+    def write(self, data):
+        """write writes data"""
+        self.emit(bf_cpp.OP_WRITE, len(self.data), len(data))
+        self.data += data
+
+    def repeat(self, c, off):
+        """repeat writes the byte c as many times as the cell at off says"""
+        i = self.data.find(c)
+        if i == -1:
+            i = len(self.data)
+            self.data.append(c)
+        self.emit(bf_cpp.OP_REPEAT, i, off)
+
+    def loop(self, insts):
+        """loop assembles insts into a loop on the current cell"""
+        self.emit(bf_cpp.OP_JZ)
+        for inst in insts:
+            inst.assemble(self)
+        self.emit(bf_cpp.OP_JNZ)
+
+
+@lru_cache(maxsize=64)
+def compile_dsl_c(ops, data):
+    """
+    compile_dsl_c assembles serialized DSL (see assemble_dsl) into a
+    bf_cpp.Program, caching the result.
+
+    ops (bytes): the serialized ops
+    data (bytes): the bytes they write
+    """
+    return bf_cpp.assemble(ops, data)
+
+
+def assemble_dsl(program):
+    """
+    assemble_dsl serializes a DSL program for bf_cpp.assemble, see
+    NativeCode. Returns the ops and data as bytes.
+
+    program (Iterable[Instruction]): the instructions to serialize, see flatten
+    """
+    code = NativeCode()
+    for inst in flatten(program):
+        inst.assemble(code)
+    return code.ops.tobytes(), bytes(code.data)
+
+
+class Tape:
+    """
+    Tape holds the cells of an interpreter in a bytearray for one byte cells
+    and in an array of the matching unsigned type for wider ones, which take a
+    fraction of the memory of a list of ints and can be handed to bf_cpp as
+    is. Indexing gives ints and slicing gives lists, and a Tape compares equal
+    to any sequence of the same values, so it reads like the list it replaced.
+    Every value stored must already fit in a cell.
+
+    size (int): number of cells
+    cell_size (int): number of bytes per cell
+    values (Iterable[int]): initial values of the first cells, wrapped to fit
+
+    Properties:
+    cells (bytearray|array): the cells themselves, for the engines to work on
+    """
+
+    def __init__(self, size, cell_size=1, values=()):
+        if cell_size == 1:
+            self.cells = bytearray(size)
+        else:
+            self.cells = array(cell_typecode(cell_size), bytes(size * cell_size))
+        mask = (1 << (8 * cell_size)) - 1
+        values = [v & mask for v in values]
+        self.cells[:len(values)] = (
+            bytearray(values) if cell_size == 1 else array(self.cells.typecode, values)
+        )
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self.cells[i])
+        return self.cells[i]
+
+    def __setitem__(self, i, v):
+        self.cells[i] = v
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def __eq__(self, other):
+        if isinstance(other, Tape):
+            other = other.cells
+        try:
+            return len(self.cells) == len(other) and all(map(int.__eq__, self.cells, other))
+        except TypeError:
+            return NotImplemented
+
+    def __repr__(self):
+        return f"Tape({list(self.cells)})"
+
 
 class Interpreter:
     """
@@ -12,11 +559,22 @@ class Interpreter:
     tape_size [int]: sets the number of cells
     cell_size [int]: sets the number of bytes per cell
     debug [bool]: whether or not to print debug messages
-    killtime [int|None]: how many steps until we should just die
+    killtime [int|None]: how many steps until we should just die. Like timeout
+    and cancel it's checked as loops jump back and once more when a run ends,
+    so a run can go a loop iteration or a stretch of loop-free code past it
+    timeout [float|None]: how many seconds a single exec may run for
+    output [BinaryIO|None]: where output bytes are written, stdout if None
+    cancel [bytearray|None]: a run stops as soon as cancel[0] is nonzero, so
+    another thread can stop it by setting that byte
     
     Properties:
+    tape (Tape): the cells, see Tape
+    mask (int): the largest value a cell holds, values are wrapped with & mask
     dp (int): data pointer or cursor. Points to the currently selected cell.
+    input (bytearray): the input tape, str input is encoded as latin-1
     itp (int): input tape pointer, is incremented as , is called
+    buffer (bytearray): output that hasn't been written to output yet, it's
+    flushed when it grows past BUFFER_SIZE and at the end of every exec
     """
     
     def __init__(
@@ -26,24 +584,103 @@ class Interpreter:
         tape_size=None,
         cell_size=1,
         debug=False,
-        killtime=None
+        killtime=None,
+        timeout=None,
+        output=None,
+        cancel=None,
     ):
         if not set_tape:
             self.tape_size = tape_size or 30000
-            self.tape = [0 for _ in range(self.tape_size)]
         else:
             self.tape_size = tape_size or len(set_tape)
-            self.tape = [0 for _ in range(self.tape_size)]
-            self.tape[:len(set_tape)] = set_tape
+        self.tape = Tape(self.tape_size, cell_size, set_tape or ())
 
         self.debug = debug
         self.cell_size = cell_size
-        self.input = set_input
+        self.mask = (1 << (8 * cell_size)) - 1
+        if isinstance(set_input, str):
+            set_input = set_input.encode("latin-1", "replace")
+        self.input = bytearray(set_input)
+        self.output = output
+        self.buffer = bytearray()
 
+        self.real_stdin = False
         self.dp = 0
         self.itp = 0
         self.steps = 0
         self.killtime = killtime
+        self.timeout = timeout
+        self.deadline = None
+        self.cancel = cancel
+
+    def write(self, data):
+        """
+        write buffers output, flushing it once there is enough of it.
+
+        data (bytes): the bytes to output
+        """
+        self.buffer += data
+        if len(self.buffer) >= BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        flush writes the buffered output to output, or to stdout if that is
+        None.
+        """
+        if not self.buffer:
+            return
+        if self.output is not None:
+            self.output.write(self.buffer)
+        else:
+            # anything printed as text has to come out first
+            sys.stdout.flush()
+            if hasattr(sys.stdout, "buffer"):
+                sys.stdout.buffer.write(self.buffer)
+                sys.stdout.buffer.flush()
+            else:
+                sys.stdout.write(self.buffer.decode("latin-1"))
+        self.buffer.clear()
+
+    def start_clock(self):
+        """
+        start_clock starts the timeout for an exec, if there is one.
+        """
+        if self.timeout is not None:
+            self.deadline = time.monotonic() + self.timeout
+
+    def check_limits(self, ip):
+        """
+        check_limits raises LimitExceeded if killtime has been exceeded, the
+        current exec has run out of time or it has been cancelled.
+
+        ip (int): where in the program we are, reported with the exception
+        """
+        if self.killtime is not None and self.steps > self.killtime:
+            self.limit_exceeded(
+                "steps", f"exceeded maximum steps, died {self.steps} > {self.killtime}", ip
+            )
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            self.limit_exceeded("timeout", "timed out", ip)
+        if self.cancel is not None and self.cancel[0]:
+            self.limit_exceeded("cancelled", "cancelled", ip)
+
+    def limited(self):
+        """
+        limited says whether check_limits has anything to check.
+        """
+        return (
+            self.killtime is not None or self.deadline is not None or self.cancel is not None
+        )
+
+    def limit_exceeded(self, reason, message, ip):
+        exc = LimitExceeded(message)
+        exc.reason = reason
+        exc.ip = ip
+        exc.dp = self.dp
+        exc.steps = self.steps
+        exc.output = None
+        raise exc
 
     def disp(self, cells=None):
         """
@@ -59,6 +696,127 @@ class Interpreter:
             s += f"{'>' if i == self.dp else ' '}{self.tape[i]:3}"
         return s
 
+    def _read_input(self):
+        if self.itp >= len(self.input) and self.real_stdin:
+            # whoever is typing the input should see what it's asked for
+            self.flush()
+            if hasattr(sys.stdin, "buffer"):
+                self.input += sys.stdin.buffer.read1(BUFFER_SIZE)
+            else:
+                self.input += sys.stdin.readline().encode("latin-1", "replace")
+        if self.itp >= len(self.input):
+            return 0
+        self.itp += 1
+        return self.input[self.itp - 1]
+
+    def _run(self, ops, pos, tail):
+        """
+        _run runs lowered ops (see lower_py and DSLCode) on the tape. Limits
+        are checked as loops jump back and when the ops run out, and only if
+        there are any.
+        """
+        tape = self.tape.cells
+        mask = self.mask
+        out = self.buffer
+        limited = self.limited()
+        dp = self.dp
+        steps = self.steps
+
+        ip = 0
+        try:
+            while ip < len(ops):
+                op, arg, off = ops[ip]
+                if op == OP_ADD:
+                    tape[dp + off] = (tape[dp + off] + arg) & mask
+                elif op == OP_MOVE:
+                    dp += arg
+                elif op == OP_JNZ:
+                    steps += off
+                    if tape[dp]:
+                        if limited:
+                            self.dp, self.steps = dp, steps
+                            self.check_limits(pos[ip])
+                        ip = arg
+                elif op == OP_JZ:
+                    steps += off
+                    if not tape[dp]:
+                        ip = arg
+                elif op == OP_MUL:
+                    v = tape[dp + off]
+                    if v:
+                        for o, factor in arg:
+                            tape[dp + off + o] = (tape[dp + off + o] + v * factor) & mask
+                        tape[dp + off] = 0
+                elif op == OP_SCAN:
+                    if arg == 1:
+                        try:
+                            dp = tape.index(0, dp)
+                        except ValueError:
+                            raise IndexError("dp ran off the end of the tape") from None
+                    else:
+                        while tape[dp]:
+                            dp += arg
+                elif op == OP_OUT:
+                    out.append(tape[dp + off] & 255)
+                    if len(out) >= BUFFER_SIZE:
+                        self.flush()
+                elif op == OP_IN:
+                    tape[dp + off] = self._read_input()
+                elif op == OP_COPY:
+                    tape[dp + off] = tape[dp + off + arg]
+                elif op == OP_WRITE:
+                    self.write(arg)
+                elif op == OP_REPEAT:
+                    self.write(arg * tape[dp + off])
+                else:
+                    self.dp, self.steps = dp, steps
+                    arg.exec(self)
+                    dp, steps = self.dp, self.steps
+                ip += 1
+            steps += tail
+            if limited:
+                self.dp, self.steps = dp, steps
+                self.check_limits(pos[-1] + 1 if pos else 0)
+        finally:
+            self.dp, self.steps = dp, steps
+
+    def _run_c(self, program, engine, end, profile=False):
+        """
+        _run_c runs a bf_cpp.Program on the tape with the given bf_cpp engine,
+        returning its RunResult. end is the ip limits that are only exceeded
+        once the program has finished are reported at.
+        """
+        capture = self.output is not None
+        try:
+            res = program.run(
+                None if self.real_stdin else bytes(self.input[self.itp:]),
+                tape=self.tape.cells,
+                dp=self.dp,
+                cell_width=self.cell_size,
+                engine=engine,
+                max_steps=-1 if self.killtime is None else max(self.killtime - self.steps, 0),
+                timeout=-1 if self.timeout is None else self.timeout,
+                cancel=self.cancel,
+                profile=profile,
+                capture=capture,
+            )
+        except LimitExceeded as e:
+            # the tape is run in place, so it's already as the run left it
+            if capture:
+                self.write(e.output)
+            self.dp = e.dp
+            self.steps += e.steps
+            e.steps = self.steps
+            raise
+        if capture:
+            self.write(res.output)
+        self.dp = res.dp
+        self.itp += res.input_pos
+        self.steps += res.steps
+        if self.limited():
+            self.check_limits(end)
+        return res
+
     def exec(self, *program):
         """
         exec executes a given program (list of *something*, should probably be
@@ -73,25 +831,79 @@ class Interpreter:
 
 class DSLInterpreter(Interpreter):
     """
-    DSLInterpreter interprets DSL programs. It does so by, for a given set of
-    DSL instructions, calls each of their `.exec` methods
+    DSLInterpreter interprets DSL programs. It lowers them to the ops the
+    python Brainfuck engine runs (see DSLCode) and runs those. In debug mode
+    it instead calls the `.exec` method of each instruction, printing the
+    instruction and the tape as it goes, and checks limits after every one.
+
+    Properties:
+    engine [str|None]: "py" (the default) for the above, or "c" or "threaded"
+    to run the instructions natively with the matching bf_cpp engine (see
+    bf_cpp.assemble), which is faster still. steps then counts native ops,
+    which are one per instruction except that loops take two and runs of
+    ADD or SHF one.
     """
+
+    depth = 0
+
+    def __init__(
+        self,
+        set_tape=None,
+        set_input="",
+        tape_size=None,
+        cell_size=1,
+        debug=False,
+        killtime=None,
+        timeout=None,
+        output=None,
+        engine=None,
+        cancel=None,
+    ):
+        super().__init__(
+            set_tape, set_input, tape_size, cell_size, debug, killtime, timeout, output, cancel
+        )
+        self.engine = engine or "py"
+        if self.engine not in ("py", "c", "threaded"):
+            raise ValueError(f"unknown engine {self.engine!r}")
+        if self.engine != "py" and not bf_cpp:
+            raise ValueError(f"the {self.engine} engine needs the bf_cpp extension")
+        if self.engine != "py" and debug:
+            raise ValueError(f"the {self.engine} engine can't debug")
     
     def exec(self, *program):
         """
         Executes a given DSL program
 
-        *program (*list[Instruction]): list of DSL instructions to execute
+        *program (*Instruction|Iterable[Instruction]): DSL instructions to
+        execute, see flatten
         """
-        for inst in program:
-            if self.debug:
+        # LOOP bodies (in debug mode) and instructions that can't be lowered
+        # come back through exec, only the outermost one times out and flushes
+        if not self.depth:
+            self.start_clock()
+        self.depth += 1
+        try:
+            if self.engine != "py":
+                program = list(flatten(program))
+                self._run_c(
+                    compile_dsl_c(*assemble_dsl(program)), C_ENGINES[self.engine], len(program)
+                )
+                return
+            if not self.debug:
+                self._run(*lower_dsl(program))
+                return
+            for i, inst in enumerate(flatten(program)):
+                self.flush()
                 print(repr(inst))
-            self.steps += 1
-            inst.exec(self)
-            if self.debug:
+                self.steps += 1
+                inst.exec(self)
+                self.flush()
                 print(self.disp(self.tape_size))
-            if self.killtime is not None and self.steps > self.killtime:
-                raise Exception(f"exceeded maximum steps, died {self.steps} > {self.killtime}")
+                self.check_limits(i)
+        finally:
+            self.depth -= 1
+            if not self.depth:
+                self.flush()
 
 
 class BFInterpreter(Interpreter):
@@ -104,7 +916,24 @@ class BFInterpreter(Interpreter):
     Properties:
     real_stdin [bool]: whether or not to read from a real stdin
     use_clib [bool]: whether or not to execute the Brainfuck program using the
-    c++ library. This will use real stdin whether real_stdin is set or not.
+    c++ library. The tape, dp and input tape are handed to it and updated
+    when it finishes, just like with the python interpreter.
+    engine [str|None]: which engine to execute with, one of "c" (the c++
+    bytecode interpreter), "threaded" (the same with computed goto dispatch),
+    "jit" (c++ compiled to machine code at runtime), "py" (the python
+    interpreter) or "transpile" (python, translated to a python function
+    first, see transpile). Defaults to "c" or "py" based on use_clib, and to
+    "py" if the c++ library isn't available.
+
+    profile [bool]: whether the c++ engine should count how many times each
+    character of the program ran. After exec, counts holds that for each
+    source offset and loops the total iterations of the loop opened at each
+    "[" (see bf_cpp.Program.run). Only the "c" engine can profile.
+
+    steps counts the folded ops each engine lowers the program to, not
+    Brainfuck characters, so it varies between the python engine (see
+    lower_py) and the c++ ones. Limits are checked when a loop jumps back and
+    when the program ends.
     """
     
     def __init__(
@@ -115,74 +944,83 @@ class BFInterpreter(Interpreter):
         cell_size=1,
         debug=False,
         real_stdin=False,
-        use_clib=False
+        use_clib=False,
+        engine=None,
+        killtime=None,
+        timeout=None,
+        profile=False,
+        output=None,
+        cancel=None,
     ):
-        super().__init__(set_tape, set_input, tape_size, cell_size, debug)
+        super().__init__(
+            set_tape, set_input, tape_size, cell_size, debug, killtime, timeout, output, cancel
+        )
         self.real_stdin = real_stdin
         self.use_clib = use_clib
+        self.engine = engine or ("c" if (use_clib or profile) and bf_cpp else "py")
+        if self.engine not in ("py", "transpile", *C_ENGINES):
+            raise ValueError(f"unknown engine {self.engine!r}")
+        if self.engine in C_ENGINES and not bf_cpp:
+            raise ValueError(f"the {self.engine} engine needs the bf_cpp extension")
+        if profile and self.engine != "c":
+            raise ValueError(f"the {self.engine} engine can't profile")
+        self.profile = profile
+        self.counts = None
+        self.loops = None
 
     def exec(self, *program):
         """
         Executes a given Brainfuck program
 
-        *program (*list[str]): list of Brainfuck strings to execute
+        *program (*str|Iterable[str]): Brainfuck strings (or anything that
+        turns into one) to execute, see flatten
         """
-        if self.use_clib:
-            self._exec_c(*program)
-        else:
-            self._exec_py(*program)
+        self.start_clock()
+        try:
+            if self.engine in ("py", "transpile"):
+                self._exec_py(*program)
+            else:
+                self._exec_c(*program)
+        finally:
+            self.flush()
         
     def _exec_py(self, *program):
-        for inst in program:
+        run = self._exec_transpiled if self.engine == "transpile" else self._exec_brainfuck
+        for inst in flatten(program):
             if self.debug:
+                self.flush()
                 print(repr(inst))
-            self._exec_brainfuck(str(inst))
+            run(str(inst))
             if self.debug:
+                self.flush()
                 print(self.disp(self.tape_size))
 
     def _exec_c(self, *program):
+        code = "".join(map(str, flatten(program)))
+        res = self._run_c(compile_c(code), C_ENGINES[self.engine], len(code), self.profile)
+        self.counts = res.counts
+        self.loops = res.loops
 
-        program_str = "".join(map(str, program))
-        bf_cpp.execute(self.tape_size, self.cell_size, program_str)
+    def _exec_transpiled(self, code):
+        def check(dp, steps, pos):
+            self.dp, self.steps = dp, steps
+            self.check_limits(pos)
 
-    def _exec_brainfuck(self, code):
-        stack = []
-        jump_table = {}
-        for i, c in enumerate(code):
-            if c == "[":
-                stack.append(i)
-            elif c == "]":
-                origin = stack.pop()
-                jump_table[origin] = i
-                jump_table[i] = origin
+        fn, _ = transpile(code)
+        limited = self.limited()
+        self.dp, self.steps = fn(
+            self.tape.cells,
+            self.dp,
+            self.steps,
+            self.mask,
+            self.buffer,
+            self.flush,
+            self._read_input,
+            check,
+            limited,
+        )
+        if limited:
+            self.check_limits(len(code))
 
-        ip = 0
-        while ip < len(code):
-            match code[ip]:
-                case ">":
-                    self.dp += 1
-                case "<":
-                    self.dp -= 1
-                case "+":
-                    self.tape[self.dp] += 1
-                    self.tape[self.dp] %= 2 ** (self.cell_size * 8)
-                case "-":
-                    self.tape[self.dp] -= 1
-                    self.tape[self.dp] %= 2 ** (self.cell_size * 8)
-                case ".":
-                    print(chr(self.tape[self.dp]), end="")
-                case ",":
-                    if self.itp >= len(self.input) and self.real_stdin:
-                        self.input += sys.stdin.readline()
-                    if self.itp >= len(self.input):
-                        self.tape[self.dp] = 0
-                    else:
-                        self.tape[self.dp] = ord(self.input[self.itp])
-                        self.itp += 1
-                case "[":
-                    if not self.tape[self.dp]:
-                        ip = jump_table[ip]
-                case "]":
-                    if self.tape[self.dp]:
-                        ip = jump_table[ip]
-            ip += 1
+    def _exec_brainfuck(self, code):
+        self._run(*lower_py(code))
@@ -4,7 +4,45 @@ import importlib
 import types
 import re
 
-from bfbbfb.interpreter import BFInterpreter
+from bfbbfb.alloc import allocate
+from bfbbfb.dsl import emit, fold, optimize
+from bfbbfb.interpreter import BFInterpreter, bf_cpp
+
+
+def profile_report(program, counts, loops, top=10):
+    """
+    profile_report lists the loops that ran the most iterations, with their
+    source offsets, how much of the run was spent inside them and the code
+    around them.
+
+    program (str): the Brainfuck that was profiled
+    counts (array[int]): how often each character ran, by source offset
+    loops (array[int]): total iterations of the loop opened at each offset
+    top (int): how many loops to list
+    """
+    ends = {}
+    stack = []
+    for i, c in enumerate(program):
+        if c == "[":
+            stack.append(i)
+        elif c == "]":
+            ends[stack.pop()] = i
+
+    total = sum(counts) or 1
+    hot = sorted(ends, key=lambda i: loops[i], reverse=True)[:top]
+
+    lines = [f"{total} characters executed, hottest loops:"]
+    lines.append(f"{'offset':>8} {'iterations':>12} {'time':>6}  code")
+    for start in hot:
+        if not loops[start]:
+            break
+        inside = sum(counts[start : ends[start] + 1])
+        before = " ".join(program[max(start - 10, 0) : start].split())
+        loop = " ".join(program[start : start + 40].split())
+        lines.append(
+            f"{start:>8} {loops[start]:>12} {inside / total:>6.1%}  {before:>10} {loop}"
+        )
+    return "\n".join(lines)
 
 
 def run():
@@ -35,7 +73,7 @@ def run():
         "--raw", action="store_true", help="treat the program as a raw brainfuck string"
     )
     run_parser.add_argument(
-        "--width", choices=[1, 2, 4, 8], default=1, help="set width of cell in bytes"
+        "--width", type=int, choices=[1, 2, 4, 8], default=1, help="set width of cell in bytes"
     )
     run_parser.add_argument(
         "--length", type=int, default=30000, help="set tape length"
@@ -50,6 +88,28 @@ def run():
     run_parser.add_argument(
         "--use-py", action="store_true", help="use a python interpreter instead of the c++ one"
     )
+    run_parser.add_argument(
+        "--engine",
+        choices=["c", "threaded", "jit", "py", "transpile"],
+        default=None,
+        help="engine to run with: the c++ interpreter, the c++ interpreter with "
+        "computed goto dispatch, the c++ jit compiler (x86-64 only), the python "
+        "interpreter or python transpiled to a python function. defaults to c, "
+        "or py if the c++ library isn't built",
+    )
+    run_parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="count how often each character runs and report the hottest loops "
+        "on stderr (c++ interpreter only)",
+    )
+    run_parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=10,
+        help="how many loops to report with --profile",
+        metavar="LOOPS",
+    )
     run_parser.add_argument("program", type=str, help="the program to run")
 
     dsl_parser.add_argument(
@@ -65,9 +125,27 @@ def run():
         action="store_true",
         help="to see arguments and defaults for the DSL file you're compiling",
     )
+    dsl_parser.add_argument(
+        "--allocate",
+        action="store_true",
+        help="give the named cells (see bfbbfb.alloc) places on the tape before compiling",
+    )
+    dsl_parser.add_argument(
+        "--fold",
+        action="store_true",
+        help="drop what the known values of cells make useless, and warn about temporaries that aren't zero",
+    )
+    dsl_parser.add_argument(
+        "--optimize",
+        action="store_true",
+        help="run the peephole optimizer over the DSL before compiling it",
+    )
     dsl_parser.add_argument("args", nargs="*")
 
     namespace = parser.parse_args(sys.argv[1:])
+    if namespace.command == "run" and namespace.profile:
+        if namespace.use_py or namespace.engine not in (None, "c") or not bf_cpp:
+            run_parser.error("--profile needs the c switch engine")
     match namespace.command:
         case "run":
             bf = namespace.program
@@ -83,12 +161,21 @@ def run():
                 tape_size=namespace.length,
                 cell_size=namespace.width,
                 real_stdin=True,
-                use_clib=not namespace.use_py
+                use_clib=True,
+                engine="py" if namespace.use_py else namespace.engine,
+                profile=namespace.profile,
             )
             i.exec(bf)
 
+            if namespace.profile:
+                sys.stdout.flush()
+                print(
+                    profile_report(bf, i.counts, i.loops, namespace.profile_top),
+                    file=sys.stderr,
+                )
+
             if namespace.print_tape != -1:
-                i.disp(namespace.print_tape)
+                print(i.disp(namespace.print_tape))
 
         case "dsl":
             loader = importlib.machinery.SourceFileLoader("file", namespace.file)
@@ -140,12 +227,19 @@ def run():
                     args.append(arg)
 
             res = mod.compile(*args, **kwargs)
-            output = "".join(map(str, res))
-
+            if namespace.allocate:
+                res, _ = allocate(res)
+            if namespace.fold:
+                res, problems = fold(res, zeroed=True)
+                for problem in problems:
+                    print(f"bfbbfb: warning: {problem}", file=sys.stderr)
+            if namespace.optimize:
+                res = optimize(res)
             if namespace.output:
-                print(output)
+                emit(res, sys.stdout)
+                print()
             else:
                 fname = next(re.finditer(r"(\w+)\.py$", namespace.file)).group(1) + ".bf"
                 with open(fname, "w") as f:
-                    f.write(output)
+                    emit(res, f)
                 print(f"Successfully compiled {namespace.file} to {fname}")
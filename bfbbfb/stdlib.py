@@ -19,40 +19,36 @@ def if_conseq(tru=[], fals=[], dist=1):
     you more than likely just want to modify 0
     dist and 2x dist ABSOLUTELY want to be zero
     """
-    return [
-        SHF(dist),
-        ADD(1),
-        SHF(-dist),
-        LOOP(*tru, SHF(dist), ADD(-1)),
-        SHF(dist),
-        LOOP(SHF(-dist), *fals, SHF(dist), ADD(-1), SHF(dist)),
-        SHF(-2*dist)
-    ]
+    yield SHF(dist)
+    yield ADD(1)
+    yield SHF(-dist)
+    yield LOOP(tru, SHF(dist), ADD(-1))
+    yield SHF(dist)
+    yield LOOP(SHF(-dist), fals, SHF(dist), ADD(-1), SHF(dist))
+    yield SHF(-2*dist)
 
 def if_tmps(tmp1, tmp2, tru=[], fals=[]):
     """
     tru and fals should start and end on 0
     """
-    return [
+    yield SHF(tmp1)
+    yield ADD(1) #set flag
+    yield SHF(-tmp1)
+    yield LOOP(
+        tru,
         SHF(tmp1),
-        ADD(1), #set flag
+        ADD(-1),
         SHF(-tmp1),
-        LOOP(
-            *tru,
-            SHF(tmp1),
-            ADD(-1),
-            SHF(-tmp1),
-            MOV(0, tmp2),
-        ),
-        MOV(tmp2, 0),
-        SHF(tmp1),
-        LOOP(
-            SHF(-tmp1),
-            *fals,
-            SHF(tmp1),
-            ADD(-1)),
+        MOV(0, tmp2),
+    )
+    yield MOV(tmp2, 0)
+    yield SHF(tmp1)
+    yield LOOP(
         SHF(-tmp1),
-    ]
+        fals,
+        SHF(tmp1),
+        ADD(-1))
+    yield SHF(-tmp1)
 
 def switch(src, flag, cases, default=[]):
     """
@@ -63,32 +59,29 @@ def switch(src, flag, cases, default=[]):
 
     cases_s = sorted(cases.items())
 
-    def construct_loop(i, prev_off):
-        if i == len(cases):
-            return [LOOP(
-                SHF(*off(src, flag)),
-                ADD(-1),
-                *default,
-                SHF(*off(flag, src)),
-                ZERO(),
-            )]
-
+    # innermost first, each case's loop wraps the ones for the cases after it
+    loop = LOOP(
+        SHF(*off(src, flag)),
+        ADD(-1),
+        default,
+        SHF(*off(flag, src)),
+        ZERO(),
+    )
+    for i in reversed(range(len(cases_s))):
         case, instrs = cases_s[i]
-
-        return [LOOP(
+        prev_off = cases_s[i-1][0] if i else 0
+        loop = LOOP(
             ADD(prev_off-case),
-            *construct_loop(i+1, case),
+            loop,
             SHF(*off(src, flag)),
-            LOOP(ADD(-1), *instrs),
+            LOOP(ADD(-1), instrs),
             SHF(*off(flag, src)),
-        )]
+        )
 
-    return [
-        SHF(flag),
-        ADD(1),
-        SHF(*off(flag, src)),
-        *construct_loop(0, 0),
-    ]
+    yield SHF(flag)
+    yield ADD(1)
+    yield SHF(*off(flag, src))
+    yield loop
 
 
 
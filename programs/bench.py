@@ -0,0 +1,69 @@
+"""
+Times the bf_cpp engines against each other on the programs in this
+directory. Run it from the repository root:
+
+    python programs/bench.py [--repeat N]
+"""
+import argparse
+import time
+
+from bfbbfb import bf_cpp
+
+# program, input (None to feed the program its own source)
+CORPUS = {
+    "compile": ("programs/compile/compile.bf", None),
+    "interpret": (
+        "programs/interpret/interpret.bf",
+        "++++++++[>++++++++[>++++<-]<-]>>[-<+>]<+.+.%",
+    ),
+    "tm": ("programs/tm/tm.bf", "aaaaRbabF  aA;aaaa"),
+    "hello_world": ("programs/hello_world/hello_world.bf", ""),
+    "echo": ("programs/echo/echo.bf", "hello world\n" * 10000),
+}
+
+
+def engines():
+    out = ["switch"]
+    if bf_cpp.has_threaded:
+        out.append("threaded")
+    if bf_cpp.has_jit:
+        out.append("jit")
+    return out
+
+
+def bench(program, input, engine, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        res = program.run(input, engine=engine, capture=True)
+        best = min(best, time.perf_counter() - start)
+    return best, res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the bf_cpp engines")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per engine, best is kept")
+    namespace = parser.parse_args()
+
+    names = engines()
+    print(f"{'program':<12} {'steps':>12}", *(f"{e:>10}" for e in names))
+    for name, (path, input) in CORPUS.items():
+        with open(path) as f:
+            source = f.read()
+        program = bf_cpp.compile(source)
+        if input is None:
+            input = source
+
+        times = []
+        outputs = set()
+        for engine in names:
+            t, res = bench(program, input, engine, namespace.repeat)
+            times.append(t)
+            outputs.add(res.output)
+        assert len(outputs) == 1, f"engines disagree on {name}"
+
+        print(f"{name:<12} {res.steps:>12}", *(f"{t * 1000:>8.2f}ms" for t in times))
+
+
+if __name__ == "__main__":
+    main()
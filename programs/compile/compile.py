@@ -289,18 +289,15 @@ class CompileCtx:
             ]
             * self.stack_size,
             SHF(*off(ST, M0)),
-            *sum(
-                (
-                    [
-                        ADD(ord(c)),  # put the char value in the cell
-                        SHF(1),  # go to next
-                    ]
-                    for c, _ in sorted(
-                        self.alphabet.items(),
-                        key=lambda tup: tup[1],
-                    )
-                ),
-                [],
+            (
+                [
+                    ADD(ord(c)),  # put the char value in the cell
+                    SHF(1),  # go to next
+                ]
+                for c, _ in sorted(
+                    self.alphabet.items(),
+                    key=lambda tup: tup[1],
+                )
             ),
             SHF(-len(self.alphabet)),  # go back to M0
             SHF(*off(M0, G0)),
@@ -473,17 +470,14 @@ def if_eq_then(comp, *instr):
 def print_tape(off1, off2):
     return [
         SHF(off1),
-        *sum(
+        (
             [
-                [
-                    ADD(33),
-                    OUT(),
-                    ADD(-33),
-                    SHF(1),
-                ]
-                for _ in range(off1, off2 + 1)
-            ],
-            [],
+                ADD(33),
+                OUT(),
+                ADD(-33),
+                SHF(1),
+            ]
+            for _ in range(off1, off2 + 1)
         ),
         SHF(-off2),
     ]
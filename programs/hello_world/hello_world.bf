@@ -1 +1 @@
-+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++.+.--------------------------------------------------------------------------------------------------
+>++++++++[-<+++++++++>]<.>++++[-<+++++++>]<+.+++++++..+++.>><++++[->++++++++<]>.<<++++++++.--------.+++.------.--------.>>+.[-]<<[-]
\ No newline at end of file
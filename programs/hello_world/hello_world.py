@@ -2,5 +2,5 @@ from bfbbfb.dsl import OUT_S
 
 
 def compile():
-    return [OUT_S("Hello world!")]
+    return [OUT_S("Hello world!", tmp=1, cells=(2, 3))]
 
@@ -12,10 +12,10 @@ def get_input():
         IN(),
         ADD(-ord("%")),
         LOOP(
-           *sum([[
+            ([
                 # subtract until the next character
                 ADD(*off(-ord(chars[i-1]), -ord(chars[i]))),
-                *if_conseq(fals=[
+                if_conseq(fals=[
                     # we have to put it out of range of the registers
                     # used in if_conseq
                     SHF(3),
@@ -23,7 +23,7 @@ def get_input():
                     SHF(-3),
                 ]),
                 ] for i in range(1, len(chars))
-            ], []),
+            ),
             # retrieve our value
             ZERO(),
             MOV(3, 0),
@@ -1 +1 @@
->>>>>,>>+[-,-----------------------------------------------------------[+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++>,>,>,[->+>>+<<<]>[-<+>]<>+<[-----------------------------------------------------------------[-----[------[------[-[>-<[-]]>[->+++<]<]>[->+<]<]>[->++<]<]>[->+++++<]<]>[->++++<]<]>>[-<<+>>]<<>+<[>>>[-]<<<>-<[->>+<<]]>>[-<<+>>]<<>[<>-]<>>>[-<<+>>]<<<>><[->+<]><<[->+<]>><<<[->+<]>>><<<<[->+<]>>>><<<<<[->+<]>>>>><<<<<<+>>>>>>[<<<<<<>>>>>>[->>>>>+<<<<<]<<<<<<>>>>[->>>>>>+<<<<<<]<<<<>>>[->>>>>>+<<<<<<]<<<>>[->>>>+<<<<]<<->>>>>>>+>>>>>,>+<[-----------------------------------------------------------------[-----[------[------[-[>-<[-]]>[->+++<]<]>[->+<]<]>[->++<]<]>[->+++++<]<]>[->++++<]<]>>[-<<+>>]<<>]>+>]<]>+>>>>>>,>>>+>,[>>,]<<[<<]<<<<+[>+>>-[+>>-]>[->+<<<<+>>>]>[-<+>]<<+<<<<-[+>>[-<<+>>]<<<<-]>>[-<<+>>]<<<<<<>>>>[-<<<<+>>>>]<<<<>>>>>[-<<<+<+>>>>]<<<[->>>+<<<]<<<<<<<<<<>>>>>>>>[-<<<<<<<+>>>>>>>]<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<>>>>>>[>>>>>>]>><<<<<<<<>>>>>>>>>[-<<<<<<<<+>>>>>>>>]<<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<+>>>>>]<<<<<<<+[->>>>>[-<+<+>>]<[->+<]<<<<>>[->>+<<<<+>>]>>[-<<+>>]<<<<[->>>-<<<]>>>[[-]<<<<<<<<<<>>>>>>>>[-<<<<<<<+>>>>>>>]<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<>>>>>>[>>>>>>]>><<<<<<<<>>>>>>>>>[-<<<<<<<<+>>>>>>>>]<<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<+>>>>>]<<<<<<<+>>>]<<<]>>[-]<<>>>>>>[>>>>>>]+<<<<<<[-<<<<<<]>>>>>>+<<<<<<+[[-]+>>>>>>-[+>>>>>>-]>>[-<<+>+>]<<[->>+<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<<+>>>>>]<<<<<<<>[-<+>>>+<<]<[->+<]>>[->-<]<<>>>[->+<<+>]>[-<+>]<<<<>>>[[-]<<<+>>>>>>-[+>>>>>>-]>>>>>>+<<<<<<-[+<<<<<<-]>>>]<<<>>[-<<+>>]<<]>[-]<+>>>>>>-[+>>>>>>-]>>>[-<<<+>+>>]<<<[->>>+<<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<+>>>>>>-[+>>>>>>-]>>>>[-<<<<+>+>>>]<<<<[->>>>+<<<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<<+>>>>>]<<<<<<<+>>>>>>-[+>>>>>>-]>>>>>[-<<<<<+>+>>>>]<<<<<[->>>>>+<<<<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<+>>>>]<<<<<<<>>>>>>-[++>>>>>>-]-[++>>>>>>-]<<<<<<[<<<<<<]>>>>>>-<<<<<[->>>>>+<<<<<]>>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>+<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<<[->>>>+<<<<]>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>+<<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<[->>>+<<<]>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>>+<<<<<<<<<<]>>>>>><<<<<<+>>>>>>>-[+>>>>>>-<<<<<[->>>>>+<<<<<]>>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>+<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<<[->>>>+<<<<]>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>+<<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<[->>>+<<<]>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>>+<<<<<<<<<<]>>>>>><<<<<<+>>>>>>>-]+>>>>>>[-]<<<<[->>>>+<<<<]>>>><<<<<>>>>+>><<<<<<[->>>>>>+<<<<<<]>>>>>>>>-[+<<[->>+<<]>>>>-]>[-]<<<[->>>+<<<]>>><+<<-[+<<-]<<<+>[-[-[--[-[<->[-]]<[->>[-]>++<<<]>]<[->>[-]>+<<<]>]<[->>>+>>-[+>>-]<<+<<-[+<<-]<<<]>]<[->>>+>>-[+>>-]>>+>>+<[>-<[->>>+<<<]]>>>[-<<<+>>>]<<<>[<++++++++++++++++++++++++++++++++>-]<<<<-[+<<-]<<<]>]>]+>[-[-[<->[-]]<[-++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++.-------------.+++++.------------------------------------------------------------------------------------------------.----------]>]<[-+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++++.++..-----------------------------------------------------------------------------------------.----------]>]>>>>>[.>>]++++++++++.----------
\ No newline at end of file
+>>>>>,>>+[-,-----------------------------------------------------------[+++++++++++++++++++++++++++++++++++++++++++++++++++++++++++>,>,>,[->+>>+<<<]>[-<+>]<>+<[-----------------------------------------------------------------[-----[------[------[-[>-<[-]]>[->+++<]<]>[->+<]<]>[->++<]<]>[->+++++<]<]>[->++++<]<]>>[-<<+>>]<<>+<[>>>[-]<<<>-<[->>+<<]]>>[-<<+>>]<<>[<>-]<>>>[-<<+>>]<<<>><[->+<]><<[->+<]>><<<[->+<]>>><<<<[->+<]>>>><<<<<[->+<]>>>>><<<<<<+>>>>>>[<<<<<<>>>>>>[->>>>>+<<<<<]<<<<<<>>>>[->>>>>>+<<<<<<]<<<<>>>[->>>>>>+<<<<<<]<<<>>[->>>>+<<<<]<<->>>>>>>+>>>>>,>+<[-----------------------------------------------------------------[-----[------[------[-[>-<[-]]>[->+++<]<]>[->+<]<]>[->++<]<]>[->+++++<]<]>[->++++<]<]>>[-<<+>>]<<>]>+>]<]>+>>>>>>,>>>+>,[>>,]<<[<<]<<<<+[>+>>-[+>>-]>[->+<<<<+>>>]>[-<+>]<<+<<<<-[+>>[-<<+>>]<<<<-]>>[-<<+>>]<<<<<<>>>>[-<<<<+>>>>]<<<<>>>>>[-<<<+<+>>>>]<<<[->>>+<<<]<<<<<<<<<<>>>>>>>>[-<<<<<<<+>>>>>>>]<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<>>>>>>[>>>>>>]>><<<<<<<<>>>>>>>>>[-<<<<<<<<+>>>>>>>>]<<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<+>>>>>]<<<<<<<+[->>>>>[-<+<+>>]<[->+<]<<<<>>[->>+<<<<+>>]>>[-<<+>>]<<<<[->>>-<<<]>>>[[-]<<<<<<<<<<>>>>>>>>[-<<<<<<<+>>>>>>>]<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<>>>>>>[>>>>>>]>><<<<<<<<>>>>>>>>>[-<<<<<<<<+>>>>>>>>]<<<<<<<<<<<<<<<[>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<]>>>>>>>[-<<<<<+>>>>>]<<<<<<<+>>>]<<<]>>[-]<<>>>>>>[>>>>>>]+<<<<<<[-<<<<<<]>>>>>>+<<<<<<+[[-]+>>>>>>-[+>>>>>>-]>>[-<<+>+>]<<[->>+<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<<+>>>>>]<<<<<<<>[-<+>>>+<<]<[->+<]>>[->-<]<<>>>[->+<<+>]>[-<+>]<<<<>>>[[-]<<<+>>>>>>-[+>>>>>>-]>>>>>>+<<<<<<-[+<<<<<<-]>>>]<<<>>[-<<+>>]<<]>[-]<+>>>>>>-[+>>>>>>-]>>>[-<<<+>+>>]<<<[->>>+<<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<+>>>>>>-[+>>>>>>-]>>>>[-<<<<+>+>>>]<<<<[->>>>+<<<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<<+>>>>>]<<<<<<<+>>>>>>-[+>>>>>>-]>>>>>[-<<<<<+>+>>>>]<<<<<[->>>>>+<<<<<]+<<<<<<-[+>>>>>>>[-<<<<<<+>>>>>>]<<<<<<<<<<<<<-]>>>>>>>[-<<<<+>>>>]<<<<<<<>>>>>>-[++>>>>>>-]-[++>>>>>>-]<<<<<<[<<<<<<]>>>>>>-<<<<<[->>>>>+<<<<<]>>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>+<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<<[->>>>+<<<<]>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>+<<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<[->>>+<<<]>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>>+<<<<<<<<<<]>>>>>><<<<<<+>>>>>>>-[+>>>>>>-<<<<<[->>>>>+<<<<<]>>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>+<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<<[->>>>+<<<<]>>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>+<<<<<<<<<]>>>>>><<<<<<+[<<<<<<]>>>>>>-<<<[->>>+<<<]>>>>>>>>>[-<<<<<<[->>>>>>+<<<<<<]>>>>>><<<<<<+>>>>>>>>>>>>]<<<<<<[->>>>>>>>>>+<<<<<<<<<<]>>>>>><<<<<<+>>>>>>>-]+>>>>>>[-]<<<<[->>>>+<<<<]>>>><<<<<>>>>+>><<<<<<[->>>>>>+<<<<<<]>>>>>>>>-[+<<[->>+<<]>>>>-]>[-]<<<[->>>+<<<]>>><+<<-[+<<-]<<<+>[-[-[--[-[<->[-]]<[->>[-]>++<<<]>]<[->>[-]>+<<<]>]<[->>>+>>-[+>>-]<<+<<-[+<<-]<<<]>]<[->>>+>>-[+>>-]>>+>>+<[>-<[->>>+<<<]]>>>[-<<<+>>>]<<<>[<++++++++++++++++++++++++++++++++>-]<<<<-[+<<-]<<<]>]>]+>[-[-[<->[-]]<[-<++++++++[->++++++++++++++<]>++.-------------.+++++.<<++++++++++.[-]>>[-]]>]<[-<++++++++[->++++++++++++<]>+.++..<<++++++++++.[-]>>[-]]>]>>>>>[.>>]++++++++++.----------
\ No newline at end of file
@@ -569,9 +569,11 @@ def compile(output_tape=True):
         ),
 
         # now we've either accepted or rejected. Let's see what we get.
+        # the last switch in the loop left the two registers below CONTINUE
+        # empty, so they can help build the strings
         *switch(1, 0, {
-            1: [OUT_S("acc\n")],
-            2: [OUT_S("rej\n")],
+            1: [OUT_S("acc\n", tmp=-1, cells=(-2,))],
+            2: [OUT_S("rej\n", tmp=-1, cells=(-2,))],
         }),
 
         # let's also print until the first 0
@@ -0,0 +1,180 @@
+import io
+from itertools import permutations
+from bfbbfb.alloc import AT, allocate
+from bfbbfb.dsl import ADD, SHF, ZERO, COPY, MOV, LOOP, IN, OUT, emit
+from bfbbfb.interpreter import DSLInterpreter, BFInterpreter
+import pytest
+
+
+def run(program, **kwargs):
+    i = DSLInterpreter(tape_size=10, **kwargs)
+    i.exec(*program)
+    bf = BFInterpreter(tape_size=10, **kwargs)
+    bf.exec(*program)
+    assert bf.tape == i.tape and bf.dp == i.dp
+    return i
+
+
+def test_allocate():
+    program = [
+        AT("n"),
+        IN(),
+        COPY("n", "t", "c"),
+        AT("c"),
+        LOOP(ADD(-1), AT("acc"), ADD(2), AT("c")),
+        AT("n"),
+        ZERO(),
+        AT("x"),
+        ADD(5),
+        MOV("x", "acc"),
+        AT("acc"),
+    ]
+    out, cells = allocate(program)
+    i = run(out, set_input="\x03")
+
+    assert i.tape[cells["acc"]] == 11 and i.dp == cells["acc"]
+    assert sum(i.tape[:]) == 11
+    # x is only used once n is done with, so it takes its place, and t is
+    # only needed by the COPY
+    assert cells["x"] == cells["n"]
+    assert len(set(cells.values())) == 3
+    assert min(cells.values()) == 0
+
+
+def test_loops_keep_cells_alive():
+    # acc is used before and inside the loop so it is live all through it,
+    # while tmp only lives inside one iteration at a time
+    program = [
+        AT("acc"),
+        ADD(1),
+        AT("i"),
+        ADD(3),
+        LOOP(AT("tmp"), ADD(1), MOV("tmp", "acc"), AT("i"), ADD(-1)),
+        AT("after"),
+        ADD(7),
+        MOV("after", "acc"),
+        AT("acc"),
+    ]
+    out, cells = allocate(program)
+
+    assert len({cells["acc"], cells["i"], cells["tmp"]}) == 3
+    assert cells["after"] in (cells["i"], cells["tmp"])
+    assert run(out).tape[cells["acc"]] == 11
+
+
+def moved(program, cells):
+    """how far the pointer moves running program, weighing loops by 10"""
+    pos, total = 0, 0
+
+    def go(insts, weight):
+        nonlocal pos, total
+        for inst in insts:
+            if isinstance(inst, AT):
+                total += weight * abs(cells[inst.name] - pos)
+                pos = cells[inst.name]
+            elif isinstance(inst, LOOP):
+                go(inst.insts, weight * 10)
+
+    go(program, 1)
+    return total
+
+
+def test_layout_is_cheapest():
+    program = [
+        AT("a"),
+        ADD(1),
+        AT("d"),
+        ADD(1),
+        LOOP(AT("b"), ADD(1), AT("c"), ADD(1), AT("e"), ADD(1), AT("d")),
+        LOOP(LOOP(AT("a"), ADD(1), AT("e"), ADD(1), AT("d"))),
+        AT("b"),
+        ADD(1),
+    ]
+    _, cells = allocate(program)
+
+    names = list(cells)
+    best = min(moved(program, dict(zip(names, p))) for p in permutations(range(len(names))))
+    assert moved(program, cells) == best
+
+
+def test_fixed():
+    program = [AT("in"), MOV("in", "tmp"), AT("tmp"), MOV("tmp", "out"), AT("out")]
+    out, cells = allocate(program, fixed={"in": 3, "out": 0})
+
+    assert cells["in"] == 3 and cells["out"] == 0
+    assert cells["tmp"] not in (0, 3)
+    i = DSLInterpreter([0, 0, 0, 42, 0, 0])
+    i.exec(*out)
+    assert i.tape == [42, 0, 0, 0, 0, 0] and i.dp == 0
+
+
+def test_minimal_moves():
+    out, cells = allocate([AT("a"), ADD(1), AT("b"), AT("c"), AT("b"), SHF(1), SHF(-1), OUT()])
+    assert emit(out).count(">") + emit(out).count("<") == 2 * abs(cells["b"] - cells["a"])
+
+
+def test_plain_code():
+    # without names allocate doesn't change anything but merging moves
+    program = [ADD(1), LOOP(SHF(1)), SHF(2), SHF(-1), OUT()]
+    assert allocate(program) == ([ADD(1), LOOP(SHF(1)), SHF(1), OUT()], {})
+
+
+@pytest.mark.parametrize(
+    "program",
+    [
+        [AT("a"), LOOP(AT("b"))],
+        [AT("a"), LOOP(SHF(1)), AT("b")],
+        [LOOP(SHF(1)), MOV("a", "b")],
+    ],
+)
+def test_lost(program):
+    with pytest.raises(ValueError):
+        allocate(program)
+
+
+def test_needs_allocate():
+    with pytest.raises(TypeError):
+        emit([AT("a")])
+    with pytest.raises(TypeError):
+        DSLInterpreter().exec(AT("a"))
+
+
+def test_scratch_cells():
+    out, cells = allocate([AT("a"), ADD(80, "t"), MOV("a", "b"), AT("b"), OUT()])
+    assert "[" in emit(out)
+    bf = BFInterpreter(tape_size=10, output=io.BytesIO())
+    bf.exec(*out)
+    assert bf.output.getvalue() == b"P"
+    assert sum(bf.tape[:]) == 80
+
+
+def test_offsets_use_the_current_cell():
+    # the MOV(0, "z") reads a, so x can't be given a's place before it
+    program = [AT("a"), ADD(3), MOV("x", "y"), MOV(0, "z"), AT("z")]
+    out, cells = allocate(program)
+
+    assert cells["x"] != cells["a"]
+    assert run(out).tape[cells["z"]] == 3
+
+
+def test_raw_offsets():
+    # the input at 0 and the 5 at 2 are reached by offset, so the named cells
+    # have to go around them
+    program = [
+        IN(),
+        MOV(0, "x"),
+        SHF(2),
+        ADD(5),
+        SHF(-2),
+        AT("a"),
+        ADD(3),
+        MOV("a", "b"),
+        AT("x"),
+        MOV("x", "b"),
+        AT("b"),
+    ]
+    out, cells = allocate(program)
+
+    assert not {0, 2} & set(cells.values())
+    i = run(out, set_input="\x07")
+    assert i.tape[2] == 5 and i.tape[cells["b"]] == 10
@@ -0,0 +1,380 @@
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+import io
+from pathlib import Path
+import subprocess
+import sys
+import threading
+import time
+from bfbbfb import bf_cpp
+from bfbbfb.dsl import ADD, SHF, MOV, COPY, ZERO, LOOP, OUT, OUT_S
+from bfbbfb.interpreter import BFInterpreter
+import pytest
+
+ENGINES = ["switch", "threaded"] + (["jit"] if bf_cpp.has_jit else [])
+
+
+def run(*program, tape_size=100, cell_width=1):
+    bf_cpp.execute(tape_size, cell_width, "".join(map(str, program)))
+
+
+def test_folded_add(capfd):
+    run(ADD(70), OUT(), ADD(-4), OUT())
+    assert capfd.readouterr().out == "FB"
+
+
+def test_clear_loops(capfd):
+    run(ADD(5), ZERO(), ADD(65), OUT(), "[+]", ADD(66), OUT())
+    assert capfd.readouterr().out == "AB"
+
+
+def test_mov_and_copy(capfd):
+    run(ADD(65), MOV(0, 2), SHF(2), OUT(), COPY(0, 1, 2), SHF(2), OUT(), SHF(-2), OUT())
+    assert capfd.readouterr().out == "AAA"
+
+
+def test_multiply_loop(capfd):
+    # 6 * 11 = 66, counting the loop cell up instead of down
+    run(ADD(-6), "[+>+++++++++++<]", SHF(1), OUT())
+    assert capfd.readouterr().out == "B"
+
+
+def test_nested_loops(capfd):
+    run("++++[>++++[>++++<-]<-]>>+.", SHF(1), OUT_S("!"))
+    assert capfd.readouterr().out == "A!"
+
+
+def test_comments_are_ignored(capfd):
+    run("this is +++ a comment -- with [-] loops " + "+" * 65 + ".")
+    assert capfd.readouterr().out == "A"
+
+
+@pytest.mark.parametrize("program", ["[", "]", "[]]", "[[]"])
+def test_unbalanced(program):
+    with pytest.raises(ValueError):
+        run(program)
+
+
+def test_program_reuse(capfd):
+    program = bf_cpp.compile(",[.,]")
+    for s in ["hello", "", "world"]:
+        program.run(input=s)
+    program.run(input=b"\x41\x42", tape_size=10, cell_width=2)
+
+    assert capfd.readouterr().out == "helloworldAB"
+
+
+def test_program_input_eof(capfd):
+    # once the input runs out ',' reads zero
+    bf_cpp.compile(",,+.").run(input="a")
+    assert capfd.readouterr().out == "\x01"
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_str_input_reads_like_the_python_engines(engine):
+    # latin-1, with "€" (which it doesn't have) read as "?"
+    out = io.BytesIO()
+    BFInterpreter(set_input="aé€", engine="py", output=out).exec(",[.,]")
+    res = bf_cpp.compile(",[.,]").run("aé€", engine=engine, capture=True)
+
+    assert res.output == out.getvalue() == b"a\xe9?"
+
+
+@pytest.mark.parametrize("cell_width", [1, 2, 4, 8])
+def test_engines_agree(capfdbinary, cell_width):
+    program = bf_cpp.compile(
+        ",[>+++[<->-]<[->+>++<<]>[-<+>]>>+<<<,]"  # fold input into a few cells
+        ">[.[-]]>[.-]>>-[.>]"
+    )
+    for engine in ENGINES:
+        program.run(input="hello", cell_width=cell_width, engine=engine)
+    out = capfdbinary.readouterr().out
+    n = len(out) // len(ENGINES)
+
+    assert out == out[:n] * len(ENGINES)
+
+
+def test_unknown_engine():
+    with pytest.raises(ValueError):
+        bf_cpp.compile("+").run(engine="nope")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_capture(capfdbinary, engine):
+    program = bf_cpp.compile("+[,.]")
+    data = bytes(range(1, 256)) * 1000  # larger than the output buffer
+
+    assert program.run(input=data, engine=engine, capture=True).output == data + b"\0"
+    assert capfdbinary.readouterr().out == b""
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_tape_in_place(engine):
+    tape = bytearray([3, 0, 0, 7, 0])
+    res = bf_cpp.compile("[->+>++<<]>>>,>-").run(input="ab", tape=tape, dp=0, engine=engine)
+
+    assert list(tape) == [0, 3, 6, 97, 255]
+    assert res.dp == 4
+    assert res.input_pos == 1
+    assert res.output is None
+
+
+def test_tape_bad_dp():
+    with pytest.raises(IndexError):
+        bf_cpp.compile("+").run(tape=bytearray(2), dp=2)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize(
+    "program", ["<+", "<<<<<<<<[-]", "+[>+]", "+[<+]", ">>>", "+[->>>+<<<]", ">>+[-<<<+>>>]"]
+)
+def test_off_the_tape(engine, program):
+    with pytest.raises(IndexError):
+        bf_cpp.compile(program).run(tape_size=3, engine=engine)
+    with pytest.raises(IndexError):
+        bf_cpp.execute(3, 1, program)
+    # caller tapes aren't guarded, so these are checked as the run goes
+    for tape in (bytearray(3), array("Q", bytes(24))):
+        with pytest.raises(IndexError):
+            bf_cpp.compile(program).run(tape=tape, cell_width=memoryview(tape).itemsize, engine=engine)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize(
+    "program", ["<.>", "<[+]>", ">" * 30000 + ".", "+[-" + ">" * 30000 + "+" + "<" * 30000 + "]"]
+)
+def test_just_off_the_default_tape(engine, program):
+    # 30000 cells isn't a whole number of pages, so one end of the tape isn't
+    # right against a guard region
+    with pytest.raises(IndexError):
+        bf_cpp.compile(program).run(b"", capture=True, engine=engine)
+    with pytest.raises(IndexError):
+        bf_cpp.execute(30000, 1, program)
+
+
+def test_off_the_tape_keeps_state():
+    tape = bytearray(4)
+    with pytest.raises(IndexError, match="cell 4"):
+        bf_cpp.compile("++>+[>+]").run(tape=tape)
+
+    assert list(tape) == [2, 1, 1, 1]
+
+
+def test_huge_tape():
+    # only the pages that get touched are ever allocated
+    res = bf_cpp.compile(">" * 1000 + "+[-]").run(tape_size=2**31 - 1, cell_width=8)
+    assert res.dp == 1000
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+@pytest.mark.parametrize("typecode,width", [("B", 1), ("H", 2), ("I", 4), ("Q", 8)])
+def test_cell_widths(engine, typecode, width):
+    tape = array(typecode, [0, 0, 2])
+    bf_cpp.compile("->->[-<<++>>]").run(tape=tape, cell_width=width, engine=engine)
+
+    top = 2 ** (width * 8)
+    assert list(tape) == [3, top - 1, 0]
+
+
+def test_tape_width_mismatch():
+    with pytest.raises(ValueError):
+        bf_cpp.compile("+").run(tape=bytearray(2), cell_width=2)
+
+
+def test_runs_without_gil():
+    # a few hundred ms of nested loops that can't be folded away
+    program = bf_cpp.compile("-[>-[>-[>-[-]<-]<-]<-]")
+    started = threading.Event()
+
+    def job():
+        started.set()
+        program.run()
+
+    t = threading.Thread(target=job)
+    t.start()
+    started.wait()
+    time.sleep(0.02)
+    # if the run held the GIL we would only get here once it was done
+    assert t.is_alive()
+    t.join()
+
+
+def test_thread_pool():
+    program = bf_cpp.compile(",[.,]")
+    inputs = [f"job {i}" * 100 for i in range(32)]
+    with ThreadPoolExecutor(4) as ex:
+        outputs = list(ex.map(lambda s: program.run(s, capture=True).output, inputs))
+
+    assert outputs == [s.encode() for s in inputs]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_max_steps(engine):
+    program = bf_cpp.compile("+[>+<]")
+    tape = bytearray(2)
+    with pytest.raises(bf_cpp.LimitExceeded) as e:
+        program.run(tape=tape, max_steps=1000, engine=engine)
+
+    assert e.value.reason == "steps"
+    assert e.value.ip == 5
+    assert e.value.dp == 0
+    assert 1000 < e.value.steps < 1010
+    assert tape[1] == (e.value.steps - 2) // 4 % 256
+    # a budget that is big enough doesn't get in the way
+    assert bf_cpp.compile("++[-]").run(max_steps=2, engine=engine).steps == 2
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_timeout(engine):
+    start = time.monotonic()
+    with pytest.raises(bf_cpp.LimitExceeded) as e:
+        bf_cpp.compile("+[.]").run(timeout=0.05, engine=engine, capture=True)
+
+    assert e.value.reason == "timeout"
+    assert e.value.output.startswith(b"\x01\x01")
+    assert time.monotonic() - start < 1
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_cancel(engine):
+    cancel = bytearray(1)
+    timer = threading.Timer(0.05, cancel.__setitem__, (0, 1))
+    timer.start()
+    with pytest.raises(bf_cpp.LimitExceeded) as e:
+        bf_cpp.compile("+[]").run(cancel=cancel, engine=engine)
+
+    assert e.value.reason == "cancelled"
+    assert e.value.steps > 0
+
+
+def test_profile():
+    # 3 outer iterations, each running the inner (multiply) loop twice
+    program = "+++[>++[>+<-]<-] done"
+    res = bf_cpp.compile(program).run(profile=True)
+
+    assert list(res.counts) == [1, 1, 1, 1, 3, 3, 3, 3, 6, 6, 6, 6, 6, 3, 3, 3] + [0] * 5
+    assert res.loops[3] == 3
+    assert res.loops[7] == 6
+    assert sum(res.loops) == 9
+
+
+def test_profile_off():
+    res = bf_cpp.compile("+").run()
+    assert res.counts is None and res.loops is None
+
+
+@pytest.mark.skipif(not bf_cpp.has_jit, reason="jit needs x86-64 linux")
+def test_profile_needs_switch():
+    with pytest.raises(ValueError):
+        bf_cpp.compile("+").run(profile=True, engine="jit")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_stream(engine):
+    data = b"hello world" * 10000
+    stream = bf_cpp.compile(",[.,]").stream(io.BytesIO(data), chunk_size=4096, engine=engine)
+    chunks = list(stream)
+
+    assert b"".join(chunks) == data
+    assert max(map(len, chunks)) == 4096
+    assert stream.result.input_pos == len(data)
+
+
+def test_stream_from_iterable():
+    stream = bf_cpp.compile(",[.,]").stream(iter(["aé", b"cd", "", "never read"]))
+    assert b"".join(stream) == b"a\xe9cd"
+
+
+def test_stream_is_lazy():
+    # a program that never stops can still be consumed bit by bit
+    stream = bf_cpp.compile("+[.]").stream(chunk_size=10)
+    assert next(stream) == next(stream) == b"\x01" * 10
+
+    stream.close()
+    assert list(stream) == []
+    assert stream.result is None
+
+
+def test_stream_errors():
+    stream = bf_cpp.compile("+.[>+]").stream(tape_size=10)
+    assert next(stream) == b"\x01"
+    with pytest.raises(IndexError):
+        next(stream)
+
+    def source():
+        yield b"a"
+        raise KeyError("source broke")
+
+    with pytest.raises(KeyError):
+        list(bf_cpp.compile(",[.,]").stream(source()))
+
+
+def assemble(*ops, data=b""):
+    return bf_cpp.assemble(array("i", [x for op in ops for x in op]).tobytes(), data)
+
+
+@pytest.mark.parametrize("engine", ["switch", "threaded"])
+def test_assemble(engine):
+    program = assemble(
+        (bf_cpp.OP_ADD, 3, 0),
+        (bf_cpp.OP_JZ, 0, 0),
+        (bf_cpp.OP_MOVE, 1, 0),
+        (bf_cpp.OP_ADD, 2, 0),
+        (bf_cpp.OP_MOVE, -1, 0),
+        (bf_cpp.OP_ADD, -1, 0),
+        (bf_cpp.OP_JNZ, 0, 0),
+        (bf_cpp.OP_COPY, 1, 2),
+        (bf_cpp.OP_MOV_SUB, 1, 3),
+        (bf_cpp.OP_WRITE, 0, 3),
+        (bf_cpp.OP_REPEAT, 3, 2),
+        data=b"hi!.",
+    )
+    tape = bytearray(4)
+    res = program.run(tape=tape, engine=engine, capture=True)
+
+    assert list(tape) == [0, 0, 6, 250]
+    assert res.output == b"hi!" + b"." * 6
+    assert res.steps == 2 + 5 * 3 + 4
+
+
+@pytest.mark.parametrize(
+    "ops,data",
+    [
+        ([(bf_cpp.OP_JZ, 0, 0)], b""),
+        ([(bf_cpp.OP_JNZ, 0, 0)], b""),
+        ([(99, 0, 0)], b""),
+        ([(bf_cpp.OP_WRITE, 1, 2)], b"ab"),
+        ([(bf_cpp.OP_REPEAT, 0, 0)], b""),
+    ],
+)
+def test_assemble_invalid(ops, data):
+    with pytest.raises(ValueError):
+        assemble(*ops, data=data)
+
+
+def test_assemble_off_the_tape():
+    with pytest.raises(IndexError):
+        assemble((bf_cpp.OP_MOVE, 2, 0), (bf_cpp.OP_MOV, 0, 5)).run(tape_size=4)
+    with pytest.raises(IndexError, match="cell 5"):
+        assemble((bf_cpp.OP_MOVE, 2, 0), (bf_cpp.OP_MOV, 0, 3)).run(tape=bytearray(4))
+    with pytest.raises(ValueError):
+        assemble((bf_cpp.OP_ADD, 1, 0)).run(engine="jit")
+
+
+def test_without_computed_goto(tmp_path):
+    # compilers without computed goto get the switch kernel for "threaded"
+    pytest.importorskip("setuptools")
+    source = Path(__file__).parent.parent / "bf.cpp"
+    build = (
+        "from setuptools import setup, Extension; "
+        f"setup(name='bf_cpp', ext_modules=[Extension('bf_cpp', [{str(source)!r}], "
+        "define_macros=[('BF_NO_COMPUTED_GOTO', None)])], "
+        "script_args=['-q', 'build_ext', '-b', '.', '-t', 'tmp'])"
+    )
+    check = (
+        "import bf_cpp; assert not bf_cpp.has_threaded; "
+        "r = bf_cpp.compile('++[>+++<-]>.').run(engine='threaded', capture=True); "
+        "assert r.output == b'\\x06', r"
+    )
+    subprocess.run([sys.executable, "-c", build], cwd=tmp_path, check=True)
+    subprocess.run([sys.executable, "-c", check], cwd=tmp_path, check=True)
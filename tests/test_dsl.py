@@ -1,3 +1,7 @@
+from array import array
+import dataclasses
+import io
+from bfbbfb import bf_cpp
 from bfbbfb.dsl import (
     ADD,
     SHF,
@@ -6,25 +10,50 @@ from bfbbfb.dsl import (
     COPY,
     LOOP,
     IN,
+    OUT,
     OUT_N,
     OUT_S,
+    DEBUG,
     Instruction,
+    emit,
+    emit_chunks,
+    optimize,
+    render,
+    flatten,
+    FACTORS,
+    fold,
 )
-from bfbbfb.interpreter import DSLInterpreter, BFInterpreter
+from bfbbfb.interpreter import (
+    DSLInterpreter,
+    BFInterpreter,
+    LimitExceeded,
+    lower_dsl,
+    assemble_dsl,
+    OP_ADD,
+    OP_MUL,
+    OP_MOVE,
+    OP_JZ,
+    OP_JNZ,
+)
+import pytest
 
 
 def assert_parity(
     tape: list[int], *PROG: list[Instruction]
 ) -> tuple[DSLInterpreter, BFInterpreter]:
     dsl = DSLInterpreter([*tape])
+    native = DSLInterpreter([*tape], engine="c")
     bf = BFInterpreter([*tape])
+    cpp = BFInterpreter([*tape], use_clib=True)
 
     for instr in PROG:
         dsl.exec(instr)
+        native.exec(instr)
         bf.exec(instr)
+        cpp.exec(instr)
 
-        assert dsl.tape == bf.tape
-        assert dsl.dp == bf.dp
+        assert dsl.tape == native.tape == bf.tape == cpp.tape
+        assert dsl.dp == native.dp == bf.dp == cpp.dp
 
     return (dsl, bf)
 
@@ -76,3 +105,399 @@ def test_out_s(capsys):
     assert captured.out == "hello"
     assert i.tape == [0]
     assert i.dp == 0
+
+
+@pytest.mark.parametrize("val", [1, 15, 16, 65, 97, 255, 1000, -1, -100, -255])
+def test_add_scratch(val):
+    start = 0 if val > 0 else 255
+    for tmp in [1, -1, 2]:
+        tape = [0, 0, start, 0, 0]
+        dsl, bf = assert_parity(tape, SHF(2), ADD(val, tmp), SHF(-2))
+        assert dsl.tape == [0, 0, (start + val) % 256, 0, 0]
+        assert len(str(ADD(val, tmp))) <= abs(val)
+    # for bytes the loop is a lot shorter
+    if 100 <= abs(val) < 256:
+        assert len(str(ADD(val, 1))) < 40
+
+
+def test_factors():
+    for n, abc in enumerate(FACTORS):
+        if abc is not None:
+            a, b, c = abc
+            assert a * b + c == n and a > 1
+
+
+@pytest.mark.parametrize("s", ["hello", "Hello world!\n", "acc\n", "", "~ !"])
+@pytest.mark.parametrize("tmp,cells", [(1, ()), (None, (1, 2)), (-1, (1, 2, 3))])
+def test_out_s_cells(capsysbinary, s, tmp, cells):
+    tape = [0] * 5
+    i = BFInterpreter([*tape])
+    i.exec(SHF(1), OUT_S(s, tmp, cells))
+
+    assert capsysbinary.readouterr().out == s.encode()
+    assert i.tape == tape and i.dp == 1
+    assert len(str(OUT_S(s, tmp, cells))) <= len(str(OUT_S(s)))
+
+
+def test_out_s_shorter():
+    plain = str(OUT_S("Hello world!\n"))
+    assert len(str(OUT_S("Hello world!\n", 1))) * 2 < len(plain)
+    assert len(str(OUT_S("Hello world!\n", 1, (2, 3, 4)))) * 2.5 < len(plain)
+
+
+def test_in_parity():
+    dsl, _ = assert_parity([0, 0], IN(), SHF(1), IN(), ADD(-1))
+    assert dsl.tape == [0, 255]
+
+
+@pytest.mark.parametrize(
+    "interp",
+    [
+        DSLInterpreter([1, 0], killtime=100),
+        DSLInterpreter([1, 0], killtime=100, engine="c"),
+        BFInterpreter([1, 0], killtime=100),
+        BFInterpreter([1, 0], killtime=100, use_clib=True),
+    ],
+)
+def test_killtime(interp):
+    with pytest.raises(LimitExceeded) as e:
+        interp.exec(LOOP(SHF(1), ADD(1), SHF(-1)))
+
+    assert e.value.reason == "steps"
+    assert interp.steps > 100
+    assert interp.tape[1] > 0
+
+
+def test_lower_dsl():
+    ops, pos, tail = lower_dsl(
+        [ADD(1), SHF(2), ADD(3), ADD(-1), LOOP(SHF(-2), MOV(0, 1)), ZERO(), SHF(1)]
+    )
+    assert ops == [
+        (OP_ADD, 1, 0),
+        (OP_ADD, 2, 2),
+        (OP_MOVE, 2, 0),
+        (OP_JZ, 6, 5),
+        (OP_MUL, ((1, 1),), -2),
+        (OP_MOVE, -2, 0),
+        (OP_JNZ, 3, 2),
+        (OP_MUL, (), 0),
+        (OP_MOVE, 1, 0),
+    ]
+    assert pos == [0, 3, 4, 4, 4, 4, 4, 5, 6]
+    assert tail == 2
+
+
+class SWAP(Instruction):
+    # an instruction without a lower method of its own
+    def __str__(self):
+        raise NotImplementedError()
+
+    def exec(self, interp):
+        tape = interp.tape
+        tape[interp.dp], tape[interp.dp + 1] = tape[interp.dp + 1], tape[interp.dp]
+
+
+@pytest.mark.parametrize("debug", [False, True])
+def test_unlowered_instruction(debug):
+    i = DSLInterpreter([0, 0, 0], debug=debug)
+    i.exec(ADD(3), SWAP(), SHF(1), LOOP(ADD(-1), SWAP(), ADD(1), SWAP()))
+
+    assert i.tape == [0, 0, 3]
+    assert i.dp == 1
+    assert i.steps == 4 + 3 * 4
+
+
+@pytest.mark.parametrize("engine", ["c", "threaded"])
+def test_native(engine):
+    program = [
+        IN(),
+        LOOP(MOV(0, 2), COPY(2, 3, 1), SHF(1), OUT_N("x", 1, 2, 3), SHF(-1), IN()),
+        OUT_S("done"),
+        SHF(2),
+        MOV(0, -1, sub=True),
+    ]
+    py_out, native_out = io.BytesIO(), io.BytesIO()
+    py = DSLInterpreter(tape_size=10, set_input="\x02\x01", output=py_out)
+    native = DSLInterpreter(tape_size=10, set_input="\x02\x01", engine=engine, output=native_out)
+    py.exec(*program)
+    native.exec(*program)
+
+    # the second iteration adds its input to what the first moved
+    assert native_out.getvalue() == py_out.getvalue() == b"xx" + b"xxx" + b"done"
+    assert native.tape == py.tape
+    assert (native.dp, native.itp) == (py.dp, py.itp)
+
+
+def test_assemble_dsl():
+    ops, data = assemble_dsl([ADD(1), ADD(2), SHF(1), SHF(-1), OUT_S("ab"), OUT_N("a", 1, 2, 3)])
+    assert array("i", ops).tolist() == [
+        bf_cpp.OP_ADD, 3, 0,
+        bf_cpp.OP_WRITE, 0, 2,
+        bf_cpp.OP_REPEAT, 0, 1,
+    ]
+    assert data == b"ab"
+
+
+def test_native_needs_known_instructions():
+    with pytest.raises(TypeError):
+        DSLInterpreter(engine="c").exec(SWAP())
+
+
+def test_optimize():
+    program = [
+        SHF(2),
+        SHF(-1),
+        MOV(0, 1),
+        SHF(-1),
+        ADD(-5),
+        DEBUG("here"),
+        SHF(3),
+        SHF(-3),
+        ADD(5),
+        ADD(2),
+        LOOP(SHF(1), ADD(1), ADD(-1), SHF(-1), COPY(1, 2, 3), OUT_N("a", 1, 2, 3), ADD(-1)),
+        SHF(1),
+    ]
+    assert list(optimize(program)) == [
+        SHF(1),
+        MOV(0, 1),
+        SHF(-1),
+        ADD(2),
+        LOOP(SHF(1), COPY(0, 1, 2), OUT_N("a", 0, 1, 2), SHF(-1), ADD(-1)),
+        SHF(1),
+    ]
+
+
+def test_optimize_keeps_behaviour():
+    from bfbbfb.stdlib import switch, if_tmps
+
+    out = lambda a, b=1: [SHF(b), ADD(a), SHF(-b)]
+    program = [
+        *switch(0, 1, {2: out(1), 8: out(2)}, out(100)),
+        SHF(2),
+        *if_tmps(1, 2, out(3, -1), out(4, -1)),
+        SHF(-2),
+    ]
+    optimized = list(optimize(program))
+    assert len("".join(map(str, optimized))) < len("".join(map(str, program)))
+    for start in [2, 5, 8]:
+        results = []
+        for prog in (program, optimized):
+            i = DSLInterpreter([start, 0, 0, 0, 0])
+            i.exec(*prog)
+            bf = BFInterpreter([start, 0, 0, 0, 0])
+            bf.exec(*prog)
+            assert bf.tape == i.tape and bf.dp == i.dp
+            results.append((list(i.tape), i.dp))
+        assert results[0] == results[1]
+
+
+def test_emit():
+    program = [ADD(2), LOOP(SHF(1), LOOP(OUT_S("hi")), "+", MOV(0, 1)), OUT_N("a", 0, 1, 2)]
+    expected = "".join(map(str, program))
+    out = io.StringIO()
+    emit(program, out)
+
+    assert out.getvalue() == emit(program) == expected
+    assert "".join(emit_chunks(program, size=4)) == expected
+    assert len(list(emit_chunks(program, size=4))) > 1
+
+
+def test_emit_deep_nesting():
+    # deeper than python would let a recursive emitter go
+    program = [ADD(1)]
+    for _ in range(5000):
+        program = [LOOP(*program, ADD(-1))]
+
+    assert emit(program) == "[" * 5000 + "+" + "-]" * 5000
+
+
+def test_instructions_are_values():
+    assert ADD(3) == ADD(3) and hash(ADD(3)) == hash(ADD(3))
+    assert ADD(3) != SHF(3)
+    assert len({MOV(0, 1), MOV(0, 1), MOV(0, 1, True)}) == 2
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        ADD(3).val = 4
+    with pytest.raises(dataclasses.FrozenInstanceError):
+        LOOP(ADD(1)).insts = ()
+
+
+def test_loops_are_shared():
+    body = lambda: LOOP(ADD(-1), SHF(1), LOOP(OUT(), ZERO()), SHF(-1))
+    loop = body()
+    assert body() is loop
+    assert LOOP(ADD(-1)) is not loop
+    assert repr(LOOP(ADD(1))) == "LOOP(ADD(val=1, tmp=None))"
+
+    # the text is kept on the shared loop, and emit uses it from then on
+    assert str(loop) is str(body())
+    assert emit([SHF(1), loop, loop]) == ">" + str(loop) * 2
+
+
+def test_render_cache():
+    render.cache_clear()
+    emit([OUT_S("hello")] * 10 + [ADD(3), ADD(3)])
+    info = render.cache_info()
+    assert info.misses == 2 and info.hits == 10
+
+
+def test_flatten():
+    def body():
+        yield SHF(1)
+        yield [ADD(1), (OUT() for _ in range(2))]
+        yield SHF(-1)
+
+    assert list(flatten([ADD(1), body(), "+-", [[ZERO()]]])) == [
+        ADD(1), SHF(1), ADD(1), OUT(), OUT(), SHF(-1), "+-", ZERO()
+    ]
+    assert LOOP(body(), ADD(-1)) is LOOP(*flatten(body()), ADD(-1))
+
+
+def test_generators():
+    def program():
+        yield ADD(3)
+        yield LOOP((SHF(i) for i in [1, 1]), ADD(2), [SHF(-1), SHF(-1)], ADD(-1))
+
+    expected = [ADD(3), LOOP(SHF(1), SHF(1), ADD(2), SHF(-2), ADD(-1))]
+    for interp in [
+        DSLInterpreter([0, 0, 0]),
+        DSLInterpreter([0, 0, 0], engine="c"),
+        BFInterpreter([0, 0, 0]),
+        BFInterpreter([0, 0, 0], use_clib=True),
+    ]:
+        interp.exec(program())
+        assert interp.tape == [0, 0, 6]
+    assert emit(program()) == emit(expected)
+    assert list(optimize(program())) == list(optimize(expected))
+
+
+def test_emit_is_lazy():
+    def forever():
+        while True:
+            yield ADD(1)
+            yield OUT()
+
+    chunks = emit_chunks(optimize(forever()), size=100)
+    assert next(chunks) == "+." * 50
+
+
+def test_fold():
+    program = [
+        ADD(5),
+        MOV(0, 1),
+        ZERO(),  # MOV leaves its source at zero
+        LOOP(OUT()),
+        SHF(1),
+        LOOP(ADD(-1), SHF(2), ADD(1), SHF(-2)),
+        LOOP(ADD(1)),  # the loop before only stops on zero
+        SHF(2),
+        ZERO(),
+        ADD(7),
+        COPY(0, 1, 2),
+        ZERO(),  # set from 7 to 5
+        ADD(5),
+        SHF(3),
+        ZERO(),
+        SHF(-1),
+        OUT_N("a", 0, 1, 2),
+    ]
+    folded = [
+        ADD(5),
+        MOV(0, 1),
+        SHF(1),
+        LOOP(ADD(-1), SHF(2), ADD(1), SHF(-2)),
+        SHF(2),
+        ZERO(),
+        ADD(7),
+        COPY(0, 1, 2),
+        ADD(-2),
+        SHF(3),
+        ZERO(),
+        SHF(-1),
+        OUT_N("a", 0, 1, 2),
+    ]
+    assert fold(program) == (folded, [])
+    # on a fresh tape the cell at 6 is zero too
+    assert fold(program, zeroed=True) == (folded[:10] + folded[11:], [])
+
+
+def test_fold_loops():
+    # the loop only ever changes the cells at 0 and 1, so 2 stays known
+    body = [ADD(-1), SHF(1), IN(), SHF(-1)]
+    program = [SHF(2), ADD(1), SHF(-2), IN(), LOOP(*body), SHF(1), ZERO(), SHF(1), ZERO()]
+    assert fold(program, zeroed=True)[0] == program[:-1] + [ADD(-1)]
+
+    # after a loop that moves the pointer anywhere only the cell it stopped
+    # on is known
+    program = [IN(), LOOP(SHF(1)), ZERO(), SHF(1), ZERO()]
+    assert fold(program, zeroed=True)[0] == [IN(), LOOP(SHF(1)), SHF(1), ZERO()]
+
+    # inside a loop that could run any number of times, nothing it changes
+    program = [LOOP(SHF(1), ZERO(), ADD(1), SHF(-1))]
+    assert fold(program)[0] == program
+
+
+@pytest.mark.parametrize(
+    "program",
+    [
+        # 255 + 1 is zero in a byte but not in anything wider
+        [ADD(255), ADD(1), LOOP(SHF(1), ADD(1), SHF(-1), ZERO())],
+        [ADD(255), ZERO(), ADD(10)],
+        [ADD(-1), ZERO(), ADD(3), LOOP(ADD(-1), SHF(1), ADD(2), SHF(-1))],
+    ],
+)
+@pytest.mark.parametrize("cell_size", [1, 2])
+def test_fold_any_cell_size(program, cell_size):
+    folded, _ = fold(program, zeroed=True)
+    tapes = []
+    for prog in (program, folded):
+        i = DSLInterpreter(tape_size=3, cell_size=cell_size)
+        i.exec(*prog)
+        tapes.append(i.tape)
+    assert tapes[0] == tapes[1]
+
+
+def test_fold_problems():
+    program = [
+        (SHF(1), ADD(i)) for i in [3, 4, 5, 6]
+    ] + [
+        SHF(-4),
+        IN(),
+        MOV(0, 1),
+        OUT_N("a", 0, 2, 5),
+        ADD(100, 3),
+        COPY(0, 5, 4),
+    ]
+    _, problems = fold(program, zeroed=True)
+    assert len(problems) == 4
+    assert problems[0] == "MOV(src=0, dest=1, sub=False): cell +1 has to be zero but is 3"
+    assert fold(program)[1] == []
+
+
+def test_fold_keeps_behaviour():
+    from bfbbfb.stdlib import switch, if_tmps, if_conseq
+
+    out = lambda a, b=1: [SHF(b), ADD(a), SHF(-b)]
+    program = [
+        ZERO(),
+        IN(),
+        COPY(0, 3, 4),
+        switch(0, 1, {2: out(1), 8: out(2)}, out(100)),
+        SHF(4),
+        ZERO(),
+        if_conseq([ADD(1)], [ADD(2)], 1),
+        SHF(-4),
+        SHF(2),
+        if_tmps(1, 2, out(3, -1), out(4, -1)),
+        SHF(-2),
+    ]
+    program = list(flatten(program))
+    folded, problems = fold(program, zeroed=True)
+    assert len(emit(folded)) < len(emit(program)) and not problems
+    for c in ["\x02", "\x05", "\x08"]:
+        results = []
+        for prog in (program, folded):
+            i = BFInterpreter(tape_size=8, set_input=c)
+            i.exec(prog)
+            results.append((list(i.tape), i.dp))
+        assert results[0] == results[1]
@@ -0,0 +1,197 @@
+import io
+import threading
+from bfbbfb.interpreter import (
+    BUFFER_SIZE,
+    BFInterpreter,
+    DSLInterpreter,
+    Interpreter,
+    LimitExceeded,
+    Tape,
+    lower_py,
+    transpile,
+    OP_ADD,
+    OP_MOVE,
+    OP_ZERO,
+    OP_MUL,
+    OP_SCAN,
+    OP_OUT,
+    OP_JZ,
+    OP_JNZ,
+)
+from bfbbfb.dsl import ADD, SHF, MOV, LOOP, OUT, OUT_N, OUT_S
+import pytest
+
+
+def test_lower_folds_runs():
+    ops, _, _ = lower_py("+++--> comment >>+<.")
+    assert ops == [(OP_ADD, 1, 0), (OP_ADD, 1, 3), (OP_OUT, 0, 2), (OP_MOVE, 2, 0)]
+
+
+def test_lower_loops():
+    ops, pos, tail = lower_py(">[-]<[->+>++<<][>]+[>.<-]")
+    assert ops == [
+        (OP_MUL, (), 1),
+        (OP_MUL, ((1, 1), (2, 2)), 0),
+        (OP_SCAN, 1, 0),
+        (OP_ADD, 1, 0),
+        (OP_JZ, 7, 5),
+        (OP_OUT, 0, 1),
+        (OP_ADD, -1, 0),
+        (OP_JNZ, 4, 3),
+    ]
+    assert pos[4] == 19
+    assert tail == 0
+
+
+@pytest.mark.parametrize("program", ["[", "]", "[]]", "[[]"])
+def test_lower_unbalanced(program):
+    with pytest.raises(ValueError):
+        lower_py(program)
+
+
+def test_py_matches_c():
+    program = ">,[>+++[<->-]<[->+>++<<]>[-<+>]>>+<<<,]>[>]<<[.<]"
+    py = BFInterpreter(set_input="hello", tape_size=50, engine="py")
+    c = BFInterpreter(set_input="hello", tape_size=50, engine="c")
+    py.exec(program)
+    c.exec(program)
+
+    assert py.tape == c.tape
+    assert py.dp == c.dp
+    assert py.itp == c.itp == 5
+
+
+def test_transpile_matches_py():
+    program = ">,[>+++[<->-]<[->+>++<<]>[-<+>]>>+<<<,]>[>]<<[.<]"
+    py = BFInterpreter(set_input="hello", tape_size=50, engine="py")
+    tr = BFInterpreter(set_input="hello", tape_size=50, engine="transpile")
+    py.exec(program)
+    tr.exec(program)
+
+    assert py.tape == tr.tape
+    assert (py.dp, py.itp, py.steps) == (tr.dp, tr.itp, tr.steps)
+
+
+def test_transpile_is_cached():
+    assert transpile("+[-.]") is transpile("+[-.]")
+
+
+def test_transpile_deep_nesting():
+    # more nested loops than python allows in one function
+    program = "+[>+" * 30 + "-]<-" * 30
+    i = BFInterpreter(tape_size=40, engine="transpile")
+    i.exec(program)
+
+    assert i.tape == [0] * 40
+    assert "def bf_1(" in transpile(program)[1]
+
+
+def test_transpile_killtime():
+    i = BFInterpreter([1, 0], killtime=100, engine="transpile")
+    with pytest.raises(LimitExceeded):
+        i.exec("[>+<]")
+
+    assert i.steps > 100
+    assert i.tape[1] > 0
+
+
+@pytest.mark.parametrize(
+    "interp, kwargs, program",
+    [
+        (BFInterpreter, {"engine": "py"}, ["+[]"]),
+        (BFInterpreter, {"engine": "transpile"}, ["+[]"]),
+        (BFInterpreter, {"engine": "c"}, ["+[]"]),
+        (DSLInterpreter, {}, [ADD(1), LOOP(ADD(2))]),
+        (DSLInterpreter, {"debug": True}, [ADD(1), LOOP(ADD(2))]),
+    ],
+    ids=["py", "transpile", "c", "dsl", "dsl-debug"],
+)
+def test_cancel(interp, kwargs, program, capsys):
+    cancel = bytearray(1)
+    i = interp(tape_size=3, cancel=cancel, **kwargs)
+    timer = threading.Timer(0.05, cancel.__setitem__, (0, 1))
+    timer.start()
+    with pytest.raises(LimitExceeded) as e:
+        i.exec(*program)
+
+    assert e.value.reason == "cancelled"
+    assert i.steps > 0
+
+
+@pytest.mark.parametrize(
+    "interp, kwargs, program",
+    [
+        (BFInterpreter, {"engine": "py"}, [".>" * 10]),
+        (BFInterpreter, {"engine": "transpile"}, [".>" * 10]),
+        (BFInterpreter, {"engine": "c"}, [".>" * 10]),
+        (DSLInterpreter, {}, [OUT()] * 10),
+        (DSLInterpreter, {"engine": "c"}, [OUT()] * 10),
+        (DSLInterpreter, {"debug": True}, [OUT()] * 10),
+    ],
+    ids=["py", "transpile", "c", "dsl", "dsl-c", "dsl-debug"],
+)
+def test_killtime_without_loops(interp, kwargs, program, capsys):
+    i = interp(tape_size=11, killtime=3, output=io.BytesIO(), **kwargs)
+    with pytest.raises(LimitExceeded) as e:
+        i.exec(*program)
+
+    assert e.value.reason == "steps"
+    assert i.steps > 3
+
+
+def test_tape_reads_like_a_list():
+    tape = Tape(5, values=[1, 2, 300])
+    assert isinstance(tape.cells, bytearray)
+    assert tape == [1, 2, 44, 0, 0]
+    assert tape[:2] == [1, 2]
+    assert tape[-1] == 0
+    assert tape != [1, 2, 44, 0]
+    assert tape == Tape(5, values=[1, 2, 44])
+
+
+@pytest.mark.parametrize("cell_size", [1, 2, 4, 8])
+@pytest.mark.parametrize("engine", ["py", "transpile", "c"])
+def test_wide_cells_wrap(cell_size, engine):
+    i = BFInterpreter(tape_size=3, cell_size=cell_size, engine=engine)
+    i.exec("->++[-<+>]")
+
+    assert i.tape == [1, 0, 0]
+    assert memoryview(i.tape.cells).itemsize == cell_size
+
+
+def test_dsl_wide_cells_wrap():
+    i = DSLInterpreter(tape_size=3, cell_size=2)
+    i.exec(ADD(-1), MOV(0, 1, sub=True), SHF(1), ADD(2))
+    assert i.tape == [0, 3, 0]
+
+
+@pytest.mark.parametrize("engine", ["py", "transpile", "c"])
+def test_output_sink(engine):
+    out = io.BytesIO()
+    i = BFInterpreter(set_input=b"\xff\x00a", engine=engine, output=out)
+    i.exec(",.,.,.", "+" * 100 + ".")
+
+    assert out.getvalue() == b"\xff\x00a\xc5"
+    assert i.buffer == b""
+
+
+@pytest.mark.parametrize("engine", ["py", "transpile"])
+def test_output_is_flushed_as_it_grows(engine):
+    out = io.BytesIO()
+    seen = []
+    i = BFInterpreter([3, 0], engine=engine, output=out)
+    i.flush = lambda: (seen.append(len(i.buffer)), Interpreter.flush(i))
+    # 256 * 256 bytes for each of the 3 iterations of the outer loop
+    dots = "." * 256
+    i.exec("[>-" + dots + "[" + dots + "-]<-]")
+
+    assert len(out.getvalue()) == 3 * 256 * 256
+    assert seen == [BUFFER_SIZE] * 3 + [0]
+
+
+def test_dsl_output_sink():
+    out = io.BytesIO()
+    i = DSLInterpreter([3], output=out)
+    i.exec(OUT_N("a", 0, 1, 2), OUT_S("\xe9!"), ADD(62), OUT())
+
+    assert out.getvalue() == b"aaa\xe9!A"